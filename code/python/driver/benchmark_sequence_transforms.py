@@ -0,0 +1,140 @@
+# Karl Gemayel
+# Georgia Institute of Technology
+#
+# Created: 10/17/26
+
+import random
+import logging
+import argparse
+import timeit
+from typing import *
+
+# noinspection All
+import pathmagic
+
+# noinspection PyUnresolvedReferences
+import sbsp_log  # runs init in sbsp_log and configures logger
+
+# Custom imports
+from Bio.Seq import Seq
+
+from sbsp_general import Environment
+from sbsp_alg.ortholog_finder import valid_starts_pos
+from sbsp_general.sequence_transforms import add_gaps_to_nt, mark_start_codons_in_aa
+
+# ------------------------------ #
+#           Parse CMD            #
+# ------------------------------ #
+
+
+parser = argparse.ArgumentParser("Measure the cost of converting an amino acid MSA to nucleotides and marking "
+                                 "start codons (string concatenation vs. numpy index arithmetic).")
+
+parser.add_argument('--num-sequences', type=int, default=50, help="Number of sequences in the MSA")
+parser.add_argument('--alignment-length', type=int, default=1000, help="Number of columns in the MSA")
+parser.add_argument('--gap-fraction', type=float, default=0.2, help="Fraction of gap columns in each sequence")
+parser.add_argument('--num-repeats', type=int, default=5, help="Number of conversions of the whole MSA")
+parser.add_argument('--random-seed', type=int, default=1)
+
+parser.add_argument('--pd-work', required=False, default=None, help="Path to working directory")
+parser.add_argument('--pd-data', required=False, default=None, help="Path to data directory")
+parser.add_argument('--pd-results', required=False, default=None, help="Path to results directory")
+parser.add_argument("-l", "--log", dest="loglevel", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                    help="Set the logging level", default='WARNING')
+
+parsed_args = parser.parse_args()
+
+# ------------------------------ #
+#           Main Code            #
+# ------------------------------ #
+
+# Load environment variables
+my_env = Environment(pd_data=parsed_args.pd_data,
+                     pd_work=parsed_args.pd_work,
+                     pd_results=parsed_args.pd_results)
+
+# Setup logger
+logging.basicConfig(level=parsed_args.loglevel)
+logger = logging.getLogger("logger")  # type: logging.Logger
+
+
+def add_gaps_to_nt_concatenation(seq_nt, seq_aa_with_gaps):
+    # type: (str, str) -> Seq
+    """Previous conversion (appending codons to a Seq), kept as the baseline"""
+    seq_nt_with_gaps = Seq("")
+    pos_in_nt = 0
+    for curr_aa in seq_aa_with_gaps:
+        if curr_aa == "-":
+            seq_nt_with_gaps += "---"
+        else:
+            seq_nt_with_gaps += seq_nt[pos_in_nt:pos_in_nt + 3]
+            pos_in_nt += 3
+
+    return seq_nt_with_gaps
+
+
+def mark_start_codons_in_aa_concatenation(seq_aa, seq_nt_with_gaps, valid_starts):
+    # type: (str, str, List[str]) -> str
+    """Previous start codon marking (one character at a time), kept as the baseline"""
+    new_seq_aa = ""
+    for j_aa in range(len(seq_aa)):
+        j_nt = j_aa * 3
+        if seq_nt_with_gaps[j_nt:j_nt + 3] in valid_starts:
+            new_seq_aa += seq_aa[j_aa].upper()
+        else:
+            new_seq_aa += seq_aa[j_aa].lower()
+
+    return new_seq_aa
+
+
+def generate_msa(num_sequences, alignment_length, gap_fraction, rng):
+    # type: (int, int, float, random.Random) -> List[Tuple[str, str]]
+    """Returns random (gapped amino acid, ungapped nucleotide) sequence pairs"""
+
+    msa = list()
+    for _ in range(num_sequences):
+        seq_aa = "".join("-" if rng.random() < gap_fraction else rng.choice("ACDEFGHIKLMNPQRSTVWY")
+                         for _ in range(alignment_length))
+        seq_nt = "".join(rng.choice("ACGT") for _ in range(3 * (len(seq_aa) - seq_aa.count("-"))))
+        msa.append((seq_aa, seq_nt))
+
+    return msa
+
+
+def time_conversion(add_gaps, mark_starts, msa, num_repeats):
+    # type: (Callable, Callable, List[Tuple[str, str]], int) -> float
+    """Returns the average time (in milliseconds) to convert the whole MSA"""
+    begin = timeit.default_timer()
+    for _ in range(num_repeats):
+        for seq_aa, seq_nt in msa:
+            mark_starts(seq_aa, str(add_gaps(seq_nt, seq_aa)), valid_starts_pos)
+
+    return 1e3 * (timeit.default_timer() - begin) / float(num_repeats)
+
+
+def main(env, args):
+    # type: (Environment, argparse.Namespace) -> None
+
+    msa = generate_msa(args.num_sequences, args.alignment_length, args.gap_fraction,
+                       random.Random(args.random_seed))
+
+    # make sure implementations agree
+    for seq_aa, seq_nt in msa:
+        seq_nt_with_gaps = add_gaps_to_nt(seq_nt, seq_aa)
+        if seq_nt_with_gaps != str(add_gaps_to_nt_concatenation(seq_nt, seq_aa)):
+            raise ValueError("Implementations disagree on gapped nucleotide sequence")
+        if mark_start_codons_in_aa(seq_aa, seq_nt_with_gaps, valid_starts_pos) != \
+                mark_start_codons_in_aa_concatenation(seq_aa, seq_nt_with_gaps, valid_starts_pos):
+            raise ValueError("Implementations disagree on start codon marking")
+
+    print("MSA: {} sequences, {} columns".format(args.num_sequences, args.alignment_length))
+
+    for name, add_gaps, mark_starts in [
+        ("concatenation", add_gaps_to_nt_concatenation, mark_start_codons_in_aa_concatenation),
+        ("numpy", add_gaps_to_nt, mark_start_codons_in_aa)
+    ]:
+        print("{:<20} {:>10.2f} ms/msa".format(name, time_conversion(add_gaps, mark_starts, msa, args.num_repeats)))
+
+
+if __name__ == "__main__":
+    main(my_env, parsed_args)
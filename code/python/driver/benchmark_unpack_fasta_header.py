@@ -0,0 +1,137 @@
+# Karl Gemayel
+# Georgia Institute of Technology
+#
+# Created: 10/17/26
+
+import re
+import logging
+import argparse
+import timeit
+from typing import *
+
+# noinspection All
+import pathmagic
+
+# noinspection PyUnresolvedReferences
+import sbsp_log  # runs init in sbsp_log and configures logger
+
+# Custom imports
+from Bio import SeqIO
+
+from sbsp_general import Environment
+from sbsp_alg.ortholog_finder import unpack_fasta_header, unpack_fasta_header_cached
+
+# ------------------------------ #
+#           Parse CMD            #
+# ------------------------------ #
+
+
+parser = argparse.ArgumentParser("Measure per-hit cost of decoding FASTA definition lines "
+                                 "(regex-per-key decoder vs. single-pass and memoized decoders).")
+
+parser.add_argument('--pf-sequences', required=True,
+                    help="Fasta file with packed definition lines (e.g. the input of a clade database)")
+parser.add_argument('--max-sequences', type=int, default=10000, help="Number of definition lines to decode")
+parser.add_argument('--num-repeats', type=int, default=3,
+                    help="Number of passes over the definition lines (later passes hit the cache)")
+
+parser.add_argument('--pd-work', required=False, default=None, help="Path to working directory")
+parser.add_argument('--pd-data', required=False, default=None, help="Path to data directory")
+parser.add_argument('--pd-results', required=False, default=None, help="Path to results directory")
+parser.add_argument("-l", "--log", dest="loglevel", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                    help="Set the logging level", default='WARNING')
+
+parsed_args = parser.parse_args()
+
+# ------------------------------ #
+#           Main Code            #
+# ------------------------------ #
+
+# Load environment variables
+my_env = Environment(pd_data=parsed_args.pd_data,
+                     pd_work=parsed_args.pd_work,
+                     pd_results=parsed_args.pd_results)
+
+# Setup logger
+logging.basicConfig(level=parsed_args.loglevel)
+logger = logging.getLogger("logger")  # type: logging.Logger
+
+
+def unpack_fasta_header_regex_per_key(header):
+    # type: (str) -> Dict[str, Any]
+    """Previous decoder (one regular expression per key), kept as the baseline"""
+
+    fields = {}
+
+    def get_key_value_from_definition_line(key, l_defline):
+        m = re.match(".*(?:^|;)" + str(key) + "=([^;]*)", l_defline)
+
+        if m:
+            return m.group(1)
+
+        raise ValueError("Key " + str(key) + " not in definition line")
+
+    header = header.strip().split(maxsplit=1)[1]
+    keys = re.findall(r"([^;=]+)=", header)
+
+    type_mapper = {
+        "left": int,
+        "right": int,
+        "gc": float,
+        "offset": int,
+        "upstream_left": int,
+        "upstream_right": int
+    }
+
+    for k in keys:
+        fields[k] = get_key_value_from_definition_line(k, header)
+
+        if k in type_mapper.keys():
+            fields[k] = type_mapper[k](fields[k])
+
+    return fields
+
+
+def time_decoder(decoder, headers, num_repeats):
+    # type: (Callable[[str], Any], List[str], int) -> float
+    """Returns the average time (in microseconds) to decode one header"""
+    begin = timeit.default_timer()
+    for _ in range(num_repeats):
+        for h in headers:
+            decoder(h)
+
+    return 1e6 * (timeit.default_timer() - begin) / float(num_repeats * len(headers))
+
+
+def main(env, args):
+    # type: (Environment, argparse.Namespace) -> None
+
+    headers = list()
+    for record in SeqIO.parse(args.pf_sequences, "fasta"):
+        headers.append(record.description)
+        if len(headers) >= args.max_sequences:
+            break
+
+    if len(headers) == 0:
+        raise ValueError("No sequences found in {}".format(args.pf_sequences))
+
+    # make sure decoders agree
+    for h in headers:
+        if unpack_fasta_header_regex_per_key(h) != unpack_fasta_header(h).to_dict():
+            raise ValueError("Decoders disagree on definition line: {}".format(h))
+
+    unpack_fasta_header_cached.cache_clear()
+
+    avg_length = sum(len(h) for h in headers) / float(len(headers))
+    print("Definition lines: {}, average length: {:.0f}".format(len(headers), avg_length))
+
+    for name, decoder in [("regex-per-key", unpack_fasta_header_regex_per_key),
+                          ("single-pass", unpack_fasta_header),
+                          ("single-pass-cached", unpack_fasta_header_cached)]:
+        print("{:<20} {:>10.2f} us/hit".format(name, time_decoder(decoder, headers, args.num_repeats)))
+
+    print(unpack_fasta_header_cached.cache_info())
+
+
+if __name__ == "__main__":
+    main(my_env, parsed_args)
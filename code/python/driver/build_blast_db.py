@@ -14,7 +14,10 @@ import sbsp_log  # runs init in sbsp_log and configures logger
 
 # Custom imports
 from sbsp_general import Environment
+from sbsp_alg.ortholog_finder import build_target_store_from_fasta
 from sbsp_general.blast import gen_cmd_create_blast_database
+from sbsp_general.general import os_join
+from sbsp_io.general import remove_p
 
 # ------------------------------ #
 #           Parse CMD            #
@@ -27,6 +30,9 @@ parser.add_argument('--pf-sequences', required=True, help="Fasta file with speci
                                                           "documentation for more information.")
 
 parser.add_argument('--pf-db', required=True, help="Path to output file.")
+parser.add_argument('--target-store', default=False, action="store_true",
+                    help="Move target information (e.g. LORF sequences) from definition lines into a "
+                         "memory-mapped store next to the database, keeping only short IDs in the database.")
 
 parser.add_argument('--pd-work', required=False, default=None, help="Path to working directory")
 parser.add_argument('--pd-data', required=False, default=None, help="Path to data directory")
@@ -53,7 +59,15 @@ logger = logging.getLogger("logger")  # type: logging.Logger
 def main(env, args):
     # type: (Environment, argparse.Namespace) -> None
 
-    run_shell_cmd(gen_cmd_create_blast_database(args.pf_sequences, args.pf_db, "nucl", True))
+    if args.target_store:
+        pf_sequences = os_join(env["pd-work"], "sequences_short_headers.faa")
+        num_sequences = build_target_store_from_fasta(args.pf_sequences, pf_sequences, args.pf_db)
+        logger.info("Target store created for {} sequences".format(num_sequences))
+
+        run_shell_cmd(gen_cmd_create_blast_database(pf_sequences, args.pf_db, "nucl", True))
+        remove_p(pf_sequences)
+    else:
+        run_shell_cmd(gen_cmd_create_blast_database(args.pf_sequences, args.pf_db, "nucl", True))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+# Karl Gemayel
+# Georgia Institute of Technology
+#
+# Created: 10/17/26
+
+import os
+import copy
+import logging
+import argparse
+import timeit
+import pandas as pd
+from typing import *
+
+# noinspection All
+import pathmagic
+
+# noinspection PyUnresolvedReferences
+import sbsp_log  # runs init in sbsp_log and configures logger
+
+# Custom imports
+from sbsp_alg.ortholog_finder import extract_labeled_sequences_for_genomes
+from sbsp_alg.sbsp_compute_accuracy import df_add_is_true_start
+from sbsp_alg.sbsp_steps import run_sbsp_steps
+from sbsp_alg.shelf import get_msa_backend
+from sbsp_container.genome_list import GenomeInfoList
+from sbsp_general import Environment
+from sbsp_general.general import os_join
+from sbsp_io.general import mkdir_p
+from sbsp_io.labels import read_labels_from_file
+from sbsp_io.sequences import read_fasta_into_hash
+from sbsp_options.sbsp import SBSPOptions
+
+# ------------------------------ #
+#           Parse CMD            #
+# ------------------------------ #
+
+
+parser = argparse.ArgumentParser("Compare start predictions when sequences removed by MSA filters are "
+                                 "projected out of the existing alignment, versus realigned from scratch.")
+
+parser.add_argument('--pf-q-list', required=True, help="List of query genomes (with verified labels)")
+parser.add_argument('--pf-t-db', required=True, help="Blast database of targets")
+parser.add_argument('--pf-sbsp-options', required=False, default=None, help="Custom SBSP options")
+parser.add_argument('--fn-q-labels', required=False, default="verified.gff",
+                    help="Name of labels file (in each genome's data directory) used as queries and reference")
+parser.add_argument('--max-queries', required=False, type=int, default=None,
+                    help="Only run on the first N queries")
+
+parser.add_argument('--pd-work', required=False, default=None, help="Path to working directory")
+parser.add_argument('--pd-data', required=False, default=None, help="Path to data directory")
+parser.add_argument('--pd-results', required=False, default=None, help="Path to results directory")
+parser.add_argument("-l", "--log", dest="loglevel", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                    help="Set the logging level", default='WARNING')
+
+parsed_args = parser.parse_args()
+
+# ------------------------------ #
+#           Main Code            #
+# ------------------------------ #
+
+# Load environment variables
+my_env = Environment(pd_data=parsed_args.pd_data,
+                     pd_work=parsed_args.pd_work,
+                     pd_results=parsed_args.pd_results)
+
+# Setup logger
+logging.basicConfig(level=parsed_args.loglevel)
+logger = logging.getLogger("logger")  # type: logging.Logger
+
+
+def run_with_mode(env, q_sequences, pf_t_db, sbsp_options, project_after_filter):
+    # type: (Environment, Dict[str, Any], str, SBSPOptions, bool) -> Tuple[pd.DataFrame, Dict[str, Any]]
+
+    mode = "project" if project_after_filter else "realign"
+
+    sbsp_options = copy.deepcopy(sbsp_options)
+    sbsp_options["msa-project-after-filter"] = project_after_filter
+
+    env = env.duplicate({"pd-work": os_join(env["pd-work"], mode)})
+    mkdir_p(env["pd-work"])
+    pf_output = os_join(env["pd-work"], "output.csv")
+
+    backend = get_msa_backend(sbsp_options)
+    num_runs_before = backend.num_runs
+
+    curr_time = timeit.default_timer()
+    run_sbsp_steps(env, q_sequences, pf_t_db, pf_output, sbsp_options)
+    elapsed_time = timeit.default_timer() - curr_time
+
+    df = pd.read_csv(pf_output, header=0) if os.path.isfile(pf_output) else pd.DataFrame()
+    if len(df) > 0:
+        df = df.drop_duplicates("q-key")
+
+    return df, {
+        "Mode": mode,
+        "Time (min)": round(elapsed_time / 60.0, 2),
+        "MSA runs": backend.num_runs - num_runs_before,
+        "Predictions": len(df),
+    }
+
+
+def compute_accuracy(env, df, fn_q_labels):
+    # type: (Environment, pd.DataFrame, str) -> Tuple[int, int]
+    """Returns the number of predictions with a verified label, and how many of those are correct"""
+
+    num_verified = 0
+    num_correct = 0
+
+    if len(df) == 0:
+        return num_verified, num_correct
+
+    for genome, df_genome in df.groupby("q-genome", as_index=False):
+        labels = read_labels_from_file(os_join(env["pd-data"], genome, fn_q_labels), shift=0)
+
+        df_genome = df_genome.copy()
+        df_add_is_true_start(df_genome, labels, "q-", "is-true", coordinates_suffix="-sbsp")
+
+        num_verified += int((df_genome["q-is-true"] != -1).sum())
+        num_correct += int((df_genome["q-is-true"] == 1).sum())
+
+    return num_verified, num_correct
+
+
+def count_agreements(df_a, df_b):
+    # type: (pd.DataFrame, pd.DataFrame) -> Tuple[int, int]
+    """Returns the number of queries predicted by both, and how many of those have the same start"""
+
+    if len(df_a) == 0 or len(df_b) == 0:
+        return 0, 0
+
+    columns = ["q-key", "q-left-sbsp", "q-right-sbsp"]
+    df_merged = df_a[columns].merge(df_b[columns], on="q-key", suffixes=("-a", "-b"))
+
+    num_same = int(((df_merged["q-left-sbsp-a"] == df_merged["q-left-sbsp-b"]) &
+                    (df_merged["q-right-sbsp-a"] == df_merged["q-right-sbsp-b"])).sum())
+
+    return len(df_merged), num_same
+
+
+def main(env, args):
+    # type: (Environment, argparse.Namespace) -> None
+
+    sbsp_options = SBSPOptions(env, args.pf_sbsp_options)
+
+    # queries: verified genes
+    gil = GenomeInfoList.init_from_file(args.pf_q_list)
+    mkdir_p(env["pd-work"])
+    pf_aa = os_join(env["pd-work"], "query.faa")
+    extract_labeled_sequences_for_genomes(env, gil, pf_aa,
+                                          ignore_frameshifted=True, reverse_complement=True, ignore_partial=True,
+                                          fn_labels=args.fn_q_labels)
+    q_sequences = read_fasta_into_hash(pf_aa, stop_at_first_space=False)
+
+    if args.max_queries is not None:
+        q_sequences = {k: q_sequences[k] for k in list(q_sequences.keys())[:args.max_queries]}
+
+    list_stats = list()
+    mode_to_df = dict()
+    for project_after_filter in [False, True]:
+        df, stats = run_with_mode(env, q_sequences, args.pf_t_db, sbsp_options, project_after_filter)
+
+        num_verified, num_correct = compute_accuracy(env, df, args.fn_q_labels)
+        stats["Verified"] = num_verified
+        stats["Correct"] = num_correct
+        stats["Accuracy"] = round(100.0 * num_correct / num_verified, 2) if num_verified > 0 else None
+
+        list_stats.append(stats)
+        mode_to_df[stats["Mode"]] = df
+
+    num_common, num_same = count_agreements(mode_to_df["realign"], mode_to_df["project"])
+
+    df_stats = pd.DataFrame(list_stats)
+    df_stats.to_csv(os_join(env["pd-work"], "msa_projection_comparison.csv"), index=False)
+
+    print(df_stats.to_string(index=False))
+    print("Same start in both modes: {} / {}".format(num_same, num_common))
+
+
+if __name__ == "__main__":
+    main(my_env, parsed_args)
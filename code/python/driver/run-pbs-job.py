@@ -4,6 +4,7 @@
 # Created:
 
 import logging
+import time
 import random
 import argparse
 from typing import *
@@ -54,9 +55,7 @@ logger = logging.getLogger("logger")                    # type: logging.Logger
 def main(env, args):
     # type: (Environment, argparse.Namespace) -> None
 
-    pbs_package = PBSJobPackage.load(args.pf_job_input)
-    func = pbs_package["func"]
-    func_args = pbs_package["func_kwargs"]
+    func, func_args = PBSJobPackage.load_input(args.pf_job_input)
 
     if "sbsp_options" in func_args:
 
@@ -83,9 +82,11 @@ def main(env, args):
     ).strip()
 
     # logger.critical("{}\n{}".format(func, func_args))
+    start_time = time.time()
     output = {
         "data": func(**func_args)
     }
+    output["elapsed"] = time.time() - start_time        # seconds, to size jobs of later runs
 
     PBSJobPackage.save(output, args.pf_job_output)
 
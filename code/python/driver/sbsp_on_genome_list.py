@@ -19,7 +19,11 @@ import sbsp_log  # runs init in sbsp_log and configures logger
 import sbsp_argparse.sbsp
 import sbsp_argparse.parallelization
 from sbsp_general import Environment
-from sbsp_io.general import mkdir_p
+from sbsp_io.blast import split_tabular_hits_by_group
+from sbsp_io.general import mkdir_p, remove_p
+from sbsp_io.sequences import read_fasta_into_hash
+from sbsp_alg.ortholog_finder import extract_labeled_sequences_for_genomes, unpack_fasta_header_cached
+from sbsp_alg.sbsp_steps import run_blast_on_sequences, get_blast_output_format
 from sbsp_options.sbsp import SBSPOptions
 from sbsp_general.general import os_join, get_value
 from sbsp_parallelization.generic_threading import run_one_per_thread
@@ -40,6 +44,9 @@ parser.add_argument('--pf-db-index', required=True,
                     help="Path to file containing database information for each ancestor clade")
 
 parser.add_argument('--simultaneous-genomes', type=int, default=1, help="Number of genomes to run on simultaneously.")
+parser.add_argument('--batch-blast', action="store_true", default=False,
+                    help="Run blast once per clade (on the queries of all its genomes), instead of once per genome. "
+                         "Requires tabular blast output.")
 parser.add_argument('--dn-run', default="sbsp", help="Name of directory with SBSP run.")
 
 parser.add_argument('--fn-q-labels', default="ncbi.gff", required=False, type=Union[str],
@@ -95,10 +102,79 @@ def get_clade_to_pf_db(pf_db_index):
     }
 
 
+def get_genome_pd_work(env, gi, dn_run):
+    # type: (Environment, GenomeInfo, str) -> str
+    return os_join(env["pd-work"], gi.name, dn_run)
+
+
+def run_blast_per_clade(env, gil, sbsp_options, clade_to_pf_db, **kwargs):
+    # type: (Environment, GenomeInfoList, SBSPOptions, Dict[str, str], Dict[str, Any]) -> Dict[str, str]
+    """
+    Run blast once per clade, on the queries of all its genomes, and split the hits back per genome
+    (into each genome's working directory). The database is then loaded and indexed once per clade,
+    instead of once per genome.
+    :return: path to the blast hits of each genome (by genome name)
+    """
+
+    dn_run = get_value(kwargs, "dn_run", "sbsp")
+    fn_q_labels = get_value(kwargs, "fn_q_labels", "ncbi.gff")
+
+    if get_blast_output_format(sbsp_options) != "tabular":
+        raise ValueError("Batched blast requires tabular blast output (blast-output-format)")
+
+    clade_to_list_gi = dict()  # type: Dict[str, List[GenomeInfo]]
+    for gi in gil:
+        clade = gi.attributes["ancestor"]
+        if clade not in clade_to_pf_db:
+            raise ValueError("Unknown clade {}".format(clade))
+        clade_to_list_gi.setdefault(clade, list()).append(gi)
+
+    genome_to_pf_blast_hits = dict()  # type: Dict[str, str]
+
+    for clade, list_gi in clade_to_list_gi.items():
+        logger.info("Running blast for clade {} ({} genomes)".format(clade, len(list_gi)))
+
+        pd_batch = os_join(env["pd-work"], "batch_blast", clade)
+        mkdir_p(pd_batch)
+
+        # same queries as those extracted by each genome's run
+        pf_aa = os_join(pd_batch, "query.faa")
+        extract_labeled_sequences_for_genomes(env, GenomeInfoList(list_gi), pf_aa,
+                                              ignore_frameshifted=True, reverse_complement=True, ignore_partial=True,
+                                              fn_labels=fn_q_labels)
+        q_sequences = read_fasta_into_hash(pf_aa, stop_at_first_space=False)
+
+        pf_blast_output = os_join(pd_batch, "blast_output.tsv")
+        run_blast_on_sequences(env.duplicate({"pd-work": pd_batch}), q_sequences, clade_to_pf_db[clade],
+                               pf_blast_output, sbsp_options)
+
+        # query definition lines carry their genome's name
+        genome_to_pf = dict()
+        for gi in list_gi:
+            mkdir_p(get_genome_pd_work(env, gi, dn_run))
+            genome_to_pf[gi.name] = os_join(get_genome_pd_work(env, gi, dn_run), "blast_hits.tsv")
+
+        genome_to_num_hits = split_tabular_hits_by_group(
+            pf_blast_output, lambda qtitle: unpack_fasta_header_cached(qtitle)["genome"], genome_to_pf
+        )
+        for name, num_hits in genome_to_num_hits.items():
+            logger.debug("{}: {} hits".format(name, num_hits))
+
+        remove_p(pf_aa, pf_blast_output)
+        genome_to_pf_blast_hits.update(genome_to_pf)
+
+    return genome_to_pf_blast_hits
+
+
 def setup_gi_and_run(env, gi, sbsp_options, prl_options, clade_to_pf_db, **kwargs):
     # type: (Environment, GenomeInfo, SBSPOptions, ParallelizationOptions, Dict[str, str], Dict[str, Any]) -> None
 
     dn_run = get_value(kwargs, "dn_run", "sbsp")
+    genome_to_pf_blast_hits = get_value(kwargs, "genome_to_pf_blast_hits", None)
+
+    kwargs = {k: v for k, v in kwargs.items() if k != "genome_to_pf_blast_hits"}
+    if genome_to_pf_blast_hits is not None:
+        kwargs["pf_blast_hits"] = genome_to_pf_blast_hits[gi.name]
 
     # Check if clade is known
     try:
@@ -108,7 +184,7 @@ def setup_gi_and_run(env, gi, sbsp_options, prl_options, clade_to_pf_db, **kwarg
 
     logger.info("Scheduling: {}".format(gi.name))
 
-    pd_work = os_join(env["pd-work"], gi.name, dn_run)  # genome working environment
+    pd_work = get_genome_pd_work(env, gi, dn_run)  # genome working environment
     curr_env = env.duplicate({"pd-work": pd_work})  # create environment for genome
     pf_output = os_join(pd_work, "output.csv")  # output file
 
@@ -138,11 +214,17 @@ def run_sbsp_on_genome_list(env, gil, sbsp_options, prl_options, clade_to_pf_db,
     :param kwargs: Optional arguments:
         simultaneous_genomes: Number of genomes to run simultaneously
         dn_run: Name of directory in which to put run
+        batch_blast: Run blast once per clade instead of once per genome (see run_blast_per_clade)
     :return: None
     """
 
     simultaneous_genomes = get_value(kwargs, "simultaneous_genomes", 1, default_if_none=True)
     dn_run = get_value(kwargs, "dn_run", "sbsp")
+    batch_blast = get_value(kwargs, "batch_blast", False)
+
+    kwargs = {k: v for k, v in kwargs.items() if k != "batch_blast"}
+    if batch_blast:
+        kwargs["genome_to_pf_blast_hits"] = run_blast_per_clade(env, gil, sbsp_options, clade_to_pf_db, **kwargs)
 
     run_one_per_thread(
         gil, setup_gi_and_run, data_arg_name="gi",
@@ -167,6 +249,7 @@ def main(env, args):
     run_sbsp_on_genome_list(
         env, gil, sbsp_options, prl_options, clade_to_pf_db,
         simultaneous_genomes=args.simultaneous_genomes,
+        batch_blast=args.batch_blast,
         dn_run=args.dn_run,
         steps=args.steps,
         fn_q_labels=args.fn_q_labels,
@@ -27,6 +27,7 @@ from sbsp_general import Environment
 # ------------------------------ #
 from sbsp_general.general import get_value
 from sbsp_general.labels import Labels, Label
+from sbsp_general.sequences import CodonIndex
 from sbsp_io.labels import read_labels_from_file
 from sbsp_io.sequences import read_fasta_into_hash
 
@@ -78,13 +79,6 @@ def is_valid_start(codon, strand):
         return codon in valid_starts_neg
 
 
-def is_valid_stop(codon, strand):
-    if strand == "+":
-        return codon in valid_stops_pos
-    else:
-        return codon in valid_stops_neg
-
-
 def initialize_stats():
     # type: () -> Dict[str, int]
     stats = dict()
@@ -100,127 +94,117 @@ def initialize_stats():
     return stats
 
 
-def count_candidates_on_positive_strand(sequence, label, **kwargs):
-    # type: (Seq, Label, Dict[str, Any]) -> Union[None, Dict[str, int]\
+def build_codon_index(sequences):
+    # type: (Dict[str, Seq]) -> Dict[str, Dict[str, CodonIndex]]
+    """Index of each start codon, and of stop codons, per strand"""
+    codon_index = dict()
+    for strand, valid_starts, valid_stops in [("+", valid_starts_pos, valid_stops_pos),
+                                              ("-", valid_starts_neg, valid_stops_neg)]:
+        codon_index[strand] = {start: CodonIndex(sequences, [start]) for start in valid_starts}
+        codon_index[strand]["stop"] = CodonIndex(sequences, valid_stops)
+
+    return codon_index
+
+
+def count_candidates_on_positive_strand(sequence, label, codon_index, **kwargs):
+    # type: (Seq, Label, Dict[str, Dict[str, CodonIndex]], Dict[str, Any]) -> Union[None, Dict[str, int]]
     max_upstream_length_nt = get_value(kwargs, "max_upstream_length_nt", None)
     max_downstream_length_nt = get_value(kwargs, "max_downstream_length_nt", None)
 
     stats = initialize_stats()
 
+    seqname = label.seqname()
     pos_5prime = label.left()
+    frame = pos_5prime % 3
 
     codon = str(sequence[pos_5prime:pos_5prime+3])
     if not is_valid_start(codon, "+"):
         return None
 
     # at position
-    stats["{}".format(
-        str(sequence[pos_5prime:pos_5prime+3]).lower()
-    )] = 1
-
-    num_upstream_until_lorf = 0
-    stop_counting = False
-    # upstream
-    curr_pos = pos_5prime - 3
-    while curr_pos >= 0:
-        if max_upstream_length_nt is not None:
-            if pos_5prime - curr_pos + 1 > max_upstream_length_nt:
-                stop_counting = True
-
-        codon = str(sequence[curr_pos:curr_pos+3])
-        if is_valid_stop(codon, "+"):
-            break
-
-        if not stop_counting and is_valid_start(codon, "+"):
-            stats["upstream"] += 1
-            stats["upstream-{}".format(codon.lower())] += 1
-
-            num_upstream_until_lorf += 1
+    stats["{}".format(codon.lower())] = 1
 
-        curr_pos -= 3
-
-    stats["num-upstream-until-lorf"] = num_upstream_until_lorf
+    # upstream: until the closest stop codon
+    stops = codon_index["+"]["stop"].positions_in_range(seqname, frame, 0, pos_5prime - 3)
+    upstream_begin = stops[-1] + 3 if len(stops) > 0 else 0
+    if max_upstream_length_nt is not None:
+        upstream_begin = max(upstream_begin, pos_5prime + 1 - max_upstream_length_nt)
 
     # downstream
-    curr_pos = pos_5prime + 3
-    while curr_pos <= label.right() - 3:
-        if max_downstream_length_nt is not None:
-            if curr_pos - pos_5prime + 1 > max_downstream_length_nt:
-                break
+    downstream_end = label.right() - 3
+    if max_downstream_length_nt is not None:
+        downstream_end = min(downstream_end, pos_5prime + max_downstream_length_nt - 1)
+
+    for start in valid_starts_pos:
+        num_upstream = len(codon_index["+"][start].positions_in_range(
+            seqname, frame, upstream_begin, pos_5prime - 3
+        ))
+        stats["upstream"] += num_upstream
+        stats["upstream-{}".format(start.lower())] += num_upstream
 
-        codon = str(sequence[curr_pos:curr_pos+3])
-        if is_valid_start(codon, "+"):
-            stats["downstream"] += 1
-            stats["downstream-{}".format(codon.lower())] += 1
+        num_downstream = len(codon_index["+"][start].positions_in_range(
+            seqname, frame, pos_5prime + 3, downstream_end
+        ))
+        stats["downstream"] += num_downstream
+        stats["downstream-{}".format(start.lower())] += num_downstream
 
-        curr_pos += 3
+    stats["num-upstream-until-lorf"] = stats["upstream"]
 
     return stats
 
 
-def count_candidates_on_negative_strand(sequence, label, **kwargs):
-    # type: (Seq, Label, Dict[str, Any]) -> Union[None, Dict[str, int]]
+def count_candidates_on_negative_strand(sequence, label, codon_index, **kwargs):
+    # type: (Seq, Label, Dict[str, Dict[str, CodonIndex]], Dict[str, Any]) -> Union[None, Dict[str, int]]
     max_upstream_length_nt = get_value(kwargs, "max_upstream_length_nt", None)
     max_downstream_length_nt = get_value(kwargs, "max_downstream_length_nt", None)
 
     stats = initialize_stats()
 
-    pos_5prime = label.right()
+    conversion = {
+        "CAT": "ATG",
+        "CAA": "TTG",
+        "CAC": "GTG"
+    }
 
-    def convert(element):
-        conversion = {
-            "CAT": "ATG",
-            "CAA": "TTG",
-            "CAC": "GTG"
-        }
+    seqname = label.seqname()
+    pos_5prime = label.right()
 
-        return conversion[str(element)]
+    # codons are indexed by the position of their leftmost nucleotide
+    pos_codon = pos_5prime - 2
+    frame = pos_codon % 3
 
     codon = str(sequence[pos_5prime-2:pos_5prime+1])
     if not is_valid_start(codon, "-"):
         return None
 
     # at position
-    stats["{}".format(
-        convert(str(sequence[pos_5prime-2:pos_5prime+1])).lower()
-    )] = 1
-
-    num_upstream_until_lorf = 0
-    stop_counting = False
-
-    # upstream
-    curr_pos = pos_5prime + 3
-    while curr_pos < len(sequence):
-        if max_upstream_length_nt is not None:
-            if curr_pos - pos_5prime + 1 > max_upstream_length_nt:
-                stop_counting = True
+    stats["{}".format(conversion[codon].lower())] = 1
 
-        codon = str(sequence[curr_pos-2:curr_pos + 1])
-        if is_valid_stop(codon, "-"):
-            break
-        if not stop_counting and is_valid_start(codon, "0"):
-            stats["upstream"] += 1
-            stats["upstream-{}".format(convert(codon).lower())] += 1
-
-            num_upstream_until_lorf += 1
-
-        curr_pos += 3
-
-    stats["num-upstream-until-lorf"] = num_upstream_until_lorf
+    # upstream: until the closest stop codon
+    stops = codon_index["-"]["stop"].positions_in_range(seqname, frame, pos_codon + 3, len(sequence))
+    upstream_end = stops[0] - 3 if len(stops) > 0 else len(sequence)
+    if max_upstream_length_nt is not None:
+        upstream_end = min(upstream_end, pos_codon + max_upstream_length_nt - 1)
 
     # downstream
-    curr_pos = pos_5prime - 3
-    while curr_pos > label.left()+2:
-        if max_downstream_length_nt is not None:
-            if pos_5prime - curr_pos + 1 > max_downstream_length_nt:
-                break
+    downstream_begin = label.left() + 1
+    if max_downstream_length_nt is not None:
+        downstream_begin = max(downstream_begin, pos_codon + 1 - max_downstream_length_nt)
 
-        codon = str(sequence[curr_pos-2:curr_pos+1])
-        if is_valid_start(codon, "-"):
-            stats["downstream"] += 1
-            stats["downstream-{}".format(convert(codon).lower())] += 1
+    for start in valid_starts_neg:
+        num_upstream = len(codon_index["-"][start].positions_in_range(
+            seqname, frame, pos_codon + 3, upstream_end
+        ))
+        stats["upstream"] += num_upstream
+        stats["upstream-{}".format(conversion[start].lower())] += num_upstream
 
-        curr_pos -= 3
+        num_downstream = len(codon_index["-"][start].positions_in_range(
+            seqname, frame, downstream_begin, pos_codon - 3
+        ))
+        stats["downstream"] += num_downstream
+        stats["downstream-{}".format(conversion[start].lower())] += num_downstream
+
+    stats["num-upstream-until-lorf"] = stats["upstream"]
 
     return stats
 
@@ -230,6 +214,8 @@ def count_candidates_per_gene(sequences, labels, **kwargs):
 
     list_stats = list()
 
+    codon_index = build_codon_index(sequences)
+
     for label in labels:
         try:
             sequence = sequences[label.seqname()]
@@ -238,9 +224,9 @@ def count_candidates_per_gene(sequences, labels, **kwargs):
             continue
 
         if label.strand() == "+":
-            stats = count_candidates_on_positive_strand(sequence, label, **kwargs)
+            stats = count_candidates_on_positive_strand(sequence, label, codon_index, **kwargs)
         else:
-            stats = count_candidates_on_negative_strand(sequence, label, **kwargs)
+            stats = count_candidates_on_negative_strand(sequence, label, codon_index, **kwargs)
 
         if stats is not None:
             list_stats.append(stats)
@@ -11,6 +11,7 @@ import sbsp_general.data
 import sbsp_io.sequences
 from sbsp_alg.phylogeny import global_alignment_aa_with_gap, k2p_distance
 from sbsp_general.general import get_value, except_if_not_in_set
+from sbsp_general.sequence_transforms import add_gaps_to_nt
 from sbsp_io.general import mkdir_p
 from sbsp_general import Environment
 from sbsp_alg.gene_distances import *
@@ -96,25 +97,7 @@ def add_gaps_to_nt_based_on_aa(seq_nt, seq_aa_with_gaps):
         raise ValueError("Number of nucleotides ({}) should be 3 times the number of amino acids ({})".format(
             len(seq_nt), num_aa))
 
-    seq_nt_with_gaps = ""
-
-    pos_in_nt = 0
-    pos_in_aa_with_gaps = 0
-
-    while pos_in_aa_with_gaps < len(seq_aa_with_gaps):
-
-        curr_aa = seq_aa_with_gaps[pos_in_aa_with_gaps]
-
-        # if gap
-        if curr_aa == "-":
-            seq_nt_with_gaps += "---"       # 3 nt gaps = 1 aa gap
-        else:
-            seq_nt_with_gaps += seq_nt[pos_in_nt:pos_in_nt+3]       # add next 3 nucleotides
-            pos_in_nt += 3
-
-        pos_in_aa_with_gaps += 1
-
-    return seq_nt_with_gaps
+    return add_gaps_to_nt(seq_nt, seq_aa_with_gaps)
 
 def df_add_labeled_sequences(env, df, **kwargs):
     # type: (Dict, pd.DataFrame, Dict[str, Any]) -> pd.DataFrame
@@ -7,6 +7,7 @@ import numpy as np
 
 from sbsp_general import Environment
 from sbsp_general.general import get_value
+from sbsp_general.sequence_transforms import add_gaps_to_nt
 import sbsp_general.labels
 from sbsp_io.general import read_rows_to_list
 from sbsp_options.sbsp import SBSPOptions
@@ -15,6 +16,7 @@ import pandas as pd
 import copy
 import sbsp_ml.msa_features
 from sbsp_container.msa import MSAType
+from sbsp_alg.phylogeny import LazyDistanceMatrix, k2p_distance
 
 import logging
 
@@ -128,25 +130,7 @@ def add_gaps_to_nt_based_on_aa(seq_nt, seq_aa_with_gaps):
         raise ValueError("Number of nucleotides ({}) should be 3 times the number of amino acids ({})".format(
             len(seq_nt), num_aa))
 
-    seq_nt_with_gaps = ""
-
-    pos_in_nt = 0
-    pos_in_aa_with_gaps = 0
-
-    while pos_in_aa_with_gaps < len(seq_aa_with_gaps):
-
-        curr_aa = seq_aa_with_gaps[pos_in_aa_with_gaps]
-
-        # if gap
-        if curr_aa == "-":
-            seq_nt_with_gaps += "---"  # 3 nt gaps = 1 aa gap
-        else:
-            seq_nt_with_gaps += seq_nt[pos_in_nt:pos_in_nt + 3]  # add next 3 nucleotides
-            pos_in_nt += 3
-
-        pos_in_aa_with_gaps += 1
-
-    return seq_nt_with_gaps
+    return add_gaps_to_nt(seq_nt, seq_aa_with_gaps)
 
 
 def convert_using_marked(aa_alignment, marks):
@@ -1411,29 +1395,30 @@ def convert_msa_from_aa_to_nt(alignments_aa, list_sequences_nt):
 def compute_kimura_matrix(list_sequences_aligned_nt):
     # type: (List[str]) -> np.ndarray
 
-    from sbsp_alg.phylogeny import k2p_distance
-    num_sequences = len(list_sequences_aligned_nt)
+    from sbsp_alg.phylogeny import k2p_distance_matrix
 
-    output = np.zeros((num_sequences, num_sequences), dtype=float)
+    # diagonal is zero, and matrix is symmetric. Pairs that are too divergent get 100
+    return k2p_distance_matrix(list_sequences_aligned_nt, value_on_error=100)
 
-    # compute pairwise kimura
-    # diagonal is zero, and matrix is symmetric (I think :))
 
-    for i in range(1, num_sequences):
-        for j in range(i):
-            try:
-                val = k2p_distance(list_sequences_aligned_nt[i], list_sequences_aligned_nt[j])
-            except ValueError:
-                val = 100
+def k2p_distance_or_100(seq_a, seq_b):
+    # type: (str, str) -> float
+
+    try:
+        return k2p_distance(seq_a, seq_b)
+    except ValueError:
+        return 100
 
-            output[i, j] = val
-            output[j, i] = val
 
-    return output
+def compute_kimura_matrix_lazy(list_sequences_aligned_nt, cache=None):
+    # type: (List[str], Dict[Tuple[str, str], float]) -> LazyDistanceMatrix
+    """Same values as compute_kimura_matrix, but entries are only computed when accessed"""
+
+    return LazyDistanceMatrix(list_sequences_aligned_nt, k2p_distance_or_100, cache=cache)
 
 
 def get_indices_after_filtering_random(edge_mat, min_range, max_range):
-    # type: (np.ndarray, Union[float, None], Union[float, None]) -> List[int]
+    # type: (Union[np.ndarray, LazyDistanceMatrix], Union[float, None], Union[float, None]) -> List[int]
 
     rows, cols = edge_mat.shape
 
@@ -1458,11 +1443,11 @@ def get_indices_after_filtering_random(edge_mat, min_range, max_range):
 
             remove = False
             if min_range is not None:
-                if edge_mat[i][j] < min_range:
+                if edge_mat[i, j] < min_range:
                     remove = True
 
             if max_range is not None:
-                if edge_mat[i][j] > max_range:
+                if edge_mat[i, j] > max_range:
                     remove = True
 
             if remove:
@@ -1475,7 +1460,7 @@ def get_indices_after_filtering_random(edge_mat, min_range, max_range):
 
 
 def get_indices_after_filtering(edge_mat, min_range=None, max_range=None, strategy="random"):
-    # type: (np.ndarray, Union[float, None], Union[float, None], str) -> List[int]
+    # type: (Union[np.ndarray, LazyDistanceMatrix], Union[float, None], Union[float, None], str) -> List[int]
 
     from sbsp_general.general import except_if_not_in_set
 
@@ -1488,12 +1473,23 @@ def get_indices_after_filtering(edge_mat, min_range=None, max_range=None, strate
         return get_indices_after_filtering_random(edge_mat, min_range, max_range)
 
 
-def filter_by_pairwise_kimura_from_msa(list_sequences_aligned_nt, msa_options):
-    # type: (List[str], SBSPOptions) -> Tuple(List[str], List[int])
+def filter_by_pairwise_kimura_from_msa(list_sequences_aligned_nt, msa_options, **kwargs):
+    # type: (List[str], SBSPOptions, Dict[str, Any]) -> Tuple(List[str], List[int])
+    """
+    :param list_sequences_aligned_nt: aligned nucleotide sequences (query first)
+    :param msa_options:
+    :param kwargs:
+        - kimura_cache: dictionary of previously computed distances (by sequence content), updated
+        in place. Share it across MSA/filter iterations to avoid recomputing distances.
+    :return: remaining sequences, and their indices
+    """
+
+    kimura_cache = get_value(kwargs, "kimura_cache", None)
 
     output = list()
 
-    kimura_mat = compute_kimura_matrix(list_sequences_aligned_nt)
+    # the filter only looks at a couple of neighbors per sequence: compute distances on demand
+    kimura_mat = compute_kimura_matrix_lazy(list_sequences_aligned_nt, cache=kimura_cache)
 
     min_val = 0.001
     max_val = 0.4
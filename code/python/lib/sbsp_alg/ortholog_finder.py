@@ -1,10 +1,12 @@
 import os
 import logging
 import re
+import functools
 
 import numpy as np
 from typing import *
 
+from Bio import SeqIO
 from Bio.Blast import NCBIXML
 from Bio.Blast.Applications import NcbiblastpCommandline
 from Bio.Blast.Record import Alignment, HSP
@@ -15,9 +17,12 @@ from tqdm import tqdm
 from sbsp_alg.feature_computation import add_gaps_to_nt_based_on_aa
 from sbsp_alg.phylogeny import k2p_distance, global_alignment_aa_with_gap
 from sbsp_container.genome_list import GenomeInfoList, GenomeInfo
+from sbsp_container.target_store import TargetStore, TargetStoreWriter
 from sbsp_general import Environment
 from sbsp_general.blast import run_blast, convert_blast_output_to_csv, create_blast_database, run_blast_alignment
 from sbsp_general.general import get_value
+from sbsp_general.sequence_transforms import add_gaps_to_nt
+from sbsp_general.sequences import CodonIndex
 from sbsp_general.labels import Labels, Label, create_gene_key_from_label
 from sbsp_io.general import mkdir_p
 from sbsp_io.labels import read_labels_from_file
@@ -97,42 +102,141 @@ def pack_fasta_header(label, gi, **kwargs):
     ) + create_tags_from_dict(**kwargs)
 
 
-def unpack_fasta_header(header):
-    # type: (str) -> Dict[str, Any]
+class FastaHeaderInfo:
+    """Information packed in a FASTA definition line (see pack_fasta_header). Supports dictionary-style
+    access, so it can be used wherever the unpacked dictionary of fields is expected."""
+
+    __slots__ = ["accession", "genome", "left", "right", "strand", "offset", "lorf_nt",
+                 "upstream_left", "upstream_right", "upstream_strand", "_extra"]
+
+    _fields = frozenset(__slots__[:-1])
+
+    def __init__(self, **kwargs):
+        # type: (Dict[str, Any]) -> None
+        self._extra = None  # type: Union[Dict[str, Any], None]
+        for k, v in kwargs.items():
+            self[k] = v
+
+    def __getitem__(self, key):
+        # type: (str) -> Any
+        if key in FastaHeaderInfo._fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        # type: (str, Any) -> None
+        if key in FastaHeaderInfo._fields:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = dict()
+            self._extra[key] = value
+
+    def __contains__(self, key):
+        # type: (str) -> bool
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        # type: (str, Any) -> Any
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
-    fields = {}
+    def keys(self):
+        # type: () -> List[str]
+        keys = [k for k in self.__slots__[:-1] if hasattr(self, k)]
+        if self._extra is not None:
+            keys += list(self._extra.keys())
+        return keys
 
-    def get_key_value_from_definition_line(key, l_defline):
-        m = re.match(".*(?:^|;)" + str(key) + "=([^;]*)", l_defline)
+    def to_dict(self):
+        # type: () -> Dict[str, Any]
+        return {k: self[k] for k in self.keys()}
 
-        if m:
-            return m.group(1)
 
-        raise ValueError("Key " + str(key) + " not in definition line")
+_FASTA_HEADER_FIELD = re.compile(r"([^;=]+)=([^;]*)")
+
+_FASTA_HEADER_TYPES = {
+    "left": int,
+    "right": int,
+    "gc": float,
+    "offset": int,
+    "upstream_left": int,
+    "upstream_right": int
+}
+
+
+def unpack_fasta_header(header):
+    # type: (str) -> FastaHeaderInfo
+    """Decode a definition line created by pack_fasta_header, in a single pass over the line"""
 
     # remove first accession
     header = header.strip().split(maxsplit=1)[1]
 
-    # get all keys in string
-    keys = re.findall(r"([^;=]+)=", header)
+    info = FastaHeaderInfo()
+
+    # if a key appears more than once, its last value is kept
+    for key, value in _FASTA_HEADER_FIELD.findall(header):
+        if key in _FASTA_HEADER_TYPES:
+            value = _FASTA_HEADER_TYPES[key](value)
+
+        info[key] = value
+
+    return info
 
-    type_mapper = {
-        "left": int,
-        "right": int,
-        "gc": float,
-        "offset": int,
-        "upstream_left": int,
-        "upstream_right": int
-    }
 
-    # for each key, get value
-    for k in keys:
-        fields[k] = get_key_value_from_definition_line(k, header)
+@functools.lru_cache(maxsize=4096)
+def unpack_fasta_header_cached(header):
+    # type: (str) -> FastaHeaderInfo
+    """Memoized unpack_fasta_header: the same target (and query) deflines are decoded repeatedly within a
+    run (e.g. by the quick filter and then by the main loop). The returned object is shared: do not modify it."""
+    return unpack_fasta_header(header)
 
-        if k in type_mapper.keys():
-            fields[k] = type_mapper[k](fields[k])
 
-    return fields
+def get_target_info(header, target_store=None):
+    # type: (str, Union[TargetStore, None]) -> Dict[str, Any]
+    """Get target information from its definition line, using the target store when the
+    line holds a store ID (otherwise, the information is unpacked from the line itself)"""
+
+    if target_store is not None:
+        sid = TargetStore.get_id_from_header(header)
+        if sid is not None:
+            return target_store[sid]
+
+    return unpack_fasta_header_cached(header)
+
+
+def build_target_store_from_fasta(pf_fasta, pf_fasta_short, pf_db):
+    # type: (str, str, str) -> int
+    """
+    Move the information packed in the definition lines of pf_fasta (see pack_fasta_header) into a
+    target store for database pf_db, and write the sequences with short (ID-only) definition lines
+    to pf_fasta_short. The latter should be used to build the blast database.
+    :return: number of sequences written
+    """
+
+    num_sequences = 0
+    with TargetStoreWriter(pf_db) as writer, open(pf_fasta_short, "w") as f_short:
+        for record in SeqIO.parse(pf_fasta, "fasta"):
+            info = unpack_fasta_header(record.description)
+            sid = writer.add(info)
+
+            f_short.write(">{}\n{}\n".format(TargetStore.create_header(info["accession"], sid), record.seq))
+            num_sequences += 1
+
+    return num_sequences
 
 
 def select_representative_hsp(alignment, hsp_criteria):
@@ -159,23 +263,17 @@ def map_aligned_aa_to_aligned_nt(q_aligned_seq_aa, original_q_nt, q_start_aa, q_
             len(original_q_nt), (q_end_aa - q_start_aa + 1) * 3
         ))
 
-    output = Seq("")
-    pos_nt_no_gaps = offset_nt + q_start_aa * 3
-    max_pos_nt_no_gaps = offset_nt + (q_end_aa + 1) * 3
-
-    for pos_aa in range(min(200, len(q_aligned_seq_aa))):
-        curr_aa = q_aligned_seq_aa[pos_aa]
-
-        if curr_aa == "-":
-            output += "---"
-        else:
-            output += original_q_nt[pos_nt_no_gaps:pos_nt_no_gaps + 3]
-            pos_nt_no_gaps += 3
-
-        if pos_nt_no_gaps >= max_pos_nt_no_gaps:
-            break
+    # only the first 200 columns, up to the amino acid at q_end_aa
+    q_aligned_seq_aa = str(q_aligned_seq_aa[:200])
+    num_aa = q_end_aa - q_start_aa + 1
+    if num_aa <= 0:
+        q_aligned_seq_aa = q_aligned_seq_aa[:1]
+    else:
+        positions_aa = np.flatnonzero(np.frombuffer(q_aligned_seq_aa.encode("ascii"), dtype=np.uint8) != ord("-"))
+        if len(positions_aa) >= num_aa:
+            q_aligned_seq_aa = q_aligned_seq_aa[:positions_aa[num_aa - 1] + 1]
 
-    return output
+    return Seq(add_gaps_to_nt(original_q_nt, q_aligned_seq_aa, start_nt=offset_nt + q_start_aa * 3))
 
 
 def compute_distance_based_on_local_alignment(query_info, target_info, hsp, **kwargs):
@@ -489,41 +587,57 @@ def get_pf_labels_for_genome(env, gi, **kwargs):
     return os.path.join(env['pd-data'], gi.name, fn_labels)
 
 
-def get_lorf(label, sequences):
-    # type: (Label, Dict[str, Seq]) -> Seq
+def build_lorf_index(sequences):
+    # type: (Dict[str, Seq]) -> Dict[str, CodonIndex]
+    """Index of start and stop codons on each strand of a genome, used by get_lorf"""
+    return {
+        "start+": CodonIndex(sequences, valid_starts_pos),
+        "start-": CodonIndex(sequences, valid_starts_neg),
+        "stop+": CodonIndex(sequences, valid_stops_pos),
+        "stop-": CodonIndex(sequences, valid_stops_neg),
+    }
 
-    if label.strand() == "+":
 
-        curr_pos = label.left()
-        pos_lorf = curr_pos
+def get_lorf(label, sequences, lorf_index=None):
+    # type: (Label, Dict[str, Seq], Union[Dict[str, CodonIndex], None]) -> Seq
+    """
+    Returns the longest ORF of a gene: from the furthest start codon upstream of (and in frame with) its 5'
+    end, without crossing a stop codon.
+    :param lorf_index: start and stop codons of the genome (see build_lorf_index). If not set, one is
+    built for the gene's sequence.
+    """
 
-        while curr_pos >= 0:
-            codon = sequences[label.seqname()][curr_pos:curr_pos + 3]._data
-            if is_valid_start(codon, label.strand()):
-                pos_lorf = curr_pos
-            if is_valid_stop(codon, label.strand()):
-                break
+    seqname = label.seqname()
+    if lorf_index is None:
+        lorf_index = build_lorf_index({seqname: sequences[seqname]})
 
-            curr_pos -= 3
+    if label.strand() == "+":
 
-        lorf_seq = sequences[label.seqname()][pos_lorf:label.right() + 1]
+        pos_5prime = label.left()
+        frame = pos_5prime % 3
 
-    else:
+        # first start after the closest upstream stop
+        stops = lorf_index["stop+"].positions_in_range(seqname, frame, 0, pos_5prime)
+        begin = stops[-1] + 3 if len(stops) > 0 else 0
+        starts = lorf_index["start+"].positions_in_range(seqname, frame, begin, pos_5prime)
+        pos_lorf = int(starts[0]) if len(starts) > 0 else pos_5prime
 
-        curr_pos = label.right()
-        pos_lorf = curr_pos
-        seq_len = len(sequences[label.seqname()])
+        lorf_seq = sequences[seqname][pos_lorf:label.right() + 1]
 
-        while curr_pos < seq_len:
-            codon = sequences[label.seqname()][curr_pos - 2:curr_pos + 1]._data
-            if is_valid_start(codon, label.strand()):
-                pos_lorf = curr_pos
-            if is_valid_stop(codon, label.strand()):
-                break
+    else:
 
-            curr_pos += 3
+        # positions of codons on the negative strand are those of their leftmost nucleotide
+        pos_5prime = label.right() - 2
+        frame = pos_5prime % 3
+        seq_len = len(sequences[seqname])
 
-        lorf_seq = sequences[label.seqname()][label.left():pos_lorf + 1]
+        # last start before the closest upstream stop
+        stops = lorf_index["stop-"].positions_in_range(seqname, frame, pos_5prime, seq_len)
+        end = stops[0] - 3 if len(stops) > 0 else seq_len
+        starts = lorf_index["start-"].positions_in_range(seqname, frame, pos_5prime, end)
+        pos_lorf = int(starts[-1]) + 2 if len(starts) > 0 else label.right()
+
+        lorf_seq = sequences[seqname][label.left():pos_lorf + 1]
 
     return lorf_seq
 
@@ -532,9 +646,10 @@ def extract_labeled_sequence(label, sequences, **kwargs):
     # type: (Label, Dict[str, Seq], Dict[str, Any]) -> Seq
     reverse_complement = get_value(kwargs, "reverse_complement", False)
     lorf = get_value(kwargs, "lorf", False)
+    lorf_index = get_value(kwargs, "lorf_index", None)
 
     if lorf:
-        frag = get_lorf(label, sequences)
+        frag = get_lorf(label, sequences, lorf_index)
     else:
         frag = sequences[label.seqname()][label.left():label.right() + 1]
 
@@ -596,6 +711,10 @@ def extract_labeled_sequences(sequences, labels, **kwargs):
 
     gene_key_to_upstream_label = get_upstream_label_per_label(labels)
 
+    # find LORFs of all genes from one index of the genome's start/stop codons
+    if get_value(kwargs, "lorf_index", None) is None:
+        kwargs["lorf_index"] = build_lorf_index(sequences)
+
     for i, label in enumerate(labels):
         labeled_sequence = extract_labeled_sequence(label, sequences, **kwargs)
         lorf_nt = extract_labeled_sequence(label, sequences, lorf=True, **kwargs)
@@ -709,8 +828,9 @@ def extract_labeled_sequences_for_genomes(env, gil, pf_output, **kwargs):
 
 
 def run_blast_on_sequence_file(env, pf_q_aa, pf_db, pf_blast_output, **kwargs):
-    # type: (Environment, str, str, str, Dict[str, Any]) -> None
-    run_blast_alignment(pf_q_aa, pf_db, pf_blast_output, use_diamond=True, **kwargs)
+    # type: (Environment, str, str, str, Dict[str, Any]) -> int
+    """Run diamond, and return its peak memory (bytes)"""
+    return run_blast_alignment(pf_q_aa, pf_db, pf_blast_output, use_diamond=True, **kwargs)
 
 
 def get_orthologs_from_files(env, pf_q_list, pf_t_list, pf_output, **kwargs):
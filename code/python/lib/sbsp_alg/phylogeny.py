@@ -4,6 +4,7 @@ from Bio import pairwise2
 from scipy.spatial.distance import squareform
 from scipy.cluster.hierarchy import linkage
 import operator
+from typing import *
 
 from sbsp_general.general import get_value
 
@@ -223,52 +224,71 @@ def compute_serial_matrix(dist_mat, method="average"):
 
 
 
-def k2p_distance(seq_a, seq_b, **kwargs):
-    # type: (str, str) -> float
+# Classes of aligned nucleotide pairs for Kimura-2P, indexed by the byte values of both letters
+_K2P_OTHER = 0              # counted in ungapped length only (identical letters, ambiguous letters, etc...)
+_K2P_TRANSITION = 1
+_K2P_TRANSVERSION = 2
+_K2P_GAP = 3                # ignored
 
-    if len(seq_a) != len(seq_b):
-        raise ValueError("Sequence sizes are not the same: {} != {}".format(len(seq_a), len(seq_b)))
 
+def _create_k2p_pair_class_table():
+    # type: () -> np.ndarray
 
-    kimura_on_3rd = get_value(kwargs, "kimura_on_3rd", False)
+    table = np.full((256, 256), _K2P_OTHER, dtype=np.uint8)
 
-    from math import log, sqrt
+    for pair in ["AG", "GA", "CT", "TC"]:
+        table[ord(pair[0]), ord(pair[1])] = _K2P_TRANSITION
+
+    for pair in ["AC", "CA", "AT", "TA", "GC", "CG", "GT", "TG"]:
+        table[ord(pair[0]), ord(pair[1])] = _K2P_TRANSVERSION
 
-    alignment_length = len(seq_a)
+    table[ord("-"), :] = _K2P_GAP
+    table[:, ord("-")] = _K2P_GAP
 
-    distance = 0
+    return table
 
-    # compute transversions and transitions
-    transitions = {"AG", "GA", "CT", "TC"}
-    transversions = {"AC", "CA", "AT", "TA",
-                     "GC", "CG", "GT", "TG"}
 
-    ts_count = 0            # transitions
-    tv_count = 0            # transversions
+_K2P_PAIR_CLASS = _create_k2p_pair_class_table()
 
-    ungapped_length = 0
 
-    begin = 0
-    end = alignment_length
-    step = 1
+def sequence_to_bytes(seq):
+    # type: (Union[str, Any, np.ndarray]) -> np.ndarray
+    """Returns a (read-only) uint8 view of a sequence. Arrays are returned as is."""
+
+    if isinstance(seq, np.ndarray):
+        return seq
+
+    # non-ascii letters become '?', so positions are preserved
+    return np.frombuffer(str(seq).encode("ascii", "replace"), dtype=np.uint8)
+
+
+def k2p_counts(seq_a, seqs_b, kimura_on_3rd=False):
+    # type: (np.ndarray, np.ndarray, bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+    Count transitions, transversions and ungapped positions between one sequence and many
+    :param seq_a: uint8 array of length L
+    :param seqs_b: uint8 matrix of shape (N, L)
+    :param kimura_on_3rd: only consider 3rd codon positions
+    :return: arrays (of length N) of transition counts, transversion counts, and ungapped lengths
+    """
 
     if kimura_on_3rd:
-        begin = 2
-        step = 3
+        seq_a = seq_a[2::3]
+        seqs_b = seqs_b[:, 2::3]
 
-    for i in range(begin, end, step):
+    classes = _K2P_PAIR_CLASS[seq_a[np.newaxis, :], seqs_b]
 
-        # ignore gaps
-        if seq_a[i] == "-" or seq_b[i] == "-":
-            continue
+    ts_count = np.count_nonzero(classes == _K2P_TRANSITION, axis=1)
+    tv_count = np.count_nonzero(classes == _K2P_TRANSVERSION, axis=1)
+    ungapped_length = np.count_nonzero(classes != _K2P_GAP, axis=1)
 
-        ungapped_length += 1
-        combined = seq_a[i] + seq_b[i]
+    return ts_count, tv_count, ungapped_length
 
-        if combined in transitions:
-            ts_count += 1
-        elif combined in transversions:
-            tv_count += 1
+
+def k2p_distance_from_counts(ts_count, tv_count, ungapped_length):
+    # type: (int, int, int) -> float
+
+    from math import log, sqrt
 
     if ungapped_length == 0:
         return 0
@@ -282,3 +302,122 @@ def k2p_distance(seq_a, seq_b, **kwargs):
         raise ValueError("Can't take log of negative value")
 
     return distance
+
+
+def _k2p_distances_from_bytes(seq_a, seqs_b, kimura_on_3rd, value_on_error):
+    # type: (np.ndarray, np.ndarray, bool, float) -> List[float]
+
+    output = list()
+    for ts, tv, ungapped in zip(*[c.tolist() for c in k2p_counts(seq_a, seqs_b, kimura_on_3rd)]):
+        try:
+            output.append(k2p_distance_from_counts(ts, tv, ungapped))
+        except ValueError:
+            output.append(value_on_error)
+
+    return output
+
+
+def k2p_distance(seq_a, seq_b, **kwargs):
+    # type: (str, str) -> float
+
+    if len(seq_a) != len(seq_b):
+        raise ValueError("Sequence sizes are not the same: {} != {}".format(len(seq_a), len(seq_b)))
+
+    kimura_on_3rd = get_value(kwargs, "kimura_on_3rd", False)
+
+    ts_count, tv_count, ungapped_length = k2p_counts(
+        sequence_to_bytes(seq_a), sequence_to_bytes(seq_b)[np.newaxis, :], kimura_on_3rd
+    )
+
+    return k2p_distance_from_counts(int(ts_count[0]), int(tv_count[0]), int(ungapped_length[0]))
+
+
+def k2p_distance_one_to_many(seq_a, list_seq_b, **kwargs):
+    # type: (str, List[str], Dict[str, Any]) -> np.ndarray
+    """
+    Kimura-2P distances between one sequence and many. Pairs whose distance cannot be
+    computed (different lengths, or too divergent) get value_on_error (default: 100).
+    """
+
+    kimura_on_3rd = get_value(kwargs, "kimura_on_3rd", False)
+    value_on_error = get_value(kwargs, "value_on_error", 100)
+
+    seq_a = sequence_to_bytes(seq_a)
+    list_seq_b = [sequence_to_bytes(s) for s in list_seq_b]
+
+    output = np.full(len(list_seq_b), value_on_error, dtype=float)
+
+    same_length = [i for i, s in enumerate(list_seq_b) if len(s) == len(seq_a)]
+    if len(same_length) > 0:
+        output[same_length] = _k2p_distances_from_bytes(
+            seq_a, np.vstack([list_seq_b[i] for i in same_length]), kimura_on_3rd, value_on_error
+        )
+
+    return output
+
+
+def k2p_distance_matrix(list_sequences, **kwargs):
+    # type: (List[str], Dict[str, Any]) -> np.ndarray
+    """
+    Symmetric matrix of pairwise Kimura-2P distances (e.g. between all sequences of an MSA).
+    Pairs whose distance cannot be computed get value_on_error (default: 100).
+    """
+
+    kimura_on_3rd = get_value(kwargs, "kimura_on_3rd", False)
+    value_on_error = get_value(kwargs, "value_on_error", 100)
+
+    list_sequences = [sequence_to_bytes(s) for s in list_sequences]
+    num_sequences = len(list_sequences)
+
+    output = np.zeros((num_sequences, num_sequences), dtype=float)
+
+    # aligned sequences all have the same length: encode them once as a single matrix
+    all_sequences = None
+    if num_sequences > 0 and len(set(len(s) for s in list_sequences)) == 1:
+        all_sequences = np.vstack(list_sequences)
+
+    for i in range(1, num_sequences):
+        if all_sequences is not None:
+            row = _k2p_distances_from_bytes(all_sequences[i], all_sequences[:i], kimura_on_3rd, value_on_error)
+        else:
+            row = k2p_distance_one_to_many(list_sequences[i], list_sequences[:i], kimura_on_3rd=kimura_on_3rd,
+                                           value_on_error=value_on_error)
+
+        output[i, :i] = row
+        output[:i, i] = row
+
+    return output
+
+
+class LazyDistanceMatrix:
+    """
+    Symmetric distance matrix over a list of sequences, whose entries are only computed when
+    accessed (as edge_mat[i, j]). Distances are cached by sequence content, so a cache shared
+    between matrices (e.g. across MSA/filter iterations) is reused for sequences that did not change.
+    """
+
+    def __init__(self, list_sequences, distance_func, cache=None):
+        # type: (List[str], Callable[[str, str], float], Dict[Tuple[str, str], float]) -> None
+
+        self._sequences = list_sequences
+        self._distance_func = distance_func
+        self._cache = cache if cache is not None else dict()
+
+        self.shape = (len(list_sequences), len(list_sequences))
+        self.num_computed = 0
+
+    def __getitem__(self, key):
+        # type: (Tuple[int, int]) -> float
+        i, j = key
+        if i == j:
+            return 0
+
+        seq_a, seq_b = self._sequences[i], self._sequences[j]
+        if seq_b < seq_a:
+            seq_a, seq_b = seq_b, seq_a
+
+        if (seq_a, seq_b) not in self._cache:
+            self._cache[(seq_a, seq_b)] = self._distance_func(seq_a, seq_b)
+            self.num_computed += 1
+
+        return self._cache[(seq_a, seq_b)]
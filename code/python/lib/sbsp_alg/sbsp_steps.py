@@ -1,9 +1,11 @@
 import copy
+import heapq
+import functools
+import queue
 import random
-import time
+import itertools
 import timeit
-from multiprocessing import Process, Lock
-from random import shuffle
+from multiprocessing import Pool
 
 from Bio.Align import MultipleSeqAlignment
 from Bio.Blast import NCBIXML, Record
@@ -15,17 +17,24 @@ from tqdm import tqdm
 import sbsp_ml
 import sbsp_ml.msa_features
 from sbsp_alg.msa import should_count_in_neighbor, filter_by_pairwise_kimura_from_msa
-from sbsp_alg.shelf import run_msa_on_sequences
+from sbsp_alg.shelf import run_msa_on_sequences, get_msa_cache_stats
 from sbsp_general.labels import Label, Coordinates
-from sbsp_container.msa import MSAType, MSASinglePointMarker
+from sbsp_container.msa import MSAType, MSAArrayType, MSASinglePointMarker
+from sbsp_container.target_store import TargetStore
 from sbsp_general.shelf import append_data_frame_to_csv
 from sbsp_io.general import mkdir_p, remove_p
-from sbsp_general.general import except_if_not_in_set, os_join
+from sbsp_general.general import except_if_not_in_set, os_join, iterate_in_random_order
+from sbsp_general.sequence_transforms import add_gaps_to_nt, mark_start_codons_in_aa
 from sbsp_alg.ortholog_finder import extract_labeled_sequences_for_genomes, \
-    unpack_fasta_header, select_representative_hsp, create_info_for_query_target_pair, \
-    compute_distance_based_on_local_alignment, run_blast_on_sequence_file, is_valid_start
+    unpack_fasta_header, unpack_fasta_header_cached, get_target_info, select_representative_hsp, \
+    create_info_for_query_target_pair, compute_distance_based_on_local_alignment, valid_starts_pos
 from sbsp_alg.sbsp_compute_accuracy import pipeline_step_compute_accuracy, separate_msa_outputs_by_stats, df_print_labels
 from sbsp_general import Environment
+from sbsp_io.blast import read_hits
+from sbsp_io.blast_cache import get_blast_cache
+from sbsp_general.blast import gen_cmd_run_blastp
+from sbsp_general.blast_planner import plan_blast_run, run_blast_with_plan
+from sbsp_io.checkpoint import CheckpointManifest
 from sbsp_io.general import read_rows_to_list
 from sbsp_io.msa_2 import add_true_starts_to_msa_output
 from sbsp_io.sequences import read_fasta_into_hash, write_fasta_hash_to_file
@@ -34,7 +43,7 @@ from sbsp_options.parallelization import ParallelizationOptions
 from sbsp_options.sbsp import SBSPOptions
 from sbsp_options.pipeline_sbsp import PipelineSBSPOptions
 from sbsp_parallelization.pbs import PBS
-from sbsp_pbs_data.mergers import merge_identity
+from sbsp_pbs_data.mergers import merge_csv_files
 from sbsp_pbs_data.splitters import *
 
 logger = logging.getLogger(__name__)
@@ -55,6 +64,12 @@ def duplicate_parallelization_options_with_updated_paths(env, prl_options, **kwa
     return prl_options
 
 
+def get_blast_output_format(sbsp_options):
+    # type: (SBSPOptions) -> str
+    outfmt = sbsp_options.safe_get("blast-output-format")
+    return outfmt if outfmt is not None else "xml"
+
+
 def run_blast_on_sequences(env, q_sequences, pf_t_db, pf_blast_output, sbsp_options, **kwargs):
     # type: (Environment, Dict[str, Seq], str, str, SBSPOptions, Dict[str, Any]) -> None
 
@@ -67,7 +82,26 @@ def run_blast_on_sequences(env, q_sequences, pf_t_db, pf_blast_output, sbsp_opti
     # start clean
     remove_p(pf_blast_output)
 
-    block_size = 0.5
+    outfmt = get_blast_output_format(sbsp_options)
+
+    # reuse output of an earlier run on the same queries and database
+    blast_cache = get_blast_cache(sbsp_options)
+    cache_key = None
+    if blast_cache is not None:
+        # paths and block size don't change the output
+        blast_options = gen_cmd_run_blastp("QUERY", "DB", "OUTPUT", use_diamond=True, outfmt=outfmt, block_size=1)
+        cache_key = blast_cache.key(pf_q_sequences, pf_t_db, blast_options)
+
+        if blast_cache.get(cache_key, outfmt, pf_blast_output):
+            logger.info("Reusing cached blast output")
+            remove_p(pf_q_sequences)
+            return
+
+    # choose block size, index chunks, threads and query shards from available memory
+    memory_limit_gb = sbsp_options.safe_get("blast-memory-limit-gb")
+    plan = plan_blast_run(pf_q_sequences, pf_t_db,
+                          memory_limit=memory_limit_gb * 1024 ** 3 if memory_limit_gb is not None else None,
+                          allow_shards=outfmt == "tabular")
 
     blast_successful = False
     max_attempts = 3
@@ -77,25 +111,31 @@ def run_blast_on_sequences(env, q_sequences, pf_t_db, pf_blast_output, sbsp_opti
         attempt += 1
         try:
             logger.info("Running Diamond Blastp")
-            run_blast_on_sequence_file(env, pf_q_sequences, pf_t_db, pf_blast_output, sbsp_options=sbsp_options,
-                                       block_size=block_size)
+            run_blast_with_plan(plan, pf_q_sequences, pf_t_db, pf_blast_output, outfmt=outfmt)
             blast_successful = True
             break
         except ValueError:
-            block_size = block_size / 2.0
-            logger.info("Blast failed. Trying again with block size {}".format(block_size))
+            # e.g. killed for using more memory than estimated
+            plan = plan_blast_run(pf_q_sequences, pf_t_db, memory_limit=plan.memory_limit / 2.0,
+                                  allow_shards=outfmt == "tabular")
+            logger.info("Blast failed. Trying again with half the memory")
 
     remove_p(pf_q_sequences)
 
     if not blast_successful:
         raise ValueError("Couldn't run blast")
 
+    if blast_cache is not None:
+        blast_cache.put(cache_key, outfmt, pf_blast_output)
+
 
 def quick_filter_alignments(list_alignments, query_info, **kwargs):
     # type: (List, Dict[str, Any]) -> List
     if len(list_alignments) < 2000:
         return list_alignments
 
+    target_store = get_value(kwargs, "target_store", None)
+
     threshold = 0.6
     threshold_int = int(threshold * 10)
     # binary search your way
@@ -112,7 +152,7 @@ def quick_filter_alignments(list_alignments, query_info, **kwargs):
 
         alignment = list_alignments[mid]
 
-        target_info = unpack_fasta_header(alignment.title)
+        target_info = get_target_info(alignment.title, target_store)
         hsp = select_representative_hsp(alignment, "")  # get reference hit for target
 
         # get nucleotide sequence that corresponds to proteins
@@ -146,6 +186,36 @@ def quick_filter_alignments(list_alignments, query_info, **kwargs):
     return list_alignments[:index_closest]
 
 
+# weight of an ortholog that reaches the MSA, relative to a blast hit that is only read and filtered
+MSA_COST_PER_ORTHOLOG = 10
+
+
+def estimate_query_cost(lorf_length, num_hits=1, num_orthologs=0):
+    # type: (int, int, int) -> float
+    """
+    Relative cost of finding a start for one query: every hit is read and compared over the LORF,
+    and the orthologs that remain are aligned.
+    :param lorf_length: length of the query's LORF (nucleotides)
+    :param num_hits: number of blast hits
+    :param num_orthologs: number of targets expected to reach the MSA
+    """
+    return float(lorf_length) * (num_hits + MSA_COST_PER_ORTHOLOG * num_orthologs)
+
+
+def estimate_blast_record_cost(r, sbsp_options, **kwargs):
+    # type: (Record, SBSPOptions, Dict[str, Any]) -> float
+    query_info = unpack_fasta_header_cached(r.query)
+
+    num_hits = len(r.alignments)
+    num_orthologs = len(quick_filter_alignments(r.alignments, query_info, **kwargs))
+
+    max_targets = sbsp_options.safe_get("filter-max-number-orthologs")
+    if max_targets is not None:
+        num_orthologs = min(num_orthologs, max_targets)
+
+    return estimate_query_cost(len(query_info["lorf_nt"]), num_hits, num_orthologs)
+
+
 def create_data_frame_for_msa_search_from_blast_results(r, sbsp_options, **kwargs):
     # type: (Record, SBSPOptions, Dict[str, Any]) -> pd.DataFrame
 
@@ -159,6 +229,9 @@ def create_data_frame_for_msa_search_from_blast_results(r, sbsp_options, **kwarg
     distance_min = sbsp_options.safe_get("distance-min")
     distance_max = sbsp_options.safe_get("distance-max")
     rng = get_value(kwargs, "rng", None)
+    if rng is None:
+        rng = random.Random(sbsp_options.safe_get("random-seed"))
+    target_store = get_value(kwargs, "target_store", None)
     max_targets = sbsp_options.safe_get("filter-max-number-orthologs")
 
     filter_orthologs_with_equal_kimura_to_query = sbsp_options.safe_get("filter-orthologs-with-equal-kimura")
@@ -173,13 +246,11 @@ def create_data_frame_for_msa_search_from_blast_results(r, sbsp_options, **kwarg
     list_entries = list()
     key = "{};{};{};{}".format(query_info["accession"], query_info["left"], query_info["right"], query_info["strand"])
     logger.debug("{}: Reading {} targets from blast".format(key, len(r.alignments)))
-    # shuffled_alignments = [a for a in r.alignments]
     before = len(r.alignments)
-    shuffled_alignments = quick_filter_alignments(r.alignments, query_info, **kwargs)
-    shuffle(shuffled_alignments, random=rng.random)
-    logger.debug("Quick filter: {} -> {}".format(before, len(shuffled_alignments)))
+    candidate_alignments = quick_filter_alignments(r.alignments, query_info, **kwargs)
+    logger.debug("Quick filter: {} -> {}".format(before, len(candidate_alignments)))
 
-    if not fsf and len(shuffled_alignments) == 0:
+    if not fsf and len(candidate_alignments) == 0:
         logger.debug("Query Filtered: Quick filter by BS")
         fsf = True
 
@@ -188,12 +259,15 @@ def create_data_frame_for_msa_search_from_blast_results(r, sbsp_options, **kwarg
     num_analyzed = 0
     acc_lengths = 0
 
-    for alignment in shuffled_alignments:
+    # visit candidates in random order, drawing them one at a time: once enough targets are accepted,
+    # the remaining ones are neither shuffled nor analyzed
+    for alignment in iterate_in_random_order(candidate_alignments, rng):
         if len(list_entries) > max_targets:
-            logger.debug("Reached limit on number of targets: {} from {}".format(max_targets, len(shuffled_alignments)))
+            logger.debug("Reached limit on number of targets: {} from {} (analyzed {})".format(
+                max_targets, len(candidate_alignments), num_analyzed))
             break
 
-        target_info = unpack_fasta_header(alignment.title)
+        target_info = get_target_info(alignment.title, target_store)
         hsp = select_representative_hsp(alignment, "")  # get reference hit for target
 
         # get nucleotide sequence that corresponds to proteins
@@ -268,21 +342,11 @@ def extract_sequences_from_df_for_msa(df):
 
 def convert_gapped_aa_to_gapped_nt(seq_aa, seq_nt_no_gaps):
     # type: (Seq, str) -> Seq
-
-    seq_nt_with_gaps = ""
-    pos_no_gaps = 0
-    for i in range(len(seq_aa)):
-        if seq_aa[i] == "-":
-            seq_nt_with_gaps += "---"
-        else:
-            seq_nt_with_gaps += seq_nt_no_gaps[pos_no_gaps:pos_no_gaps + 3]
-            pos_no_gaps += 3
-
-    return Seq(seq_nt_with_gaps)
+    return Seq(add_gaps_to_nt(seq_nt_no_gaps, seq_aa))
 
 
 def convert_msa_aa_to_nt(msa_t_aa, df):
-    # type: (MSAType, pd.DataFrame) -> MSAType
+    # type: (MSAType, pd.DataFrame) -> MSAArrayType
 
     seq_record_list = list()
     # query sequence
@@ -293,28 +357,19 @@ def convert_msa_aa_to_nt(msa_t_aa, df):
         row = df.iloc[i - 1]  # -1 to account for query as first sequence
         seq_record_list.append(SeqRecord(convert_gapped_aa_to_gapped_nt(msa_t_aa[i].seq, row["t-lorf_nt"])))
 
-    return MSAType(MultipleSeqAlignment(seq_record_list))
+    return MSAArrayType(MultipleSeqAlignment(seq_record_list))
 
 
 def lower_case_non_5prime_in_msa(msa_t_aa, msa_t_nt):
-    # type: (MSAType, MSAType) -> MSAType
+    # type: (MSAType, MSAType) -> MSAArrayType
 
     seq_record_list = list()
 
     for i in range(msa_t_aa.number_of_sequences()):
-
-        new_seq_aa = ""
-        for j_aa in range(msa_t_aa.alignment_length()):
-            j_nt = j_aa * 3
-
-            if is_valid_start(msa_t_nt[i].seq._data[j_nt:j_nt + 3], "+"):
-                new_seq_aa += msa_t_aa[i].seq._data[j_aa].upper()
-            else:
-                new_seq_aa += msa_t_aa[i].seq._data[j_aa].lower()
-
+        new_seq_aa = mark_start_codons_in_aa(msa_t_aa[i].seq, msa_t_nt[i].seq, valid_starts_pos)
         seq_record_list.append(SeqRecord(Seq(new_seq_aa), id=msa_t_aa[i].id))
 
-    return MSAType(MultipleSeqAlignment(seq_record_list))
+    return MSAArrayType(MultipleSeqAlignment(seq_record_list))
 
 
 def construct_msa_from_df(env, df, sbsp_options, **kwargs):
@@ -335,13 +390,32 @@ def construct_msa_from_df(env, df, sbsp_options, **kwargs):
     return msa_t_aa, msa_t_nt
 
 
+def project_msa_on_remaining_sequences(msa_t_aa, msa_t_nt, rows_to_keep):
+    # type: (MSAType, MSAType, List[int]) -> Tuple[MSAType, MSAType]
+    """
+    Derive the alignment of a subset of sequences from an existing alignment (instead of realigning):
+    keep the selected rows, and remove columns left with gaps only.
+    :param rows_to_keep: rows of the MSA to keep (including the query)
+    :return: the projected amino acid and nucleotide MSAs
+    """
+
+    msa_t_aa = msa_t_aa.get_subset(rows_to_keep)
+    num_sequences = msa_t_aa.number_of_sequences()
+
+    columns_aa = [c for c in range(msa_t_aa.alignment_length())
+                  if msa_t_aa.number_of_gaps_in_column(c) < num_sequences]
+    columns_nt = [3 * c + k for c in columns_aa for k in range(3)]
+
+    return msa_t_aa.get_subset(range(num_sequences), columns_aa), msa_t_nt.get_subset(rows_to_keep, columns_nt)
+
+
 def number_of_sequences_with_gap_in_position(msa_t, pos):
     # type: (MSAType, int) -> int
 
     if msa_t.number_of_sequences() == 0:
         return 0
 
-    return sum(1 for i in range(msa_t.number_of_sequences()) if msa_t[i][pos] == "-")
+    return msa_t.number_of_gaps_in_column(pos)
 
 
 def get_position_from_which_to_start_gap_filtering(msa_t):
@@ -351,7 +425,7 @@ def get_position_from_which_to_start_gap_filtering(msa_t):
     first_start_codon_position = None
     passed_go = False
     for i in range(msa_t.alignment_length()):
-        if msa_t[0][i].isupper():
+        if msa_t.is_upper(0, i):
             first_start_codon_position = i
 
         if number_of_sequences_with_gap_in_position(msa_t, i) / float(msa_t.number_of_sequences()) < 0.3:
@@ -366,8 +440,9 @@ def get_position_from_which_to_start_gap_filtering(msa_t):
     return first_start_codon_position
 
 
-def filter_df_based_on_msa(df, msa_t, msa_t_nt, sbsp_options, inplace=False, multiple_filterings=False):
-    # type: (pd.DataFrame, MSAType, MSAType, SBSPOptions, bool, bool) -> pd.DataFrame
+def filter_df_based_on_msa(df, msa_t, msa_t_nt, sbsp_options, inplace=False, multiple_filterings=False,
+                           kimura_cache=None):
+    # type: (pd.DataFrame, MSAType, MSAType, SBSPOptions, bool, bool, Dict[Tuple[str, str], float]) -> pd.DataFrame
 
     if not inplace:
         df = df.copy()
@@ -379,7 +454,8 @@ def filter_df_based_on_msa(df, msa_t, msa_t_nt, sbsp_options, inplace=False, mul
     # pairwise Kimura
     if sbsp_options.safe_get("filter-by-pairwise-kimura-from-msa"):
         _, indices_to_keep = filter_by_pairwise_kimura_from_msa(
-            [msa_t_nt[i].seq._data for i in range(msa_t_nt.number_of_sequences())], sbsp_options
+            [msa_t_nt[i].seq._data for i in range(msa_t_nt.number_of_sequences())], sbsp_options,
+            kimura_cache=kimura_cache
         )
 
         indices_in_msa_to_remove = set(range(msa_t_nt.number_of_sequences())).difference(indices_to_keep)
@@ -404,7 +480,7 @@ def filter_df_based_on_msa(df, msa_t, msa_t_nt, sbsp_options, inplace=False, mul
     for i in range(first_start_codon_position, end_search):
 
         # if chunk of gaps detected in query
-        block_detected = msa_t[0][i:i + gap_width].seq._data.count("-") == gap_width
+        block_detected = msa_t.number_of_gaps_in_region(0, i, i + gap_width) == gap_width
 
         sequences_that_contribute_to_block = list()
 
@@ -412,7 +488,7 @@ def filter_df_based_on_msa(df, msa_t, msa_t_nt, sbsp_options, inplace=False, mul
 
             # find sequences that have no gaps in that region
             for j in range(1, num_sequences_aligned):
-                if msa_t[j][i:i + gap_width].seq._data.count("-") == 0:
+                if msa_t.number_of_gaps_in_region(j, i, i + gap_width) == 0:
                     sequences_that_contribute_to_block.append(j - 1)
 
             # compute fraction of these sequences
@@ -484,28 +560,9 @@ def check_each_column_below_gap_allowance(msa_t, start, end, max_frac_allowed_ga
         raise ValueError(
             "Start of region out of bounds: {} not in [{},{})".format(end, start, msa_t.alignment_length()))
 
-    num_positions_to_analyze = end - start
-
-    curr_pos = start if direction == "downstream" else end - 1
-    total_number_of_computations = 0
-    pos_score = 0
-    num_sequences = msa_t.number_of_sequences()
-
-    for n in range(num_positions_to_analyze):
-
-        if curr_pos is None:
-            raise ValueError("Not enough region to compute score")
-
-        num_gaps_in_pos = sum([1 for k in range(msa_t.number_of_sequences()) if msa_t[k][curr_pos] == "-"])
-
-        frac_gaps_in_pos = float(num_gaps_in_pos) / num_sequences
-
-        if frac_gaps_in_pos > max_frac_allowed_gaps:
-            return False
-
-        curr_pos = get_next_position_in_msa(curr_pos, msa_t, direction, skip_gaps_in_query)
-
-    return True
+    return msa_t.get_index().each_column_below_gap_allowance(
+        start, end, max_frac_allowed_gaps, direction, skip_gaps_in_query
+    )
 
 
 def compute_conservation_in_region(msa_t, start, end, scorer, **kwargs):
@@ -530,32 +587,10 @@ def compute_conservation_in_region(msa_t, start, end, scorer, **kwargs):
         raise ValueError(
             "Start of region out of bounds: {} not in [{},{})".format(end, start, msa_t.alignment_length()))
 
-    num_positions_to_analyze = end - start
-
-    curr_pos = start if direction == "downstream" else end - 1
-    total_number_of_computations = 0
-    pos_score = 0
-    num_sequences = msa_t.number_of_sequences()
-
-    for n in range(num_positions_to_analyze):
-
-        if curr_pos is None:
-            raise ValueError("Not enough region to compute score")
-
-        if score_on_all_pairs:
-            for i in range(num_sequences):
-                element_i = msa_t[i][curr_pos]
-                for j in range(i + 1, num_sequences):
-                    element_j = msa_t[j][curr_pos]
-
-                    pos_score += scorer.score(element_i, element_j)
-                    total_number_of_computations += 1
-        else:
-            for i in range(1, num_sequences):
-                pos_score += scorer.score(msa_t[0][curr_pos], msa_t[i][curr_pos])
-                total_number_of_computations += 1
-
-        curr_pos = get_next_position_in_msa(curr_pos, msa_t, direction, skip_gaps_in_query)
+    # column scores are computed once per alignment, then summed over the window with prefix sums
+    pos_score, total_number_of_computations = msa_t.get_index().conservation_in_window(
+        start, end, scorer, direction, skip_gaps_in_query, score_on_all_pairs
+    )
 
     return pos_score / float(total_number_of_computations)
 
@@ -580,14 +615,14 @@ def get_all_candidates_before_conserved_block(msa_t, sbsp_options, at_least_unti
 
     candidates = list()  # type: List[int]
     passed_column_of_no_gaps = False
+    msa_index = msa_t.get_index()
     for i in range(start, end):
 
         if not passed_column_of_no_gaps:
-            if sum([1 for k in range(msa_t.number_of_sequences()) if
-                    msa_t[k][i] != "-"]) == msa_t.number_of_sequences():
+            if msa_index.column_gaps[i] == 0:
                 passed_column_of_no_gaps = True
 
-        if msa_t[0][i].isupper():
+        if msa_t.is_upper(0, i):
             candidates.append(i)
         elif i >= at_least_until and len(candidates) > 0 and passed_column_of_no_gaps:
             # compute conservation of block upstream of candidate
@@ -638,6 +673,7 @@ def count_number_of_5prime_candidates_at_position(msa_t, curr_pos, sbsp_options)
     i = curr_pos
     num_upper = 0
     q_curr_type = msa_t[0][i]
+    msa_index = msa_t.get_index()
 
     for j in range(msa_t.number_of_sequences()):
 
@@ -674,7 +710,7 @@ def count_number_of_5prime_candidates_at_position(msa_t, curr_pos, sbsp_options)
 
         if sbsp_options.safe_get("search-penalize-no-sequence") is not None:
             if letter_at_i_j == "-":
-                if msa_t[j][0:i].count("-") == i:
+                if msa_index.number_of_gaps_in_row(j, 0, i) == i:
                     num_upper -= sbsp_options.safe_get("search-penalize-no-sequence")
 
     return num_upper
@@ -693,7 +729,7 @@ def find_first_5prime_that_satisfies_5prime_threshold(msa_t, sbsp_options, begin
         if curr_pos is None or curr_pos < 0 or curr_pos >= msa_t.alignment_length():
             break
 
-        if not msa_t[0][curr_pos].isupper():
+        if not msa_t.is_upper(0, curr_pos):
             curr_pos = get_next_position_in_msa(curr_pos, msa_t, direction, skip_gaps_in_query)
             continue
 
@@ -1136,19 +1172,28 @@ def perform_msa_on_df_with_single_query(env, df, sbsp_options, **kwargs):
 
     fsf = False
 
+    # pairwise distances of aligned sequences, reused across iterations for rows whose alignment didn't change
+    kimura_cache = dict()  # type: Dict[Tuple[str, str], float]
+
+    # if set, sequences removed by filters are dropped from the existing MSA rather than realigning
+    project_after_filter = sbsp_options.safe_get("msa-project-after-filter")
+    msa_t_aa, msa_t_nt = None, None
+
     # construct msa and filter (if necessary)
     while True:
-        curr_time = timeit.default_timer()
-        msa_t_aa, msa_t_nt = construct_msa_from_df(env, df, sbsp_options, **kwargs)
-        logger.debug("MSA: Time (min): {}, Support: {}, Key: {}".format(
-            round((timeit.default_timer() - curr_time) / 60.0, 2), len(df), qkey
-        ))
+        if msa_t_aa is None:
+            curr_time = timeit.default_timer()
+            msa_t_aa, msa_t_nt = construct_msa_from_df(env, df, sbsp_options, **kwargs)
+            logger.debug("MSA: Time (min): {}, Support: {}, Key: {}".format(
+                round((timeit.default_timer() - curr_time) / 60.0, 2), len(df), qkey
+            ))
 
         # pairwise kimura filter
         targets_before = len(df)
+        index_before = list(df.index)
 
         curr_time = timeit.default_timer()
-        filter_df_based_on_msa(df, msa_t_aa, msa_t_nt, sbsp_options, inplace=True)
+        filter_df_based_on_msa(df, msa_t_aa, msa_t_nt, sbsp_options, inplace=True, kimura_cache=kimura_cache)
         logger.debug("Filter: Time (min): {}, Support: {}, Key: {}".format(
             round((timeit.default_timer() - curr_time) / 60.0, 2), len(df), qkey
         ))
@@ -1157,6 +1202,14 @@ def perform_msa_on_df_with_single_query(env, df, sbsp_options, **kwargs):
         if targets_before == len(df) or len(df) == 0:
             break
 
+        if project_after_filter:
+            remaining = set(df.index)
+            rows_to_keep = [0] + [i + 1 for i, label in enumerate(index_before) if label in remaining]
+            msa_t_aa, msa_t_nt = project_msa_on_remaining_sequences(msa_t_aa, msa_t_nt, rows_to_keep)
+            logger.debug("MSA: Projected, Support: {}, Key: {}".format(len(df), qkey))
+        else:
+            msa_t_aa, msa_t_nt = None, None
+
     if len(df) > 0:
         logger.debug("Searching for start on {} targets".format(len(df)))
         curr_time = timeit.default_timer()
@@ -1255,139 +1308,296 @@ def find_start_for_query_blast_record(env, r, sbsp_options, **kwargs):
     return df
 
 
-def process_find_start_for_multiple_query_blast_record(lock, process_number, env, records, sbsp_options, pf_output,
-                                                       **kwargs):
-    # type: (Lock, int, Environment, List[Record], SBSPOptions, str, Dict[str, Any]) -> None
+# State of run_sbsp_steps' worker processes: set once per worker, when the pool starts
+_worker_state = dict()  # type: Dict[str, Any]
 
-    # local_rng = np.random.RandomState(sbsp_options.safe_get("random-seed"))
-    local_rng = random.Random(sbsp_options.safe_get("random-seed"))
 
-    msa_number = 0
-    for r in records:
-        df_result = find_start_for_query_blast_record(
-            env, r, sbsp_options, msa_number="{}_{}".format(process_number, msa_number), rng=local_rng, **kwargs
-        )
+def _init_find_start_worker(env, sbsp_options, kwargs):
+    # type: (Environment, SBSPOptions, Dict[str, Any]) -> None
+    _worker_state["env"] = env
+    _worker_state["sbsp_options"] = sbsp_options
+    _worker_state["kwargs"] = kwargs        # target store is reopened once per worker when unpickled
 
-        lock.acquire()
-        try:
-            append_data_frame_to_csv(df_result, pf_output)
-        finally:
-            lock.release()
 
-        msa_number += 1
+def _find_start_for_query_blast_record_seeded(env, r, sbsp_options, msa_number, **kwargs):
+    # type: (Environment, Record, SBSPOptions, int, Dict[str, Any]) -> pd.DataFrame
+
+    # one generator per query, so results don't depend on how queries are split across workers
+    rng = random.Random(sbsp_options.safe_get("random-seed"))
+    return find_start_for_query_blast_record(env, r, sbsp_options, msa_number=msa_number, rng=rng, **kwargs)
+
+
+def get_q_key_from_blast_record(r):
+    # type: (Record) -> str
+    query_info = unpack_fasta_header_cached(r.query)
+    return "{};{};{};{}".format(query_info["accession"], query_info["left"], query_info["right"],
+                                query_info["strand"])
+
+
+def _write_query_result(df_result, q_key, pf_output, manifest):
+    # type: (pd.DataFrame, str, str, CheckpointManifest) -> None
+    append_data_frame_to_csv(df_result, pf_output)
+
+    pf_msa = None
+    if len(df_result) > 0 and "pf-msa-output" in df_result.columns:
+        pf_msa = df_result.iloc[0]["pf-msa-output"]
+        pf_msa = None if pd.isnull(pf_msa) else pf_msa
+
+    manifest.add_query(q_key, len(df_result), pf_output, pf_msa)
+
+
+def _find_start_for_chunk_of_blast_records(chunk, cost):
+    # type: (List[Tuple[int, Record]], float) -> Tuple[int, int, float, float, Tuple[int, int], List[Tuple[str, pd.DataFrame]]]
+    """
+    Runs in a worker process.
+    :return: worker process ID, number of records, estimated cost, time spent (seconds), MSA cache
+    hits and misses, and the query key and data frame of each record
+    """
+
+    env = _worker_state["env"]
+    sbsp_options = _worker_state["sbsp_options"]
+    kwargs = _worker_state["kwargs"]
+
+    curr_time = timeit.default_timer()
+    hits_before, misses_before = get_msa_cache_stats()
+
+    list_results = list()
+    for msa_number, r in chunk:
+        list_results.append((
+            get_q_key_from_blast_record(r),
+            _find_start_for_query_blast_record_seeded(env, r, sbsp_options, msa_number, **kwargs)
+        ))
+
+    hits, misses = get_msa_cache_stats()
+
+    return os.getpid(), len(chunk), cost, timeit.default_timer() - curr_time, \
+        (hits - hits_before, misses - misses_before), list_results
+
+
+def run_find_start_on_blast_records_in_parallel(env, numbered_records, sbsp_options, pf_output, manifest,
+                                                num_processors, **kwargs):
+    # type: (Environment, Iterator[Tuple[int, Record]], SBSPOptions, str, CheckpointManifest, int, Dict[str, Any]) -> int
+    """
+    Find starts for all (MSA number, blast record) pairs using a pool of persistent worker processes, and
+    record each finished query in the manifest. Records are read lazily
+    and submitted in chunks, with a bounded number of chunks in flight; idle workers take the next chunk
+    from the pool's shared queue. Results are written to the output file by the calling process only.
+
+    Records are scheduled longest-job-first: a window of upcoming records is kept, and the most expensive
+    one (see estimate_blast_record_cost) is always submitted next, so that expensive queries don't end up
+    running alone at the end. Chunks are filled up to an estimated run time of target_seconds_per_chunk,
+    using the observed time per unit of cost (one record per chunk until that is known).
+
+    :param kwargs:
+        - max_chunks_per_worker: maximum number of chunks waiting or running per worker (default 2)
+        - target_seconds_per_chunk: desired run time of a chunk (default 20)
+        - max_records_per_chunk: upper bound on chunk size (default 16)
+        - records_in_window_per_worker: number of records read ahead for scheduling, per worker (default 64)
+    :return: number of chunks that failed
+    """
+
+    max_chunks_per_worker = get_value(kwargs, "max_chunks_per_worker", 2)
+    target_seconds_per_chunk = get_value(kwargs, "target_seconds_per_chunk", 20)
+    max_records_per_chunk = get_value(kwargs, "max_records_per_chunk", 16)
+    records_in_window_per_worker = get_value(kwargs, "records_in_window_per_worker", 64)
+
+    kwargs_worker = {k: v for k, v in kwargs.items() if k not in {
+        "max_chunks_per_worker", "target_seconds_per_chunk", "max_records_per_chunk",
+        "records_in_window_per_worker"
+    }}
+    kwargs_worker["num_processors"] = 1
+
+    max_pending = max_chunks_per_worker * num_processors
+    completed = queue.Queue()       # filled by the pool's result thread
+
+    numbered_records = iter(numbered_records)
+    max_window = records_in_window_per_worker * num_processors
+    window = list()                 # type: List[Tuple[float, int, Record]]  # heap of (-cost, msa number, record)
+    num_pending = 0
+    num_failed = 0
+    no_more_records = False
+
+    seconds_per_cost = None         # type: Union[float, None]   # unknown until the first chunk completes
+    total_cost = 0.0
+    total_seconds = 0.0
+    worker_stats = dict()           # type: Dict[int, List[float]]   # pid -> [records, busy seconds, hits, misses]
+
+    curr_time = timeit.default_timer()
+    pool = Pool(processes=num_processors, initializer=_init_find_start_worker,
+                initargs=(env, sbsp_options, kwargs_worker))
+
+    try:
+        while True:
+            # keep workers busy without reading too far ahead in the blast output
+            while num_pending < max_pending:
+                if not no_more_records:
+                    for msa_number, r in itertools.islice(numbered_records, max_window - len(window)):
+                        cost = estimate_blast_record_cost(r, sbsp_options, **kwargs_worker)
+                        heapq.heappush(window, (-cost, msa_number, r))
+                    no_more_records = len(window) < max_window
+
+                if len(window) == 0:
+                    break
+
+                # most expensive records first, grouped until the chunk's estimated time is reached
+                chunk = list()      # type: List[Tuple[int, Record]]
+                chunk_cost = 0.0
+                while len(window) > 0 and len(chunk) < max_records_per_chunk:
+                    neg_cost, number, r = heapq.heappop(window)
+                    chunk.append((number, r))
+                    chunk_cost -= neg_cost
+
+                    if seconds_per_cost is None or chunk_cost * seconds_per_cost >= target_seconds_per_chunk:
+                        break
+
+                pool.apply_async(_find_start_for_chunk_of_blast_records, (chunk, chunk_cost),
+                                 callback=completed.put, error_callback=completed.put)
+                num_pending += 1
+
+            if num_pending == 0:
+                break
+
+            result = completed.get()
+            num_pending -= 1
+
+            if isinstance(result, BaseException):
+                logger.warning("Failed to process chunk of queries: {}".format(result))
+                num_failed += 1
+                continue
+
+            pid, num_records, cost, elapsed, (cache_hits, cache_misses), list_results = result
+            for q_key, df_result in list_results:
+                _write_query_result(df_result, q_key, pf_output, manifest)
+
+            if pid not in worker_stats:
+                worker_stats[pid] = [0, 0.0, 0, 0]
+            worker_stats[pid][0] += num_records
+            worker_stats[pid][1] += elapsed
+            worker_stats[pid][2] += cache_hits
+            worker_stats[pid][3] += cache_misses
+
+            total_cost += cost
+            total_seconds += elapsed
+            if total_cost > 0:
+                seconds_per_cost = total_seconds / total_cost
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+    wall_time = max(timeit.default_timer() - curr_time, 1e-6)
+    for pid in sorted(worker_stats.keys()):
+        num_records, busy, cache_hits, cache_misses = worker_stats[pid]
+        logger.info("Worker {}: {} queries, {:.2f} queries/min, busy {:.0f}% of {:.2f} min, "
+                    "MSA cache {} hits / {} misses".format(
+                        pid, int(num_records), 60.0 * num_records / max(busy, 1e-6), 100.0 * busy / wall_time,
+                        wall_time / 60.0, cache_hits, cache_misses
+                    ))
+
+    return num_failed
 
 
 def run_sbsp_steps(env, data, pf_t_db, pf_output, sbsp_options, **kwargs):
     # type: (Environment, Dict[str, Seq], str, str, SBSPOptions, Dict[str, Any]) -> str
+    """
+    Run blast on the query sequences, and find a start for each query with hits. Progress is recorded
+    in a checkpoint manifest (<pf_output>.manifest); if the "resume" option is set, a previous run
+    in the same place is continued: its blast output is reused, and finished queries are skipped.
+    :param kwargs:
+        - pf_blast_hits: blast output for the queries, computed beforehand (e.g. in a batch with other
+        genomes); if set, blast is not run
+    """
 
     num_processors = get_value(kwargs, "num_processors", None)
+    pf_blast_hits = get_value(kwargs, "pf_blast_hits", None)
+    resume = sbsp_options.safe_get("resume")
 
     q_sequences = data
     # REMOVE
     # q_sequences = debug_filter_queries(q_sequences)
     # num_processors = None
 
-    remove_p(pf_output)  # start clean
+    manifest = CheckpointManifest(pf_output + ".manifest", resume=resume)
+    if manifest.is_complete:
+        logger.info("All queries already done: {}".format(pf_output))
+        return pf_output
+
+    if resume:
+        manifest.truncate_output(pf_output)     # drop rows of unfinished queries
+    else:
+        remove_p(pf_output)  # start clean
 
     # Run blast
-    pf_blast_output = os.path.join(env["pd-work"], "blast_output.xml")
-    remove_p(pf_blast_output)
-    try:
-        curr_time = timeit.default_timer()
-        run_blast_on_sequences(env, q_sequences, pf_t_db, pf_blast_output, sbsp_options, **kwargs)
-        logger.info("Blast runtime (min): {:.2f}".format((timeit.default_timer() - curr_time) / float(60)))
-    except ValueError:
+    outfmt = get_blast_output_format(sbsp_options)
+    pf_blast_output = os.path.join(env["pd-work"], "blast_output.{}".format("tsv" if outfmt == "tabular" else "xml"))
+
+    if pf_blast_hits is not None:
+        if not os.path.isfile(pf_blast_hits):
+            raise ValueError("Could not find blast results file: {}".format(pf_blast_hits))
+        pf_blast_output = pf_blast_hits
+    elif manifest.pf_blast_output is not None and os.path.isfile(manifest.pf_blast_output):
+        pf_blast_output = manifest.pf_blast_output
+        logger.info("Reusing blast output: {}".format(pf_blast_output))
+    else:
         remove_p(pf_blast_output)
-        raise ValueError("Couldn't run blast successfully")
+        try:
+            curr_time = timeit.default_timer()
+            run_blast_on_sequences(env, q_sequences, pf_t_db, pf_blast_output, sbsp_options, **kwargs)
+            logger.info("Blast runtime (min): {:.2f}".format((timeit.default_timer() - curr_time) / float(60)))
+        except ValueError:
+            remove_p(pf_blast_output)
+            raise ValueError("Couldn't run blast successfully")
+
+        manifest.add_blast_output(pf_blast_output)
+
+    # target information is read from the database's store (if one was built with it)
+    kwargs["target_store"] = TargetStore.init_if_exists(pf_t_db)
+    unpack_fasta_header_cached.cache_clear()  # memoized deflines are only reused within a run
 
     # open blast stream
     try:
-        f_blast_results = open(pf_blast_output, "r")
+        records = read_hits(pf_blast_output, outfmt)
     except OSError:
         raise ValueError("Could not open blast results file: {}".format(pf_blast_output))
 
-    records = NCBIXML.parse(f_blast_results)
+    # MSA numbers follow the blast output, so they don't change when finished queries are skipped
+    numbered_records = (
+        (msa_number, r) for msa_number, r in enumerate(records)
+        if not manifest.is_query_done(get_q_key_from_blast_record(r))
+    )
 
     # REMOVE
 
+    num_failed = 0
     if num_processors is None or num_processors == 0:
-        msa_number = 0
         # for each query, find start
-        for r in tqdm(records, total=len(records)):
+        for msa_number, r in tqdm(numbered_records):
             # REMOVE
             # query_info = unpack_fasta_header(r.query)
             # if  int(query_info["right"]) not in {449870}:
             #    logger.debug("Skipping: {}".format(query_info["right"]))
             #    continue
 
-            df_result = find_start_for_query_blast_record(env, r, sbsp_options, msa_number=msa_number, **kwargs)
-            append_data_frame_to_csv(df_result, pf_output)
-            msa_number += 1
-    else:
+            df_result = _find_start_for_query_blast_record_seeded(env, r, sbsp_options, msa_number, **kwargs)
+            _write_query_result(df_result, get_q_key_from_blast_record(r), pf_output, manifest)
 
+        logger.info("MSA cache: {} hits / {} misses".format(*get_msa_cache_stats()))
+    else:
         logger.debug("Run in parallel mode with {} processors".format(num_processors))
+        num_failed = run_find_start_on_blast_records_in_parallel(env, numbered_records, sbsp_options, pf_output,
+                                                                 manifest, num_processors, **kwargs)
 
-        num_simultaneous_records_per_process = 4
-        active_processes = dict()
-        worker_id = 0
-        kwargs_duplicated = kwargs.copy()
-        kwargs_duplicated["num_processors"] = 1
-
-        # run separate process on each split
-        lock = Lock()
-
-        while True:
+    if num_failed > 0:
+        # keep blast output, so a resumed run only redoes the failed queries
+        logger.warning("Some queries failed; rerun with 'resume' to retry them")
+        return pf_output
 
-            no_more_records = False
-
-            while len(active_processes) < num_processors:
-                list_records = list()  # type: List[Record]
-
-                for r in records:
-                    list_records.append(r)
-                    if len(list_records) == num_simultaneous_records_per_process:
-                        break
-
-                if len(list_records) == 0:
-                    no_more_records = True
-                    break
-
-                p = Process(target=process_find_start_for_multiple_query_blast_record,
-                            args=(lock, worker_id, env, list_records, sbsp_options, pf_output),
-                            kwargs={**kwargs_duplicated}
-                            )
-
-                logger.debug("Starting process {}".format(worker_id))
-                p.start()
-                active_processes[worker_id] = p
-                worker_id += 1
-
-            if no_more_records:
-                break
-
-            # wait until all processes are done
-            if len(active_processes) > 0:
-                while True:
-                    completed_process_ids = set()
-                    for i, p in active_processes.items():
-                        if not p.is_alive():
-                            completed_process_ids.add(i)
-                            logger.debug("Done running process {}".format(i))
-
-                    # clean up
-                    if len(completed_process_ids) > 0:
-                        for i in completed_process_ids:
-                            del active_processes[i]
-
-                        break
-                    else:
-                        time.sleep(1)
-
-        # wait for remaining processes
-        for p in active_processes.values():
-            p.join()
-
-    remove_p(pf_blast_output)
+    manifest.mark_complete()
+    if pf_blast_hits is None:
+        remove_p(pf_blast_output)
 
 
     return pf_output
@@ -1419,11 +1629,15 @@ def sbsp_steps(env, pipeline_options):
         if prl_options.safe_get("pd-data-compute"):
             env = env.duplicate({"pd-data": prl_options["pd-data-compute"]})
 
+        # job outputs are concatenated into the pipeline output as jobs end
         pbs = PBS(env, prl_options,
                   splitter=split_dict,
-                  merger=merge_identity
+                  merger=functools.partial(merge_csv_files, pf_output=pipeline_options["pf-output"])
                   )
 
+        if pipeline_options.safe_get("pf-blast-hits") is not None:
+            logger.warning("Precomputed blast hits are not split across PBS jobs: each job runs blast")
+
         if pipeline_options.perform_step("prediction"):
 
             pd_msa = os.path.join(prl_options["pbs-pd-head"], "msa")
@@ -1431,6 +1645,8 @@ def sbsp_steps(env, pipeline_options):
 
             output = pbs.run(
                 data={"dict": q_sequences,
+                      "costs": {k: estimate_query_cost(len(unpack_fasta_header_cached(k)["lorf_nt"]))
+                                for k in q_sequences.keys()},
                       "pf_output_template": os.path.join(prl_options["pbs-pd-head"],
                                                          pipeline_options["fn-msa"] + "_{}")},
                 func=run_sbsp_steps,
@@ -1459,6 +1675,7 @@ def sbsp_steps(env, pipeline_options):
                 clean=True,
                 pd_msa_final=pd_msa,
                 num_processors=pipeline_options["prl-options"]["num-processors"],
+                pf_blast_hits=pipeline_options.safe_get("pf-blast-hits"),
             )
 
         output = [pipeline_options["pf-output"]]
@@ -1,24 +1,45 @@
 import logging
 import os
+import hashlib
+from io import StringIO
 from typing import *
 
+from Bio import AlignIO
+from Bio.Align import MultipleSeqAlignment
 from Bio.Align.Applications import ClustalOmegaCommandline
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
 
 from sbsp_container.msa import MSAType
-from sbsp_general.general import get_value
-from sbsp_io.general import write_string_to_file, remove_p
+from sbsp_general.general import get_value, except_if_not_in_set
+from sbsp_io.general import write_string_to_file, remove_p, mkdir_p
 
 logger = logging.getLogger(__name__)
 
 
+def sequence_list_to_fasta_string(sequences):
+    # type: (List[Seq]) -> str
+    return "".join(">{}\n{}\n".format(i, sequences[i]) for i in range(len(sequences)))
+
+
 def write_sequence_list_to_fasta_file(sequences, pf_sequences):
     # type: (List[Seq], str) -> None
 
-    data = ""
-    for i in range(len(sequences)):
-        data += ">{}\n{}\n".format(i, sequences[i])
+    write_string_to_file(sequence_list_to_fasta_string(sequences), pf_sequences)
+
+
+def get_clustalo_options(**kwargs):
+    # type: (Dict[str, Any]) -> Dict[str, Any]
+
+    num_processors = get_value(kwargs, "num_processors", None)
+    output_order = get_value(kwargs, "outputorder", "input-order")
+
+    logger.debug("Number of processors for MSA: {}".format(num_processors))
+    options = {"outputorder": output_order, "force": True, "outfmt": "clustal"}
+    if num_processors is not None:
+        options["threads"] = num_processors
 
-    write_string_to_file(data, pf_sequences)
+    return options
 
 
 def run_msa_on_sequence_file(pf_fasta, sbsp_options, pf_msa, **kwargs):
@@ -27,8 +48,6 @@ def run_msa_on_sequence_file(pf_fasta, sbsp_options, pf_msa, **kwargs):
     gapopen = sbsp_options.safe_get("msa-gapopen")
     gapext = sbsp_options.safe_get("msa-gapext")
 
-    num_processors = get_value(kwargs, "num_processors", None)
-    output_order = get_value(kwargs, "outputorder", "input-order")
     gapopen = get_value(kwargs, "gapopen", None)
 
     # clustalw_cline = ClustalwCommandline(
@@ -38,10 +57,6 @@ def run_msa_on_sequence_file(pf_fasta, sbsp_options, pf_msa, **kwargs):
     #     outorder="input"
     # )
 
-    logger.debug("Number of processors for MSA: {}".format(num_processors))
-    other_options = dict()
-    if num_processors is not None:
-        other_options["threads"] = num_processors
     # if gapopen is not None:
     #     other_options["gapopen"] = gapopen
 
@@ -49,32 +64,289 @@ def run_msa_on_sequence_file(pf_fasta, sbsp_options, pf_msa, **kwargs):
         "clustalo", infile=pf_fasta, outfile=pf_msa,
         # gapopen=gapopen,
         # gapext=gapext,
-        outputorder=output_order,
-        force=True,
-        outfmt="clustal",
-        **other_options
+        **get_clustalo_options(**kwargs)
     )
 
     clustalw_cline()
 
 
+class MSABackend:
+    """Runs a multiple sequence alignment. One instance per backend is kept for the life of the process."""
+
+    name = None         # type: str
+    num_runs = 0        # number of alignments run by this backend (in this process)
+
+    def run(self, env, sequences, sbsp_options, **kwargs):
+        # type: (Environment, List[Seq], SBSPOptions, Dict[str, Any]) -> MSAType
+        """Align sequences, and return the MSA with sequences (named 0, 1, ...) in the requested order"""
+        raise NotImplementedError()
+
+
+class ClustaloFileMSABackend(MSABackend):
+    """Writes sequences to a temporary file, runs clustalo on it, and reads its output file"""
+
+    name = "file"
+
+    def run(self, env, sequences, sbsp_options, **kwargs):
+        # type: (Environment, List[Seq], SBSPOptions, Dict[str, Any]) -> MSAType
+
+        pd_work = env["pd-work"]
+        fn_tmp_prefix = get_value(kwargs, "fn_tmp_prefix", "", default_if_none=True)
+
+        # write sequences to file
+        pf_fasta = os.path.join(pd_work, "{}tmp_sequences.fasta".format(fn_tmp_prefix))
+        remove_p(pf_fasta)
+        write_sequence_list_to_fasta_file(sequences, pf_fasta)
+
+        # run msa
+        pf_msa = os.path.join(pd_work, "{}tmp_msa.txt".format(fn_tmp_prefix))
+        run_msa_on_sequence_file(pf_fasta, sbsp_options, pf_msa, **kwargs)
+
+        msa_t = MSAType.init_from_file(pf_msa)
+
+        remove_p(pf_msa, pf_fasta)
+
+        return msa_t
+
+
+class ClustaloPipeMSABackend(MSABackend):
+    """Feeds sequences to clustalo through stdin and parses the alignment from stdout (no temporary files)"""
+
+    name = "pipe"
+
+    def run(self, env, sequences, sbsp_options, **kwargs):
+        # type: (Environment, List[Seq], SBSPOptions, Dict[str, Any]) -> MSAType
+
+        clustalo_cline = ClustalOmegaCommandline("clustalo", infile="-", **get_clustalo_options(**kwargs))
+        stdout, _ = clustalo_cline(stdin=sequence_list_to_fasta_string(sequences))
+
+        return MSAType(AlignIO.read(StringIO(stdout), "clustal"))
+
+
+class ClustaloLibraryMSABackend(MSABackend):
+    """
+    Aligns in-process with the clustalo python bindings (pip install clustalo): no process is
+    spawned per query. The bindings only return alignments in input order; other orders are
+    delegated to the file backend.
+    """
+
+    name = "library"
+
+    def __init__(self):
+        try:
+            import clustalo
+        except ImportError:
+            raise ValueError("MSA backend ({}) requires the clustalo python package".format(self.name))
+
+        self._clustalo = clustalo
+        self._fallback = ClustaloFileMSABackend()
+
+    def run(self, env, sequences, sbsp_options, **kwargs):
+        # type: (Environment, List[Seq], SBSPOptions, Dict[str, Any]) -> MSAType
+
+        if get_value(kwargs, "outputorder", "input-order") != "input-order":
+            return self._fallback.run(env, sequences, sbsp_options, **kwargs)
+
+        num_processors = get_value(kwargs, "num_processors", None)
+        seqtype = get_value(kwargs, "seqtype", "protein")
+        except_if_not_in_set(seqtype, ["protein", "dna", "rna"])
+
+        # unlike the clustalo executable, the bindings don't guess the sequence type
+        aligned = self._clustalo.clustalo(
+            {str(i): str(sequences[i]) for i in range(len(sequences))},
+            seqtype=getattr(self._clustalo, seqtype.upper()),
+            num_threads=num_processors if num_processors is not None else 1
+        )
+
+        return MSAType(MultipleSeqAlignment(
+            [SeqRecord(Seq(aligned[str(i)]), id=str(i), description="") for i in range(len(sequences))]
+        ))
+
+
+MSA_BACKENDS = {b.name: b for b in [ClustaloFileMSABackend, ClustaloPipeMSABackend, ClustaloLibraryMSABackend]}
+
+_msa_backend_instances = dict()  # type: Dict[str, MSABackend]
+
+
+def get_msa_backend(sbsp_options):
+    # type: (SBSPOptions) -> MSABackend
+
+    name = sbsp_options.safe_get("msa-backend")
+    if name is None:
+        name = "file"
+
+    except_if_not_in_set(name, MSA_BACKENDS.keys())
+
+    # backends are persistent: create once per process
+    if name not in _msa_backend_instances:
+        _msa_backend_instances[name] = MSA_BACKENDS[name]()
+
+    return _msa_backend_instances[name]
+
+
+class MSACache:
+    """
+    Persistent, content-addressed cache of alignments, shared by all runs (and processes) that use the
+    same directory. An entry is keyed by a hash of the ordered input sequences, of the MSA backend, and of
+    the aligner options that change the output. Once the directory grows past its size limit, the least
+    recently used entries are removed.
+    """
+
+    VERSION = 1         # part of every key: bump when the entry format or aligner changes
+
+    def __init__(self, pd_cache, max_size_mb):
+        # type: (str, float) -> None
+
+        self._pd_cache = pd_cache
+        self._max_size = int(max_size_mb * 1024 * 1024)
+        self._size = None           # type: Union[int, None]     # bytes used, counted on first write
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+        mkdir_p(pd_cache)
+
+    @staticmethod
+    def key(sequences, backend_name, **kwargs):
+        # type: (List[Seq], str, Dict[str, Any]) -> str
+
+        options = get_clustalo_options(**kwargs)
+        options.pop("threads", None)
+        options["seqtype"] = get_value(kwargs, "seqtype", None)
+        options["backend"] = backend_name       # backends can align the same input differently
+
+        h = hashlib.sha256("{};{}".format(MSACache.VERSION, sorted(options.items())).encode("ascii"))
+        for s in sequences:
+            h.update(b"\n")
+            h.update(str(s).encode("ascii", "replace"))
+
+        return h.hexdigest()
+
+    def _get_path(self, key):
+        # type: (str) -> str
+        return os.path.join(self._pd_cache, key[:2], "{}.msa".format(key))
+
+    def get(self, key):
+        # type: (str) -> Union[MSAType, None]
+
+        pf_entry = self._get_path(key)
+        try:
+            with open(pf_entry, "r") as f:
+                list_records = [SeqRecord(Seq(seq), id=seq_id, description="")
+                                for seq_id, seq in (line.rstrip("\n").split("\t") for line in f)]
+            os.utime(pf_entry)      # mark as recently used
+        except (OSError, ValueError):
+            list_records = list()   # missing, or removed/rewritten by another process while reading
+
+        if len(list_records) == 0:
+            self.num_misses += 1
+            return None
+
+        self.num_hits += 1
+        return MSAType(MultipleSeqAlignment(list_records))
+
+    def put(self, key, msa_t):
+        # type: (str, MSAType) -> None
+
+        pf_entry = self._get_path(key)
+        mkdir_p(os.path.dirname(pf_entry))
+
+        # write then rename, so other processes never read a partial entry
+        pf_tmp = "{}.{}.tmp".format(pf_entry, os.getpid())
+        with open(pf_tmp, "w") as f:
+            for r in msa_t.list_alignment_sequences:
+                f.write("{}\t{}\n".format(r.id, str(r.seq)))
+        os.replace(pf_tmp, pf_entry)
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._list_entries())
+        else:
+            self._size += os.path.getsize(pf_entry)
+
+        if self._size > self._max_size:
+            self._evict()
+
+    def _list_entries(self):
+        # type: () -> List[Tuple[float, int, str]]
+        """Returns (last use, size, path) of all entries"""
+
+        entries = list()
+        for pd_bucket in os.scandir(self._pd_cache):
+            if not pd_bucket.is_dir():
+                continue
+            for f in os.scandir(pd_bucket.path):
+                if f.name.endswith(".msa"):
+                    try:
+                        stat = f.stat()
+                        entries.append((stat.st_mtime, stat.st_size, f.path))
+                    except OSError:
+                        pass    # removed by another process
+        return entries
+
+    def _evict(self):
+        # type: () -> None
+        """Remove least recently used entries, down to 90% of the size limit"""
+
+        entries = sorted(self._list_entries())
+        self._size = sum(size for _, size, _ in entries)
+
+        num_removed = 0
+        for _, size, pf_entry in entries:
+            if self._size <= 0.9 * self._max_size:
+                break
+            remove_p(pf_entry)
+            self._size -= size
+            num_removed += 1
+
+        logger.debug("MSA cache: evicted {} entries".format(num_removed))
+
+
+_msa_cache_instances = dict()  # type: Dict[str, MSACache]
+
+
+def get_msa_cache(sbsp_options):
+    # type: (SBSPOptions) -> Union[MSACache, None]
+    """Returns the MSA cache set in the options, or None if caching is disabled"""
+
+    pd_cache = sbsp_options.safe_get("msa-cache-directory")
+    if pd_cache is None:
+        return None
+
+    max_size_mb = sbsp_options.safe_get("msa-cache-max-size-mb")
+    if max_size_mb is None:
+        max_size_mb = 1024
+
+    if pd_cache not in _msa_cache_instances:
+        _msa_cache_instances[pd_cache] = MSACache(pd_cache, max_size_mb)
+
+    return _msa_cache_instances[pd_cache]
+
+
+def get_msa_cache_stats():
+    # type: () -> Tuple[int, int]
+    """Returns the number of MSA cache hits and misses in this process"""
+    return sum(c.num_hits for c in _msa_cache_instances.values()), \
+        sum(c.num_misses for c in _msa_cache_instances.values())
+
+
 def run_msa_on_sequences(env, sequences, sbsp_options, **kwargs):
     # type: (Environment, List[Seq], SBSPOptions, Dict[str, Any]) -> MSAType
 
-    pd_work = env["pd-work"]
-    fn_tmp_prefix = get_value(kwargs, "fn_tmp_prefix", "", default_if_none=True)
+    backend = get_msa_backend(sbsp_options)
+    cache = get_msa_cache(sbsp_options)
+    key = None
 
-    # write sequences to file
-    pf_fasta = os.path.join(pd_work, "{}tmp_sequences.fasta".format(fn_tmp_prefix))
-    remove_p(pf_fasta)
-    write_sequence_list_to_fasta_file(sequences, pf_fasta)
+    if cache is not None:
+        key = MSACache.key(sequences, backend.name, **kwargs)
+        msa_t = cache.get(key)
+        if msa_t is not None:
+            return msa_t
 
-    # run msa
-    pf_msa = os.path.join(pd_work, "{}tmp_msa.txt".format(fn_tmp_prefix))
-    run_msa_on_sequence_file(pf_fasta, sbsp_options, pf_msa, **kwargs)
+    backend.num_runs += 1
 
-    msa_t = MSAType.init_from_file(pf_msa)
+    msa_t = backend.run(env, sequences, sbsp_options, **kwargs)
 
-    remove_p(pf_msa, pf_fasta)
+    if cache is not None:
+        cache.put(key, msa_t)
 
     return msa_t
\ No newline at end of file
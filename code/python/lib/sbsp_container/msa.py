@@ -1,6 +1,8 @@
 from typing import *
 import logging
 
+import numpy as np
+
 from Bio import AlignIO
 from Bio.Align import MultipleSeqAlignment, SeqRecord, Seq
 
@@ -71,6 +73,8 @@ class MSAType:
 
         self.list_alignment_sequences = [s for s in alignments]           # type: List[SeqRecord]
 
+        self._index = None          # type: Union[MSAIndex, None]
+
     def get_mark_position(self, name):
         # type: (str) -> Union[int, None]
 
@@ -120,6 +124,56 @@ class MSAType:
 
         self.list_alignment_sequences = sorted(self.list_alignment_sequences,
                                                key=lambda x: x.id.split("-")[field_number])
+        self._index = None
+
+    def number_of_gaps_in_column(self, pos):
+        # type: (int) -> int
+        return sum(1 for a in self.list_alignment_sequences if a[pos] == "-")
+
+    def number_of_gaps_in_region(self, idx, begin, end):
+        # type: (int, int, int) -> int
+        """Number of gaps in sequence idx, between begin and end (exclusive)"""
+        return str(self.list_alignment_sequences[idx].seq[begin:end]).count("-")
+
+    def is_upper(self, idx, pos):
+        # type: (int, int) -> bool
+        return self.list_alignment_sequences[idx][pos].isupper()
+
+    def get_subset(self, rows, columns=None):
+        # type: (Iterable[int], Union[Iterable[int], None]) -> MSAType
+        """
+        New alignment with the selected sequences (and columns, if given), in the given order.
+        Markers are not copied.
+        """
+
+        records = [self.list_alignment_sequences[r] for r in rows]
+
+        if columns is not None:
+            columns = list(columns)
+
+            def select_columns(seq):
+                # type: (str) -> str
+                return "".join(seq[c] for c in columns)
+
+            records = [
+                SeqRecord(Seq(select_columns(str(a.seq))), id=a.id, name=a.name, description=a.description)
+                for a in records
+            ]
+
+        return type(self)(records)
+
+    def get_index(self):
+        # type: () -> MSAIndex
+        """Precomputed gap and conservation index of the alignment (built on first use)"""
+        if self._index is None:
+            self._index = MSAIndex(self)
+        return self._index
+
+    def get_column_letters(self, pos):
+        # type: (int) -> np.ndarray
+        """Letters at a column, as a uint8 array (one per sequence)"""
+        column = "".join(a[pos] for a in self.list_alignment_sequences)
+        return np.frombuffer(column.encode("ascii", "replace"), dtype=np.uint8)
 
 
     @staticmethod
@@ -389,3 +443,246 @@ class MSAType:
         sbsp_io.general.write_string_to_file(self.to_string(begin, end, format=format, **kwargs), pf_out)
 
 
+
+
+class MSAArrayType(MSAType):
+    """
+    MSA with the same interface as MSAType, where letters are also stored as a 2-D uint8 matrix
+    (one row per sequence), along with gap and upper-case (i.e. candidate start) masks. Column
+    operations become array slicing instead of per-letter SeqRecord lookups.
+
+    Sequence records are not expected to change after construction (ids can).
+    """
+
+    GAP = ord("-")
+
+    def __init__(self, alignments, **kwargs):
+        # type: (MultipleSeqAlignment, Dict[str, Any]) -> None
+        super(MSAArrayType, self).__init__(alignments, **kwargs)
+
+        self._update_arrays()
+
+    def _update_arrays(self):
+        # type: () -> None
+
+        num_sequences = self.number_of_sequences()
+        alignment_length = self.alignment_length() if num_sequences > 0 else 0
+
+        # non-ascii letters become '?', so positions are preserved
+        all_letters = "".join(str(a.seq) for a in self.list_alignment_sequences).encode("ascii", "replace")
+        if len(all_letters) != num_sequences * alignment_length:
+            raise ValueError("Sequences in alignment must have the same length")
+
+        self.letters = np.frombuffer(all_letters, dtype=np.uint8).reshape(
+            num_sequences, alignment_length
+        )  # type: np.ndarray
+        self.gap_mask = self.letters == MSAArrayType.GAP  # type: np.ndarray
+        self.upper_mask = (self.letters >= ord("A")) & (self.letters <= ord("Z"))  # type: np.ndarray
+
+        self._index = None
+
+    @classmethod
+    def from_msa_type(cls, msa_t):
+        # type: (MSAType) -> MSAArrayType
+        return cls(msa_t.list_alignment_sequences, list_msa_markers=msa_t.list_msa_markers)
+
+    @staticmethod
+    def init_from_file(pf_msa):
+        # type: (str) -> MSAArrayType
+        return MSAArrayType.from_msa_type(MSAType.init_from_file(pf_msa))
+
+    def sort_by_field(self, field_number):
+        # type: (int) -> None
+        super(MSAArrayType, self).sort_by_field(field_number)
+        self._update_arrays()
+
+    def number_of_gaps_in_column(self, pos):
+        # type: (int) -> int
+        return int(np.count_nonzero(self.gap_mask[:, pos]))
+
+    def number_of_gaps_per_column(self):
+        # type: () -> np.ndarray
+        return np.count_nonzero(self.gap_mask, axis=0)
+
+    def number_of_gaps_in_region(self, idx, begin, end):
+        # type: (int, int, int) -> int
+        return int(np.count_nonzero(self.gap_mask[idx, begin:end]))
+
+    def is_upper(self, idx, pos):
+        # type: (int, int) -> bool
+        return bool(self.upper_mask[idx, pos])
+
+    def get_column(self, pos):
+        # type: (int) -> str
+        return self.letters[:, pos].tobytes().decode("ascii")
+
+    def get_column_letters(self, pos):
+        # type: (int) -> np.ndarray
+        return self.letters[:, pos]
+
+    def get_subset(self, rows, columns=None):
+        # type: (Iterable[int], Union[Iterable[int], None]) -> MSAArrayType
+
+        if columns is None:
+            return super(MSAArrayType, self).get_subset(rows)
+
+        rows = list(rows)
+        letters = self.letters[rows][:, list(columns)]
+
+        return MSAArrayType([
+            SeqRecord(Seq(letters[i].tobytes().decode("ascii")), id=a.id, name=a.name, description=a.description)
+            for i, a in enumerate(self.list_alignment_sequences[r] for r in rows)
+        ])
+
+
+class MSAIndex:
+    """
+    Prefix sums over an alignment, so that gap and conservation queries over a window of columns
+    take constant time:
+        - cumulative number of gaps per sequence
+        - number of gaps per column
+        - positions where the query (first sequence) has no gap
+        - per-column conservation scores (computed once per scorer)
+
+    Windows follow the same walk as the start search: from an anchor column, either over consecutive
+    columns, or (when skipping gaps in the query) over the next columns where the query has no gap.
+    """
+
+    def __init__(self, msa_t):
+        # type: (MSAType) -> None
+
+        if not isinstance(msa_t, MSAArrayType):
+            msa_t = MSAArrayType.from_msa_type(msa_t)
+
+        self.letters = msa_t.letters
+        self.num_sequences, self.alignment_length = self.letters.shape
+
+        gap_mask = msa_t.gap_mask
+
+        self.row_gap_prefix = np.zeros((self.num_sequences, self.alignment_length + 1), dtype=np.int64)
+        np.cumsum(gap_mask, axis=1, out=self.row_gap_prefix[:, 1:])
+
+        self.column_gaps = np.count_nonzero(gap_mask, axis=0)
+
+        self.query_non_gap_positions = np.flatnonzero(~gap_mask[0]) if self.num_sequences > 0 \
+            else np.zeros(0, dtype=np.int64)
+
+        self._column_scores = dict()        # type: Dict[Tuple[int, bool], Tuple[np.ndarray, np.ndarray]]
+        self._column_gap_flags = dict()     # type: Dict[float, np.ndarray]
+        self._prefixes = dict()             # type: Dict[Tuple[int, bool], np.ndarray]
+
+    def number_of_gaps_in_row(self, idx, begin, end):
+        # type: (int, int, int) -> int
+        """Number of gaps in sequence idx between begin and end (exclusive)"""
+        return int(self.row_gap_prefix[idx, end] - self.row_gap_prefix[idx, begin])
+
+    def _window_sum(self, values, start, end, direction, skip_gaps_in_query):
+        # type: (np.ndarray, int, int, str, bool) -> Tuple[float, int]
+        """
+        Sum of per-column values over a window of end-start columns
+        :return: sum and number of columns visited (fewer than end-start if the alignment ran out)
+        """
+
+        num_positions = end - start
+        if num_positions <= 0:
+            return 0, 0
+
+        if not skip_gaps_in_query:
+            prefix = self._get_prefix(values, False)
+            return prefix[end] - prefix[start], num_positions
+
+        # first column of the walk is the anchor, then only columns where the query has no gap
+        positions = self.query_non_gap_positions
+        prefix = self._get_prefix(values, True)
+
+        if direction == "downstream":
+            anchor = start
+            k = int(np.searchsorted(positions, anchor, side="right"))
+            num_other = min(num_positions - 1, len(positions) - k)
+            total = values[anchor] + prefix[k + num_other] - prefix[k]
+        else:
+            anchor = end - 1
+            k = int(np.searchsorted(positions, anchor, side="left"))
+            num_other = min(num_positions - 1, k)
+            total = values[anchor] + prefix[k] - prefix[k - num_other]
+
+        return total, num_other + 1
+
+    def _get_prefix(self, values, over_query_non_gaps):
+        # type: (np.ndarray, bool) -> np.ndarray
+
+        # values are cached arrays, so prefixes are cached alongside them
+        key = (id(values), over_query_non_gaps)
+
+        if key not in self._prefixes:
+            selected = values[self.query_non_gap_positions] if over_query_non_gaps else values
+            prefix = np.zeros(len(selected) + 1, dtype=values.dtype)
+            np.cumsum(selected, out=prefix[1:])
+            self._prefixes[key] = prefix
+
+        return self._prefixes[key]
+
+    def _get_column_scores(self, scorer, score_on_all_pairs):
+        # type: (Any, bool) -> Tuple[np.ndarray, np.ndarray]
+        """Per-column scores, and flags for columns with letter pairs the scorer doesn't know"""
+
+        key = (id(scorer.lookup_table()), score_on_all_pairs)
+
+        if key not in self._column_scores:
+            scores = np.zeros(self.alignment_length, dtype=float)
+            unknown = np.zeros(self.alignment_length, dtype=np.int64)
+
+            for pos in range(self.alignment_length):
+                try:
+                    if score_on_all_pairs:
+                        scores[pos] = scorer.score_column_all_pairs(self.letters[:, pos])
+                    else:
+                        scores[pos] = scorer.score_column_against_first(self.letters[:, pos])
+                except KeyError:
+                    unknown[pos] = 1
+
+            self._column_scores[key] = (scores, unknown)
+
+        return self._column_scores[key]
+
+    def conservation_in_window(self, start, end, scorer, direction, skip_gaps_in_query, score_on_all_pairs):
+        # type: (int, int, Any, str, bool, bool) -> Tuple[float, int]
+        """
+        :return: sum of column scores over the window, and number of scored pairs
+        """
+
+        scores, unknown = self._get_column_scores(scorer, score_on_all_pairs)
+
+        num_positions = end - start
+        num_unknown, num_visited = self._window_sum(unknown, start, end, direction, skip_gaps_in_query)
+
+        if num_unknown > 0:
+            raise KeyError("Unknown letter pair in column")
+        if num_visited < num_positions:
+            raise ValueError("Not enough region to compute score")
+
+        pairs_per_column = self.num_sequences * (self.num_sequences - 1) // 2 if score_on_all_pairs \
+            else self.num_sequences - 1
+
+        total, _ = self._window_sum(scores, start, end, direction, skip_gaps_in_query)
+
+        return float(total), num_positions * pairs_per_column
+
+    def each_column_below_gap_allowance(self, start, end, max_frac_allowed_gaps, direction, skip_gaps_in_query):
+        # type: (int, int, float, str, bool) -> bool
+
+        if max_frac_allowed_gaps not in self._column_gap_flags:
+            self._column_gap_flags[max_frac_allowed_gaps] = (
+                self.column_gaps / float(self.num_sequences) > max_frac_allowed_gaps
+            ).astype(np.int64)
+
+        above, num_visited = self._window_sum(
+            self._column_gap_flags[max_frac_allowed_gaps], start, end, direction, skip_gaps_in_query
+        )
+
+        if above > 0:
+            return False
+        if num_visited < end - start:
+            raise ValueError("Not enough region to compute score")
+
+        return True
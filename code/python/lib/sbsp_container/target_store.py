@@ -0,0 +1,185 @@
+import os
+import logging
+from typing import *
+
+import numpy as np
+
+from sbsp_io.general import remove_p
+
+logger = logging.getLogger(__name__)
+
+
+class TargetStore:
+    """Memory-mapped store of target information (LORF nucleotides, coordinates, upstream gene), written
+    next to a blast database. Each target is identified by a short integer ID placed in its definition line,
+    so blast outputs stay small and target information is looked up in constant time.
+
+    Files (for database path/to/db.dmnd):
+        path/to/db_store_index.npy:     one fixed-size record per target (see INDEX_DTYPE)
+        path/to/db_store_sequences.bin: concatenated LORF nucleotide sequences
+        path/to/db_store_strings.txt:   accession and genome names, one per line (referenced by index)
+    """
+
+    INDEX_DTYPE = np.dtype([
+        ("left", np.int64),
+        ("right", np.int64),
+        ("offset", np.int64),
+        ("upstream_left", np.int64),
+        ("upstream_right", np.int64),
+        ("strand", "S1"),
+        ("upstream_strand", "S1"),
+        ("accession", np.uint32),
+        ("genome", np.uint32),
+        ("seq_start", np.uint64),
+        ("seq_length", np.uint32),
+    ])
+
+    ID_TAG = "sid="
+
+    def __init__(self, pf_db):
+        # type: (str) -> None
+
+        self._pf_db = pf_db
+        self._open()
+
+    def _open(self):
+        # type: () -> None
+        pf_index, pf_sequences, pf_strings = TargetStore.paths(self._pf_db)
+
+        self._index = np.load(pf_index, mmap_mode="r")
+        self._sequences = np.memmap(pf_sequences, dtype=np.uint8, mode="r") \
+            if os.path.getsize(pf_sequences) > 0 else np.zeros(0, dtype=np.uint8)
+
+        with open(pf_strings, "r") as f:
+            self._strings = [line.rstrip("\n") for line in f]
+
+    def __getstate__(self):
+        # memory maps are not picklable: reopen from file when unpickled (e.g. in worker processes)
+        return {"pf_db": self._pf_db}
+
+    def __setstate__(self, state):
+        self._pf_db = state["pf_db"]
+        self._open()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, sid):
+        # type: (int) -> Dict[str, Any]
+        """Returns target information in the same format as unpack_fasta_header"""
+        r = self._index[sid]
+
+        seq_start = int(r["seq_start"])
+        lorf_nt = self._sequences[seq_start:seq_start + int(r["seq_length"])].tobytes().decode("ascii")
+
+        return {
+            "accession": self._strings[r["accession"]],
+            "genome": self._strings[r["genome"]],
+            "left": int(r["left"]),
+            "right": int(r["right"]),
+            "strand": r["strand"].decode("ascii"),
+            "offset": int(r["offset"]),
+            "lorf_nt": lorf_nt,
+            "upstream_left": int(r["upstream_left"]),
+            "upstream_right": int(r["upstream_right"]),
+            "upstream_strand": r["upstream_strand"].decode("ascii"),
+        }
+
+    @staticmethod
+    def paths(pf_db):
+        # type: (str) -> Tuple[str, str, str]
+        pf_base = pf_db[:-len(".dmnd")] if pf_db.endswith(".dmnd") else pf_db
+        return "{}_store_index.npy".format(pf_base), "{}_store_sequences.bin".format(pf_base), \
+               "{}_store_strings.txt".format(pf_base)
+
+    @staticmethod
+    def exists(pf_db):
+        # type: (str) -> bool
+        return all(os.path.isfile(pf) for pf in TargetStore.paths(pf_db))
+
+    @staticmethod
+    def init_if_exists(pf_db):
+        # type: (str) -> Union[TargetStore, None]
+        if pf_db is None or not TargetStore.exists(pf_db):
+            return None
+
+        logger.debug("Using target store for database: {}".format(pf_db))
+        return TargetStore(pf_db)
+
+    @staticmethod
+    def create_header(accession, sid):
+        # type: (str, int) -> str
+        return "{} {}{}".format(accession, TargetStore.ID_TAG, sid)
+
+    @staticmethod
+    def get_id_from_header(header):
+        # type: (str) -> Union[int, None]
+        """Returns the target ID from a definition line, or None if it has none"""
+        pos = header.rfind(TargetStore.ID_TAG)
+        if pos == -1:
+            return None
+
+        try:
+            return int(header[pos + len(TargetStore.ID_TAG):].split(maxsplit=1)[0])
+        except (ValueError, IndexError):
+            return None
+
+
+class TargetStoreWriter:
+    """Writes a TargetStore incrementally. Use as a context manager, or call close() when done."""
+
+    def __init__(self, pf_db):
+        # type: (str) -> None
+
+        self._pf_index, self._pf_sequences, self._pf_strings = TargetStore.paths(pf_db)
+        remove_p(self._pf_index, self._pf_sequences, self._pf_strings)
+
+        self._f_sequences = open(self._pf_sequences, "wb")
+        self._rows = list()  # type: List[Tuple]
+        self._string_to_index = dict()  # type: Dict[str, int]
+        self._seq_position = 0
+
+    def _get_string_index(self, a_string):
+        # type: (str) -> int
+        if a_string not in self._string_to_index:
+            self._string_to_index[a_string] = len(self._string_to_index)
+        return self._string_to_index[a_string]
+
+    def add(self, info):
+        # type: (Dict[str, Any]) -> int
+        """
+        Add a target to the store
+        :param info: target information, as returned by unpack_fasta_header
+        :return: ID of the target in the store
+        """
+
+        lorf_nt = str(info["lorf_nt"]).encode("ascii")
+        self._f_sequences.write(lorf_nt)
+
+        self._rows.append((
+            int(info["left"]), int(info["right"]), int(info["offset"]),
+            int(info["upstream_left"]), int(info["upstream_right"]),
+            info["strand"].encode("ascii"), info["upstream_strand"].encode("ascii"),
+            self._get_string_index(info["accession"]), self._get_string_index(info["genome"]),
+            self._seq_position, len(lorf_nt)
+        ))
+
+        self._seq_position += len(lorf_nt)
+
+        return len(self._rows) - 1
+
+    def close(self):
+        # type: () -> None
+        self._f_sequences.close()
+
+        np.save(self._pf_index, np.array(self._rows, dtype=TargetStore.INDEX_DTYPE))
+
+        with open(self._pf_strings, "w") as f:
+            for a_string in sorted(self._string_to_index.keys(), key=lambda x: self._string_to_index[x]):
+                f.write("{}\n".format(a_string))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -25,6 +25,18 @@ class Environment:
         # type: (str, Any) -> None
         self._env[key] = value
 
+    def to_dict(self):
+        # type: () -> Dict[str, Any]
+        return copy.deepcopy(self._env)
+
+    @staticmethod
+    def init_from_dict(env_dict):
+        # type: (Dict[str, Any]) -> Environment
+        """Recreate an environment from to_dict (without reloading variables, or creating directories)"""
+        env = Environment.__new__(Environment)
+        env._env = copy.deepcopy(env_dict)
+        return env
+
     def duplicate(self, new_values=None):
         # type: (Dict[str, Any]) -> Environment
         """Creates a copy of the environment, with update variables
@@ -1,6 +1,7 @@
 from __future__ import print_function
 import os
-from subprocess import CalledProcessError
+import logging
+import subprocess
 from typing import *
 
 import numpy as np
@@ -9,22 +10,39 @@ import sbsp_general.general
 # Generating commands
 from sbsp_container.genome_list import GenomeInfoList
 from sbsp_general import Environment
+from sbsp_io.blast import DIAMOND_TABULAR_FIELDS
 from sbsp_io.sequences import extract_genes_for_multiple_genomes
 
+logger = logging.getLogger(__name__)
+
 
 def gen_cmd_run_blastp(pf_q_sequences, pf_blast_db, pf_blast_out, use_diamond, **kwargs):
     # type: (str, str, str, bool, **str) -> str
 
     max_evalue = sbsp_general.general.get_value(kwargs, "max_evalue", None)
     block_size = sbsp_general.general.get_value(kwargs, "block_size", 2, default_if_none=True)
+    outfmt = sbsp_general.general.get_value(kwargs, "outfmt", "xml", default_if_none=True)
+    threads = sbsp_general.general.get_value(kwargs, "threads", None)
+    index_chunks = sbsp_general.general.get_value(kwargs, "index_chunks", None)
+
+    sbsp_general.general.except_if_not_in_set(outfmt, {"xml", "tabular"})
 
     if use_diamond:
-        cmd = "diamond blastp -b {} -d {} -q {} -o {} --outfmt 5 --quiet -k 0 --subject-cover 80 --query-cover 80 ".format(
-            block_size, pf_blast_db, pf_q_sequences, pf_blast_out
+        if outfmt == "tabular":
+            outfmt_diamond = "6 {}".format(" ".join(DIAMOND_TABULAR_FIELDS))
+        else:
+            outfmt_diamond = "5"
+
+        cmd = "diamond blastp -b {} -d {} -q {} -o {} --outfmt {} --quiet -k 0 --subject-cover 80 --query-cover 80 ".format(
+            block_size, pf_blast_db, pf_q_sequences, pf_blast_out, outfmt_diamond
         )
 
         if max_evalue is not None:
             cmd += " --evalue {}".format(max_evalue)
+        if threads is not None:
+            cmd += " --threads {}".format(threads)
+        if index_chunks is not None:
+            cmd += " -c {}".format(index_chunks)
 
     else:
         # TODO: add NCBI blast support
@@ -48,15 +66,44 @@ def gen_cmd_create_blast_database(pf_input, pf_blast_db, seq_type, use_diamond):
 
 # Running commands
 
-def run_blast_alignment(pf_q_sequences, pf_blast_db, pf_blast_out, use_diamond, **kwargs):
-    # type: (str, str, str, bool, **str) -> None
+def start_blast_alignment(pf_q_sequences, pf_blast_db, pf_blast_out, use_diamond, **kwargs):
+    # type: (str, str, str, bool, **str) -> subprocess.Popen
+    """Start blast without waiting for it to finish (see wait_for_blast_alignment)"""
 
     cmd = gen_cmd_run_blastp(pf_q_sequences, pf_blast_db, pf_blast_out, use_diamond, **kwargs)
-    try:
-        sbsp_general.general.run_shell_cmd(cmd)
-    except CalledProcessError:
+    logger.debug(cmd)
+
+    return subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL)
+
+
+def wait_for_blast_alignment(process):
+    # type: (subprocess.Popen) -> int
+    """
+    Wait for a blast run to finish
+    :return: peak memory (resident set size, in bytes) of the run
+    """
+
+    # unlike wait, wait4 reports the resource usage of the process (and of everything it waited for)
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+
+    if process.returncode != 0:
         raise ValueError("Couldn't run blast")
 
+    return rusage.ru_maxrss * 1024      # kilobytes on linux
+
+
+def run_blast_alignment(pf_q_sequences, pf_blast_db, pf_blast_out, use_diamond, **kwargs):
+    # type: (str, str, str, bool, **str) -> int
+    """
+    Run blast
+    :return: peak memory (resident set size, in bytes) of the run
+    """
+
+    return wait_for_blast_alignment(
+        start_blast_alignment(pf_q_sequences, pf_blast_db, pf_blast_out, use_diamond, **kwargs)
+    )
+
 
 def create_blast_database(pf_input, pf_blast_db, seq_type="nucl", use_diamond=True):
     # type: (str, str, str, bool) -> None
@@ -0,0 +1,338 @@
+import os
+import json
+import math
+import logging
+import threading
+from typing import *
+
+from sbsp_general.general import get_value
+from sbsp_general.blast import start_blast_alignment, wait_for_blast_alignment
+from sbsp_io.general import remove_p
+
+logger = logging.getLogger(__name__)
+
+# Diamond's memory use is roughly 6 GB per billion letters of block size (-b) with the default 4 index
+# chunks (-c); fewer chunks use more memory, but run faster. Modeled as GB = b * (2 + 16 / c) + overhead,
+# plus the memory taken by the query sequences. Estimates are scaled by the ratio of measured to estimated
+# peak memory of earlier runs on the same database (see BlastMemoryHistory).
+_GB = 1024 ** 3
+_MEMORY_OVERHEAD_GB = 0.5
+_MEMORY_PER_QUERY_LETTER = 20       # bytes
+_MIN_BLOCK_SIZE = 0.05              # billions of letters
+_MEMORY_SAFETY_FRACTION = 0.8       # only plan to use this much of the available memory
+_MIN_MEMORY_SCALE = 0.5             # don't trust measurements to shrink estimates by more than this
+
+
+def _read_first_line(pf):
+    # type: (str) -> Union[str, None]
+    try:
+        with open(pf, "r") as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def get_available_memory():
+    # type: () -> Union[int, None]
+    """
+    Returns the memory available to this process (in bytes): the smallest of the free memory reported in
+    /proc/meminfo and the remaining room in the process's cgroup (v1 or v2), or None if unknown.
+    """
+
+    candidates = list()
+
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    candidates.append(int(line.split()[1]) * 1024)
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+
+    for pf_limit, pf_usage in [("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+                               ("/sys/fs/cgroup/memory/memory.limit_in_bytes",
+                                "/sys/fs/cgroup/memory/memory.usage_in_bytes")]:
+        limit = _read_first_line(pf_limit)
+        usage = _read_first_line(pf_usage)
+        try:
+            # "max" (v2) and very large numbers (v1) mean no limit
+            if limit is not None and limit != "max" and int(limit) < (1 << 60):
+                candidates.append(int(limit) - int(usage or 0))
+        except ValueError:
+            pass
+
+    return min(candidates) if len(candidates) > 0 else None
+
+
+def get_available_cpus():
+    # type: () -> int
+    """Returns the number of CPUs this process may use, taking cgroup (v2) CPU quotas into account"""
+
+    num_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+
+    quota = _read_first_line("/sys/fs/cgroup/cpu.max")
+    if quota is not None:
+        try:
+            limit, period = quota.split()
+            if limit != "max":
+                num_cpus = min(num_cpus, max(1, int(int(limit) / int(period))))
+        except ValueError:
+            pass
+
+    return num_cpus
+
+
+def count_letters_in_fasta(pf_fasta):
+    # type: (str) -> Tuple[int, int]
+    """Returns the number of sequences and letters in a fasta file"""
+
+    num_sequences = 0
+    num_letters = 0
+    with open(pf_fasta, "r") as f:
+        for line in f:
+            if line.startswith(">"):
+                num_sequences += 1
+            else:
+                num_letters += len(line.strip())
+
+    return num_sequences, num_letters
+
+
+def get_database_file(pf_db):
+    # type: (str) -> str
+    if not pf_db.endswith(".dmnd") and os.path.isfile(pf_db + ".dmnd"):
+        return pf_db + ".dmnd"
+    return pf_db
+
+
+class BlastMemoryHistory:
+    """Measured peak memory of blast runs against a database, kept in a file next to it"""
+
+    MAX_RUNS = 20
+    _lock = threading.Lock()        # runs in threads of one process (e.g. genomes) record runs one at a time
+
+    def __init__(self, pf_db):
+        # type: (str) -> None
+
+        pf_db = get_database_file(pf_db)
+        pf_base = pf_db[:-len(".dmnd")] if pf_db.endswith(".dmnd") else pf_db
+        self._pf_history = "{}_blast_memory.json".format(pf_base)
+        self.runs = self._read()
+
+    def _read(self):
+        # type: () -> List[Dict[str, Any]]
+        try:
+            with open(self._pf_history, "r") as f:
+                return json.load(f)["runs"]
+        except (OSError, ValueError, KeyError):
+            return list()
+
+    def get_memory_scale(self):
+        # type: () -> float
+        """
+        Ratio of measured to estimated peak memory: the largest over recent runs (but at least
+        _MIN_MEMORY_SCALE), or 1 if there are none
+        """
+        ratios = [r["peak-gb"] / r["estimated-gb"] for r in self.runs[-5:] if r["estimated-gb"] > 0]
+        return max(_MIN_MEMORY_SCALE, max(ratios)) if len(ratios) > 0 else 1.0
+
+    def add_run(self, plan, peak_memory):
+        # type: (BlastPlan, int) -> None
+
+        with BlastMemoryHistory._lock:
+            # other runs may have been recorded since this history was read
+            self.runs = self._read()
+
+            self.runs.append({
+                "block-size": plan.block_size, "index-chunks": plan.index_chunks,
+                "num-shards": plan.num_shards, "concurrent-shards": plan.concurrent_shards,
+                "threads": plan.threads, "query-letters": plan.query_letters,
+                "estimated-gb": round(plan.estimated_memory / float(_GB), 3),
+                "peak-gb": round(peak_memory / float(_GB), 3),
+            })
+            self.runs = self.runs[-BlastMemoryHistory.MAX_RUNS:]
+
+            # write then rename, so that runs reading the history never see it partially written
+            pf_tmp = "{}.{}.{}.tmp".format(self._pf_history, os.getpid(), threading.get_ident())
+            try:
+                with open(pf_tmp, "w") as f:
+                    json.dump({"runs": self.runs}, f, indent=1)
+                os.replace(pf_tmp, self._pf_history)
+            except OSError:
+                logger.debug("Could not record blast memory usage in {}".format(self._pf_history))
+
+
+class BlastPlan:
+    """How to run diamond for a query file: block size (-b), index chunks (-c), threads, and how many
+    shards the queries are split into (and how many of those run at the same time)"""
+
+    def __init__(self, block_size, index_chunks, threads, num_shards, concurrent_shards, query_letters,
+                 estimated_memory, memory_scale, memory_limit):
+        # type: (float, int, int, int, int, int, int, float, int) -> None
+        self.block_size = block_size
+        self.index_chunks = index_chunks
+        self.threads = threads
+        self.num_shards = num_shards
+        self.concurrent_shards = concurrent_shards
+        self.query_letters = query_letters
+        self.estimated_memory = estimated_memory    # bytes, for all concurrent shards (before scaling)
+        self.memory_scale = memory_scale            # ratio of measured to estimated memory in earlier runs
+        self.memory_limit = memory_limit            # bytes planned for
+
+    def __str__(self):
+        return "block size {}, index chunks {}, threads {}, shards {} ({} at a time), estimated {:.2f} GB " \
+               "of {:.2f} GB".format(self.block_size, self.index_chunks, self.threads, self.num_shards,
+                                     self.concurrent_shards,
+                                     self.estimated_memory * self.memory_scale / float(_GB),
+                                     self.memory_limit / float(_GB))
+
+
+def estimate_blast_memory(block_size, index_chunks, query_letters):
+    # type: (float, int, int) -> float
+    """Estimated peak memory (in bytes) of a single diamond run, before scaling by measured runs"""
+    return (block_size * (2 + 16.0 / index_chunks) + _MEMORY_OVERHEAD_GB) * _GB + \
+        query_letters * _MEMORY_PER_QUERY_LETTER
+
+
+def plan_blast_run(pf_q_sequences, pf_db, **kwargs):
+    # type: (str, str, Dict[str, Any]) -> BlastPlan
+    """
+    Choose diamond settings that fit in memory:
+        - queries are split into shards if they would take more than a quarter of the memory
+        - one index chunk is used if a block covering the whole database fits (fastest), otherwise 4
+        - the block size is the largest that fits, but no larger than the database
+        - shards run at the same time if more than one fits in memory
+    :param kwargs:
+        - memory_limit: memory (bytes) to plan for; by default, what's available to this process
+        - threads: number of threads to plan for; by default, all available CPUs
+        - allow_shards: whether queries can be split (default True). The output of shards is concatenated,
+        so only tabular output can be sharded.
+    """
+
+    memory_limit = get_value(kwargs, "memory_limit", None)
+    threads = get_value(kwargs, "threads", None)
+    allow_shards = get_value(kwargs, "allow_shards", True)
+
+    if memory_limit is None:
+        memory_limit = get_available_memory()
+        if memory_limit is None:
+            memory_limit = 8 * _GB          # unknown: assume a small node
+    if threads is None:
+        threads = get_available_cpus()
+
+    scale = BlastMemoryHistory(pf_db).get_memory_scale()
+    budget = memory_limit * _MEMORY_SAFETY_FRACTION / scale
+
+    _, query_letters = count_letters_in_fasta(pf_q_sequences)
+    db_letters = os.path.getsize(get_database_file(pf_db))      # about one byte per letter
+    full_block_size = max(_MIN_BLOCK_SIZE, math.ceil(db_letters / 1e7) / 100.0)
+
+    num_shards = 1
+    if allow_shards:
+        num_shards = max(1, int(math.ceil(query_letters * _MEMORY_PER_QUERY_LETTER / (0.25 * budget))))
+    shard_letters = int(math.ceil(query_letters / float(num_shards)))
+
+    memory_for_blocks = budget - estimate_blast_memory(0, 1, shard_letters)
+    index_chunks = 1 if memory_for_blocks >= full_block_size * 18 * _GB else 4
+    block_size = memory_for_blocks / (2 + 16.0 / index_chunks) / _GB
+    block_size = max(_MIN_BLOCK_SIZE, min(full_block_size, math.floor(block_size * 100) / 100.0))
+
+    shard_memory = estimate_blast_memory(block_size, index_chunks, shard_letters) * scale
+    concurrent_shards = max(1, min(num_shards, int(budget * scale / shard_memory), threads))
+
+    plan = BlastPlan(block_size, index_chunks, max(1, threads // concurrent_shards), num_shards,
+                     concurrent_shards, query_letters, int(shard_memory / scale * concurrent_shards), scale,
+                     int(memory_limit))
+
+    logger.info("Blast plan: {}".format(plan))
+    if shard_memory > memory_limit:
+        logger.warning("Blast is expected to need more memory than available")
+    return plan
+
+
+def split_fasta_into_shards(pf_fasta, num_shards, pf_shard_template):
+    # type: (str, int, str) -> List[str]
+    """Split a fasta file into (at most) num_shards files with about the same number of letters"""
+
+    _, num_letters = count_letters_in_fasta(pf_fasta)
+    letters_per_shard = num_letters / float(num_shards)
+
+    list_pf_shards = list()
+    f_out = None
+    letters_in_shard = 0
+
+    with open(pf_fasta, "r") as f:
+        for line in f:
+            if line.startswith(">") and (f_out is None or (letters_in_shard >= letters_per_shard and
+                                                           len(list_pf_shards) < num_shards)):
+                if f_out is not None:
+                    f_out.close()
+                list_pf_shards.append(pf_shard_template.format(len(list_pf_shards)))
+                f_out = open(list_pf_shards[-1], "w")
+                letters_in_shard = 0
+
+            if f_out is not None:
+                f_out.write(line)
+                if not line.startswith(">"):
+                    letters_in_shard += len(line.strip())
+
+    if f_out is not None:
+        f_out.close()
+
+    return list_pf_shards
+
+
+def run_blast_with_plan(plan, pf_q_sequences, pf_db, pf_blast_output, **kwargs):
+    # type: (BlastPlan, str, str, str, Dict[str, Any]) -> int
+    """
+    Run diamond as planned (other arguments in kwargs are passed to gen_cmd_run_blastp), and record the
+    peak memory it used in the database's memory history.
+    :return: peak memory (bytes); for shards running at the same time, the sum of their peaks
+    """
+
+    blast_kwargs = dict(kwargs)
+    blast_kwargs.update({"block_size": plan.block_size, "index_chunks": plan.index_chunks,
+                         "threads": plan.threads})
+
+    if plan.num_shards == 1:
+        peak_memory = wait_for_blast_alignment(
+            start_blast_alignment(pf_q_sequences, pf_db, pf_blast_output, use_diamond=True, **blast_kwargs)
+        )
+    else:
+        list_pf_shards = split_fasta_into_shards(pf_q_sequences, plan.num_shards, pf_q_sequences + "_shard_{}")
+        list_pf_outputs = ["{}_shard_{}".format(pf_blast_output, i) for i in range(len(list_pf_shards))]
+
+        peak_memory = 0
+        try:
+            for begin in range(0, len(list_pf_shards), plan.concurrent_shards):
+                end = min(begin + plan.concurrent_shards, len(list_pf_shards))
+                processes = [start_blast_alignment(list_pf_shards[i], pf_db, list_pf_outputs[i], use_diamond=True,
+                                                   **blast_kwargs) for i in range(begin, end)]
+
+                # wait for all before reporting a failure, so none are left running
+                list_peaks = list()
+                for p in processes:
+                    try:
+                        list_peaks.append(wait_for_blast_alignment(p))
+                    except ValueError:
+                        list_peaks.append(None)
+
+                if None in list_peaks:
+                    raise ValueError("Couldn't run blast")
+
+                peak_memory = max(peak_memory, sum(list_peaks))
+
+            with open(pf_blast_output, "w") as f_out:
+                for pf in list_pf_outputs:
+                    with open(pf, "r") as f_in:
+                        for line in f_in:
+                            f_out.write(line)
+        finally:
+            remove_p(*list_pf_shards)
+            remove_p(*list_pf_outputs)
+
+    logger.info("Blast peak memory (GB): {:.2f}".format(peak_memory / float(_GB)))
+    BlastMemoryHistory(pf_db).add_run(plan, peak_memory)
+
+    return peak_memory
@@ -8,6 +8,8 @@ from collections import namedtuple
 import copy
 import pandas as pd
 
+from sbsp_general.sequence_transforms import add_gaps_to_nt
+
 logger = logging.getLogger(__name__)
 
 
@@ -353,31 +355,7 @@ def add_gaps_to_nt_based_on_aa(seq_nt, seq_aa_with_gaps, preserve_case=True):
     #     raise ValueError("Number of nucleotides ({}) should be 3 times the number of amino acids ({})".format(
     #         len(seq_nt), num_aa))
 
-    seq_nt_with_gaps = ""
-
-    pos_in_nt = 0
-    pos_in_aa_with_gaps = 0
-
-    while pos_in_aa_with_gaps < len(seq_aa_with_gaps):
-
-        curr_aa = seq_aa_with_gaps[pos_in_aa_with_gaps]
-
-        # if gap
-        if curr_aa == "-":
-            seq_nt_with_gaps += "---"       # 3 nt gaps = 1 aa gap
-        else:
-            if preserve_case:
-                if curr_aa.isupper():
-                    seq_nt_with_gaps += seq_nt[pos_in_nt:pos_in_nt + 3].upper()
-                else:
-                    seq_nt_with_gaps += seq_nt[pos_in_nt:pos_in_nt + 3].lower()
-            else:
-                seq_nt_with_gaps += seq_nt[pos_in_nt:pos_in_nt+3]       # add next 3 nucleotides
-            pos_in_nt += 3
-
-        pos_in_aa_with_gaps += 1
-
-    return seq_nt_with_gaps
+    return add_gaps_to_nt(seq_nt, seq_aa_with_gaps, preserve_case=preserve_case)
 
 
 def list_find_first(a_list, a_filter):
@@ -388,6 +366,33 @@ def list_find_first(a_list, a_filter):
     return None
 
 
+def iterate_in_random_order(a_list, rng):
+    # type: (Sequence[Any], Any) -> Generator[Any, None, None]
+    """
+    Lazily yield the elements of a list in random order, drawing one random number per element
+    consumed. This is a Fisher-Yates shuffle run from the end of the list, in which moved elements
+    are tracked in a dictionary instead of a copy of the list, so stopping early leaves the
+    remaining elements untouched.
+    :param rng: any object with a random() method (e.g. random.Random)
+    """
+
+    moved = dict()  # type: Dict[int, int]      # position -> index of element now there
+
+    for i in range(len(a_list) - 1, 0, -1):
+        j = int(rng.random() * (i + 1))
+
+        index_at_i = moved.pop(i, i)
+        index_at_j = moved.get(j, j) if j != i else index_at_i
+
+        # swap positions i and j: position i is final
+        if j != i:
+            moved[j] = index_at_i
+        yield a_list[index_at_j]
+
+    if len(a_list) > 0:
+        yield a_list[moved.get(0, 0)]
+
+
 def os_join(*args):
     # type: (List[Any]) -> str
     return os.path.join(*args)
\ No newline at end of file
@@ -0,0 +1,83 @@
+import numpy as np
+from typing import *
+
+from Bio.Seq import Seq
+
+# Sequence transforms on whole (gapped) sequences, written as numpy index arithmetic over byte arrays
+# instead of per-character string concatenation.
+
+_GAP = ord("-")
+
+
+def _to_array(sequence):
+    # type: (Union[str, Seq]) -> np.ndarray
+    return np.frombuffer(str(sequence).encode("ascii"), dtype=np.uint8)
+
+
+def _to_str(array):
+    # type: (np.ndarray) -> str
+    return array.tobytes().decode("ascii")
+
+
+def _is_upper(array):
+    # type: (np.ndarray) -> np.ndarray
+    return (array >= ord("A")) & (array <= ord("Z"))
+
+
+def add_gaps_to_nt(seq_nt, seq_aa_with_gaps, start_nt=0, preserve_case=False):
+    # type: (Union[str, Seq], Union[str, Seq], int, bool) -> str
+    """
+    Align a nucleotide sequence based on its gapped amino acid alignment: each gap becomes "---", and the
+    i-th amino acid becomes the i-th codon of seq_nt (counting from start_nt). Codons past the end of
+    seq_nt are cut short, as when slicing.
+    :param preserve_case: if set, codons take the case of their amino acid
+    :return: the gapped nucleotide sequence
+    """
+
+    aa = _to_array(seq_aa_with_gaps)
+    nt = _to_array(seq_nt)
+
+    is_residue = aa != _GAP
+    residue_rank = np.cumsum(is_residue) - 1
+
+    # positions in seq_nt of each codon (one row per alignment column)
+    nt_index = start_nt + 3 * residue_rank[:, None] + np.arange(3)[None, :]
+    is_nt = is_residue[:, None] & (nt_index >= 0) & (nt_index < len(nt))
+
+    if preserve_case:
+        nt_upper = _to_array(str(seq_nt).upper())
+        nt_lower = _to_array(str(seq_nt).lower())
+        is_upper = np.broadcast_to(_is_upper(aa)[:, None], is_nt.shape)
+        codon_values = np.where(is_upper[is_nt], nt_upper[nt_index[is_nt]], nt_lower[nt_index[is_nt]])
+    else:
+        codon_values = nt[nt_index[is_nt]]
+
+    output = np.full(nt_index.shape, _GAP, dtype=np.uint8)
+    output[is_nt] = codon_values
+
+    # drop codon positions cut short by the end of seq_nt (gaps are always kept)
+    return _to_str(output[is_nt | ~is_residue[:, None]])
+
+
+def mark_start_codons_in_aa(seq_aa, seq_nt_with_gaps, valid_starts):
+    # type: (Union[str, Seq], Union[str, Seq], Iterable[str]) -> str
+    """
+    Upper-case the amino acids whose codon (in the matching gapped nucleotide sequence) is a valid start,
+    and lower-case all others.
+    """
+
+    aa = _to_array(seq_aa)
+    num_columns = len(aa)
+
+    nt = _to_array(seq_nt_with_gaps)[:3 * num_columns]
+    codons = np.full(3 * num_columns, _GAP, dtype=np.uint8)
+    codons[:len(nt)] = nt
+    codons = codons.reshape(num_columns, 3)
+
+    is_start = np.zeros(num_columns, dtype=bool)
+    for start in valid_starts:
+        is_start |= np.all(codons == _to_array(start)[None, :], axis=1)
+
+    return _to_str(np.where(
+        is_start, _to_array(str(seq_aa).upper()), _to_array(str(seq_aa).lower())
+    ).astype(np.uint8))
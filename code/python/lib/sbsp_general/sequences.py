@@ -1,5 +1,8 @@
 
 
+import numpy as np
+from typing import *
+
 from Bio import Seq
 
 
@@ -90,4 +93,36 @@ def count_number_of_candidate_starts_upstream(sequence, coord, strand):
     return start_counts
 
 
+class CodonIndex:
+    """
+    Positions of a set of codons (e.g. start codons) in each contig of a genome, split by frame, so that
+    codons between two positions are found by binary search instead of scanning codon by codon.
+
+    A codon's position is that of its first nucleotide, and its frame is that position modulo 3.
+    Matching is case-sensitive, as with slicing the sequence and comparing.
+    """
+
+    def __init__(self, sequences, codons):
+        # type: (Dict[str, Seq], Iterable[str]) -> None
+
+        codons = [np.frombuffer(c.encode("ascii"), dtype=np.uint8) for c in codons]
+
+        self._positions = dict()  # type: Dict[str, List[np.ndarray]]
+        for seqname, sequence in sequences.items():
+            nt = np.frombuffer(str(sequence).encode("ascii"), dtype=np.uint8)
+
+            is_codon = np.zeros(max(len(nt) - 2, 0), dtype=bool)
+            for c in codons:
+                is_codon |= (nt[:-2] == c[0]) & (nt[1:-1] == c[1]) & (nt[2:] == c[2])
+
+            positions = np.flatnonzero(is_codon)
+            self._positions[seqname] = [positions[positions % 3 == frame] for frame in range(3)]
 
+    def positions_in_range(self, seqname, frame, begin, end):
+        # type: (str, int, int, int) -> np.ndarray
+        """
+        :return: sorted positions of codons in frame (0, 1 or 2), between begin and end (inclusive)
+        """
+        positions = self._positions[seqname][frame % 3]
+        return positions[np.searchsorted(positions, begin, side="left"):
+                         np.searchsorted(positions, end, side="right")]
@@ -1,8 +1,154 @@
+import re
+from typing import *
+
 from Bio.Blast import NCBIXML
 
 
-def read_hits(fname):
-    # type: (str) -> list[NCBIXML.Record.Blast]
+# Fields requested from diamond in tabular mode (order matters: it is the column order of the output)
+DIAMOND_TABULAR_FIELDS = ["qtitle", "stitle", "qstart", "qend", "sstart", "send", "evalue", "length", "qseq", "btop"]
+
+_BTOP_PATTERN = re.compile(r"(\d+)|(\D\D)")
+
+
+class TabularHSP:
+    """A single high-scoring pair read from tabular blast output. Attribute names
+    mirror those of Bio.Blast.Record.HSP, so both can be used interchangeably"""
+
+    __slots__ = ["query", "sbjct", "query_start", "query_end", "sbjct_start", "sbjct_end", "expect", "align_length"]
+
+    def __init__(self, query, sbjct, query_start, query_end, sbjct_start, sbjct_end, expect, align_length):
+        # type: (str, str, int, int, int, int, float, int) -> None
+        self.query = query
+        self.sbjct = sbjct
+        self.query_start = query_start
+        self.query_end = query_end
+        self.sbjct_start = sbjct_start
+        self.sbjct_end = sbjct_end
+        self.expect = expect
+        self.align_length = align_length
+
+
+class TabularAlignment:
+    """All HSPs of a query against one target (mirrors Bio.Blast.Record.Alignment)"""
+
+    __slots__ = ["title", "hit_id", "hit_def", "hsps"]
+
+    def __init__(self, title):
+        # type: (str) -> None
+        self.title = title
+        split_title = title.split(maxsplit=1)
+        self.hit_id = split_title[0] if len(split_title) > 0 else ""
+        self.hit_def = split_title[1] if len(split_title) > 1 else ""
+        self.hsps = list()  # type: List[TabularHSP]
+
+
+class TabularRecord:
+    """All alignments for a single query (mirrors Bio.Blast.Record.Blast)"""
+
+    __slots__ = ["query", "alignments"]
+
+    def __init__(self, query):
+        # type: (str) -> None
+        self.query = query
+        self.alignments = list()  # type: List[TabularAlignment]
+
+
+def expand_btop(q_seq_aligned_region, btop):
+    # type: (str, str) -> Tuple[str, str]
+    """
+    Reconstruct the gapped query and subject sequences of an alignment from the
+    aligned region of the query and the blast traceback operations (BTOP).
+    :param q_seq_aligned_region: aligned region of query (gaps, if any, are ignored)
+    :param btop: traceback operations string, e.g. 10AG5-K3
+    :return: gapped query and gapped subject
+    """
+
+    q_seq_aligned_region = q_seq_aligned_region.replace("-", "")
+
+    list_q = list()
+    list_s = list()
+    pos_q = 0
+
+    for m in _BTOP_PATTERN.finditer(btop):
+        if m.group(1) is not None:
+            num_identical = int(m.group(1))
+            identical = q_seq_aligned_region[pos_q:pos_q + num_identical]
+            list_q.append(identical)
+            list_s.append(identical)
+            pos_q += num_identical
+        else:
+            q_letter, s_letter = m.group(2)
+            list_q.append(q_letter)
+            list_s.append(s_letter)
+            if q_letter != "-":
+                pos_q += 1
+
+    return "".join(list_q), "".join(list_s)
+
+
+def parse_tabular_hit_line(line):
+    # type: (str) -> Tuple[str, str, TabularHSP]
+
+    values = line.rstrip("\n").split("\t")
+    if len(values) != len(DIAMOND_TABULAR_FIELDS):
+        raise ValueError("Unexpected number of columns in tabular blast output: {} != {}".format(
+            len(values), len(DIAMOND_TABULAR_FIELDS)
+        ))
+
+    qtitle, stitle, qstart, qend, sstart, send, evalue, length, qseq, btop = values
+    q_aligned, s_aligned = expand_btop(qseq, btop)
+
+    hsp = TabularHSP(q_aligned, s_aligned, int(qstart), int(qend), int(sstart), int(send), float(evalue), int(length))
+
+    return qtitle, stitle, hsp
+
+
+def read_hits_tabular(fname):
+    # type: (str) -> Generator[TabularRecord, None, None]
+    """
+    Stream tabular blast output (see DIAMOND_TABULAR_FIELDS), one record per query. Hits
+    are expected to be grouped by query, as written by diamond. Queries without hits
+    do not appear in tabular output, and are therefore not yielded.
+    """
+
+    fresult = open(fname, "r")
+
+    def record_generator():
+        # type: () -> Generator[TabularRecord, None, None]
+        record = None  # type: Union[TabularRecord, None]
+        alignment = None  # type: Union[TabularAlignment, None]
+
+        with fresult:
+            for line in fresult:
+                if len(line.strip()) == 0:
+                    continue
+
+                qtitle, stitle, hsp = parse_tabular_hit_line(line)
+
+                if record is None or record.query != qtitle:
+                    if record is not None:
+                        yield record
+                    record = TabularRecord(qtitle)
+                    alignment = None
+
+                # consecutive HSPs with the same target belong to the same alignment
+                if alignment is None or alignment.title != stitle:
+                    alignment = TabularAlignment(stitle)
+                    record.alignments.append(alignment)
+
+                alignment.hsps.append(hsp)
+
+            if record is not None:
+                yield record
+
+    return record_generator()
+
+
+def read_hits(fname, outfmt="xml"):
+    # type: (str, str) -> Iterator[Union[NCBIXML.Record.Blast, TabularRecord]]
+
+    if outfmt == "tabular":
+        return read_hits_tabular(fname)
 
     fresult = open(fname, "r")
     records = NCBIXML.parse(fresult)
@@ -10,6 +156,43 @@ def read_hits(fname):
     return records
 
 
+def split_tabular_hits_by_group(pf_hits, get_group, group_to_pf_output):
+    # type: (str, Callable[[str], str], Dict[str, str]) -> Dict[str, int]
+    """
+    Split tabular blast output into one file per group of queries (e.g. one per genome). Every output
+    file is created, even if its group has no hits; hits of queries in other groups are dropped.
+    :param get_group: returns the group of a query, given its title
+    :param group_to_pf_output: output file of each group
+    :return: number of hits written for each group
+    """
+
+    group_to_file = {g: open(pf, "w") for g, pf in group_to_pf_output.items()}
+    group_to_num_hits = {g: 0 for g in group_to_pf_output.keys()}
+
+    try:
+        with open(pf_hits, "r") as f:
+            qtitle = None
+            f_out = None
+
+            for line in f:
+                curr_qtitle = line.split("\t", 1)[0]
+
+                # hits are grouped by query: only look up the group when the query changes
+                if curr_qtitle != qtitle:
+                    qtitle = curr_qtitle
+                    group = get_group(qtitle) if len(qtitle.strip()) > 0 else None
+                    f_out = group_to_file.get(group)
+
+                if f_out is not None:
+                    f_out.write(line)
+                    group_to_num_hits[group] += 1
+    finally:
+        for f_out in group_to_file.values():
+            f_out.close()
+
+    return group_to_num_hits
+
+
 def split_blast_output_by_query(pf_hits, tag, num_splits):
     # type: (str, str, int) -> list[str]
 
@@ -32,10 +215,3 @@ def split_blast_output_by_query(pf_hits, tag, num_splits):
     from sbsp_io.xml_breaker import XMLBreaker
 
     return XMLBreaker.run_breaker(pf_hits, tag, num_queries_per_split)
-
-
-
-
-
-
-
@@ -0,0 +1,242 @@
+import os
+import gzip
+import shutil
+import hashlib
+import logging
+from typing import *
+
+import numpy as np
+
+from sbsp_io.blast import DIAMOND_TABULAR_FIELDS
+from sbsp_io.general import mkdir_p, remove_p
+
+logger = logging.getLogger(__name__)
+
+
+# numeric columns of tabular output, and their types
+_NUMERIC_FIELDS = {
+    "qstart": np.int64, "qend": np.int64, "sstart": np.int64, "send": np.int64, "length": np.int64,
+    "evalue": np.float64,
+}
+
+# string columns stored as-is; titles (qtitle and stitle) share a dictionary instead, since each
+# appears on many lines
+_STRING_FIELDS = ["qseq", "btop"]
+
+
+def _pack_strings(list_strings):
+    # type: (List[str]) -> Tuple[np.ndarray, np.ndarray]
+    """Concatenate strings into one byte array, with the start offset of each (plus the total length)"""
+    encoded = [s.encode("utf-8") for s in list_strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack_strings(data, offsets):
+    # type: (np.ndarray, np.ndarray) -> List[str]
+    data = data.tobytes()
+    return [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+
+def write_tabular_hits_columnar(pf_tabular, pf_columnar):
+    # type: (str, str) -> None
+    """
+    Store tabular blast output (see DIAMOND_TABULAR_FIELDS) column by column in a compressed numpy
+    archive. Query and target titles (long definition lines, repeated on every hit) are
+    dictionary-encoded.
+    """
+
+    title_to_index = dict()  # type: Dict[str, int]
+    columns = {f: list() for f in DIAMOND_TABULAR_FIELDS}
+
+    with open(pf_tabular, "r") as f:
+        for line in f:
+            if len(line.strip()) == 0:
+                continue
+
+            values = line.rstrip("\n").split("\t")
+            if len(values) != len(DIAMOND_TABULAR_FIELDS):
+                raise ValueError("Unexpected number of columns in tabular blast output: {} != {}".format(
+                    len(values), len(DIAMOND_TABULAR_FIELDS)
+                ))
+
+            for field, value in zip(DIAMOND_TABULAR_FIELDS, values):
+                if field in {"qtitle", "stitle"}:
+                    if value not in title_to_index:
+                        title_to_index[value] = len(title_to_index)
+                    value = title_to_index[value]
+                columns[field].append(value)
+
+    arrays = dict()
+    arrays["titles_data"], arrays["titles_offsets"] = _pack_strings(
+        sorted(title_to_index.keys(), key=lambda x: title_to_index[x])
+    )
+    for field in ["qtitle", "stitle"]:
+        arrays[field] = np.array(columns[field], dtype=np.uint32)
+    for field, dtype in _NUMERIC_FIELDS.items():
+        arrays[field] = np.array(columns[field], dtype=dtype)
+    for field in _STRING_FIELDS:
+        arrays["{}_data".format(field)], arrays["{}_offsets".format(field)] = _pack_strings(columns[field])
+
+    with open(pf_columnar, "wb") as f:
+        np.savez_compressed(f, **arrays)
+
+
+def read_tabular_hits_columnar(pf_columnar, pf_tabular):
+    # type: (str, str) -> None
+    """Write back the tabular blast output stored by write_tabular_hits_columnar"""
+
+    with np.load(pf_columnar) as arrays:
+        titles = _unpack_strings(arrays["titles_data"], arrays["titles_offsets"])
+        strings = {f: _unpack_strings(arrays["{}_data".format(f)], arrays["{}_offsets".format(f)])
+                   for f in _STRING_FIELDS}
+
+        columns = dict()
+        for field in DIAMOND_TABULAR_FIELDS:
+            if field in {"qtitle", "stitle"}:
+                columns[field] = [titles[i] for i in arrays[field]]
+            elif field == "evalue":
+                columns[field] = [repr(float(x)) for x in arrays[field]]      # repr round-trips exactly
+            elif field in _NUMERIC_FIELDS:
+                columns[field] = [str(x) for x in arrays[field].tolist()]
+            else:
+                columns[field] = strings[field]
+
+    with open(pf_tabular, "w") as f:
+        for values in zip(*[columns[field] for field in DIAMOND_TABULAR_FIELDS]):
+            f.write("\t".join(values) + "\n")
+
+
+class BlastResultCache:
+    """
+    Persistent cache of blast outputs, so that runs that only differ in options used after blast
+    (filtering, search) don't run it again. An entry is keyed by hashes of the query sequences file,
+    the database file, and the blast command options that change the output.
+
+    Tabular outputs are stored column by column (see write_tabular_hits_columnar); XML outputs are
+    stored gzip-compressed.
+    """
+
+    VERSION = 1         # part of every key: bump when the entry format changes
+
+    def __init__(self, pd_cache):
+        # type: (str) -> None
+        self._pd_cache = pd_cache
+        self._db_hashes = dict()    # type: Dict[Tuple[str, int, float], str]
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+        mkdir_p(pd_cache)
+
+    @staticmethod
+    def _hash_file(pf):
+        # type: (str) -> str
+        h = hashlib.sha256()
+        with open(pf, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def _hash_database(self, pf_db):
+        # type: (str) -> str
+        """
+        Databases are large: their hash is computed once, and kept (in memory and in the cache directory)
+        for as long as their path, size and modification time don't change.
+        """
+
+        if not pf_db.endswith(".dmnd") and os.path.isfile(pf_db + ".dmnd"):
+            pf_db = pf_db + ".dmnd"
+
+        pf_db = os.path.abspath(pf_db)
+        stat = os.stat(pf_db)
+        db_id = (pf_db, stat.st_size, stat.st_mtime)
+
+        if db_id not in self._db_hashes:
+            pf_memo = os.path.join(self._pd_cache, "databases",
+                                   "{}.txt".format(hashlib.sha256(repr(db_id).encode("utf-8")).hexdigest()))
+            try:
+                with open(pf_memo, "r") as f:
+                    self._db_hashes[db_id] = f.read().strip()
+            except OSError:
+                self._db_hashes[db_id] = BlastResultCache._hash_file(pf_db)
+                mkdir_p(os.path.dirname(pf_memo))
+                with open(pf_memo, "w") as f:
+                    f.write(self._db_hashes[db_id])
+
+        return self._db_hashes[db_id]
+
+    def key(self, pf_q_sequences, pf_db, blast_options):
+        # type: (str, str, str) -> str
+        """
+        :param pf_q_sequences: query sequences file
+        :param pf_db: blast database
+        :param blast_options: blast command, without anything that doesn't change the output (e.g. paths)
+        """
+        h = hashlib.sha256()
+        h.update("{};{}".format(BlastResultCache.VERSION, blast_options).encode("utf-8"))
+        h.update(BlastResultCache._hash_file(pf_q_sequences).encode("ascii"))
+        h.update(self._hash_database(pf_db).encode("ascii"))
+        return h.hexdigest()
+
+    def _get_path(self, key, outfmt):
+        # type: (str, str) -> str
+        return os.path.join(self._pd_cache, key[:2], "{}.{}".format(key, "npz" if outfmt == "tabular" else "xml.gz"))
+
+    def get(self, key, outfmt, pf_blast_output):
+        # type: (str, str, str) -> bool
+        """Write the cached output for key to pf_blast_output. Returns False if there is none."""
+
+        pf_entry = self._get_path(key, outfmt)
+        if not os.path.isfile(pf_entry):
+            self.num_misses += 1
+            return False
+
+        try:
+            if outfmt == "tabular":
+                read_tabular_hits_columnar(pf_entry, pf_blast_output)
+            else:
+                with gzip.open(pf_entry, "rb") as f_in, open(pf_blast_output, "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+        except (OSError, ValueError, KeyError):
+            logger.warning("Could not read blast cache entry: {}".format(pf_entry))
+            remove_p(pf_blast_output)
+            self.num_misses += 1
+            return False
+
+        self.num_hits += 1
+        return True
+
+    def put(self, key, outfmt, pf_blast_output):
+        # type: (str, str, str) -> None
+
+        pf_entry = self._get_path(key, outfmt)
+        mkdir_p(os.path.dirname(pf_entry))
+
+        # write then rename, so other processes never read a partial entry
+        pf_tmp = "{}.{}.tmp".format(pf_entry, os.getpid())
+        if outfmt == "tabular":
+            write_tabular_hits_columnar(pf_blast_output, pf_tmp)
+        else:
+            with open(pf_blast_output, "rb") as f_in, gzip.open(pf_tmp, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+
+        os.replace(pf_tmp, pf_entry)
+
+
+_blast_cache_instances = dict()  # type: Dict[str, BlastResultCache]
+
+
+def get_blast_cache(sbsp_options):
+    # type: (SBSPOptions) -> Union[BlastResultCache, None]
+    """Returns the blast cache set in the options, or None if caching is disabled"""
+
+    pd_cache = sbsp_options.safe_get("blast-cache-directory")
+    if pd_cache is None:
+        return None
+
+    if pd_cache not in _blast_cache_instances:
+        _blast_cache_instances[pd_cache] = BlastResultCache(pd_cache)
+
+    return _blast_cache_instances[pd_cache]
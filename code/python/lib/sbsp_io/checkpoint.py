@@ -0,0 +1,121 @@
+import os
+import json
+import logging
+from typing import *
+
+from sbsp_io.general import remove_p
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointManifest:
+    """Append-only record of the progress of a run, kept next to its output file, so that an interrupted
+    run can be resumed without redoing finished work. Each line is a JSON object, one of:
+
+        {"blast-output": path}                              blast finished and its output is complete
+        {"q-key": key, "row-begin": i, "row-end": j,        query done: its rows in the output file
+         "byte-end": n, "pf-msa": path}                     are [i, j), and the file is n bytes long
+        {"complete": true}                                  all queries done
+
+    A line is only written once the data it describes is on disk, so anything in the output file past
+    the last recorded byte-end belongs to an unfinished query, and is dropped on resume.
+    """
+
+    def __init__(self, pf_manifest, resume=False):
+        # type: (str, bool) -> None
+
+        self._pf_manifest = pf_manifest
+
+        self.pf_blast_output = None         # type: Union[str, None]
+        self.completed = dict()             # type: Dict[str, Dict[str, Any]]
+        self.is_complete = False
+        self.num_rows = 0
+        self.byte_end = 0
+
+        if resume and os.path.isfile(pf_manifest):
+            self._load()
+        else:
+            remove_p(pf_manifest)
+
+    def _load(self):
+        # type: () -> None
+        with open(self._pf_manifest, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break           # partially written line from an interrupted run
+
+                if "blast-output" in entry:
+                    self.pf_blast_output = entry["blast-output"]
+                elif "q-key" in entry:
+                    self.completed[entry["q-key"]] = entry
+                    self.num_rows = entry["row-end"]
+                    self.byte_end = entry["byte-end"]
+                elif entry.get("complete", False):
+                    self.is_complete = True
+
+        # drop anything after the last complete line
+        self._rewrite()
+
+        logger.info("Resuming from checkpoint: {} queries done".format(len(self.completed)))
+
+    def _rewrite(self):
+        # type: () -> None
+        with open(self._pf_manifest, "w") as f:
+            if self.pf_blast_output is not None:
+                f.write(json.dumps({"blast-output": self.pf_blast_output}) + "\n")
+            for entry in self.completed.values():
+                f.write(json.dumps(entry) + "\n")
+            if self.is_complete:
+                f.write(json.dumps({"complete": True}) + "\n")
+
+    def _append(self, entry):
+        # type: (Dict[str, Any]) -> None
+        with open(self._pf_manifest, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def truncate_output(self, pf_output):
+        # type: (str) -> None
+        """Remove rows written to the output file by queries that did not finish"""
+        if not os.path.isfile(pf_output):
+            return
+
+        if self.byte_end == 0:
+            remove_p(pf_output)
+        elif os.path.getsize(pf_output) > self.byte_end:
+            with open(pf_output, "r+") as f:
+                f.truncate(self.byte_end)
+
+    def is_query_done(self, q_key):
+        # type: (str) -> bool
+        return q_key in self.completed
+
+    def add_blast_output(self, pf_blast_output):
+        # type: (str) -> None
+        self.pf_blast_output = pf_blast_output
+        self._append({"blast-output": pf_blast_output})
+
+    def add_query(self, q_key, num_rows, pf_output, pf_msa=None):
+        # type: (str, int, str, Union[str, None]) -> None
+        """Record a query as done, after its rows have been appended to the output file"""
+
+        entry = {
+            "q-key": q_key,
+            "row-begin": self.num_rows,
+            "row-end": self.num_rows + num_rows,
+            "byte-end": os.path.getsize(pf_output) if os.path.isfile(pf_output) else 0,
+            "pf-msa": pf_msa
+        }
+
+        self.completed[q_key] = entry
+        self.num_rows = entry["row-end"]
+        self.byte_end = entry["byte-end"]
+        self._append(entry)
+
+    def mark_complete(self):
+        # type: () -> None
+        self.is_complete = True
+        self._append({"complete": True})
@@ -1,6 +1,8 @@
 from typing import *
 import copy
 
+import numpy as np
+
 import sbsp_alg.msa
 from sbsp_container.msa import MSAType
 from sbsp_options.sbsp import SBSPOptions
@@ -10,6 +12,9 @@ import Bio.SubsMat.MatrixInfo
 
 class ScoringMatrix:
 
+    # lookup tables are shared by all scorers with the same name and case handling
+    _lookup_tables = dict()  # type: Dict[Tuple[str, bool, int], np.ndarray]
+
     def __init__(self, name="identity", ignore_case=True):
         self._name = name
         self._ignore_case = ignore_case
@@ -71,6 +76,67 @@ class ScoringMatrix:
         b = b.upper() if self._ignore_case else b
         return self._scorer(a, b)
 
+    def lookup_table(self):
+        # type: () -> np.ndarray
+        """
+        Dense 256x256 table of scores, indexed by the byte values of both letters. Pairs
+        without a score (e.g. letters missing from blosum) are set to NaN.
+        """
+
+        # blosum matrices are extended in place (see extend_blosum), so their size is part of the key
+        key = (self._name, self._ignore_case, len(getattr(self, "_blosum_matrix", ())))
+
+        if key not in ScoringMatrix._lookup_tables:
+            table = np.full((256, 256), np.nan, dtype=float)
+            for a in range(128):
+                for b in range(128):
+                    try:
+                        table[a, b] = self.score(chr(a), chr(b))
+                    except KeyError:
+                        pass
+
+            ScoringMatrix._lookup_tables[key] = table
+
+        return ScoringMatrix._lookup_tables[key]
+
+    def score_column_all_pairs(self, column):
+        # type: (np.ndarray) -> float
+        """
+        Sum of scores over all pairs of letters in a column, computed from letter counts
+        in O(alphabet^2) rather than O(N^2)
+        :param column: uint8 array of letters
+        """
+
+        letters, counts = np.unique(column, return_counts=True)
+        sub_table = self.lookup_table()[np.ix_(letters, letters)]
+
+        # a letter is only paired with itself if it appears more than once
+        unknown = np.isnan(sub_table)
+        np.fill_diagonal(unknown, np.diag(unknown) & (counts > 1))
+        if unknown.any():
+            raise KeyError("Unknown letter pair in column")
+
+        sub_table = np.nan_to_num(sub_table)
+        counts = counts.astype(float)
+
+        # c'Sc counts every pair of sequences twice (scoring tables are symmetric), and
+        # each sequence once with itself
+        total = counts.dot(sub_table).dot(counts) - counts.dot(np.diag(sub_table))
+        return total / 2.0
+
+    def score_column_against_first(self, column):
+        # type: (np.ndarray) -> float
+        """
+        Sum of scores between the first letter of a column and each of the others
+        :param column: uint8 array of letters
+        """
+
+        scores = self.lookup_table()[column[0], column[1:]]
+        if np.isnan(scores).any():
+            raise KeyError("Unknown letter pair in column")
+
+        return float(scores.sum())
+
 
 def compute_upstream_score(msa_t, position, msa_options, **kwargs):
     # type: (MSAType, int, SBSPOptions, Dict[str, Any]) -> float
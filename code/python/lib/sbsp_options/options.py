@@ -70,6 +70,18 @@ class Options:
         # type: (str) -> None
         sbsp_io.general.write_string_to_file(self.to_string(), pf_options)
 
+    @classmethod
+    def init_from_complete_file(cls, env, pf_options):
+        # type: (Environment, str) -> TypeVar('T', bound=Options)
+        """Load options written by to_file, as they were: the file holds all options, so defaults are not
+        read again and requirements are not checked"""
+        options = cls.__new__(cls)
+        options.env = env.duplicate()
+        options._default_options = dict()
+        options._custom_options = Options.read_from_file(pf_options)
+        options._options = dict(options._custom_options or dict())
+        return options
+
     @abstractmethod
     def path_to_default_options_file(self, env):
         # type: (Environment) -> str
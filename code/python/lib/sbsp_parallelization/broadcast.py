@@ -0,0 +1,333 @@
+import os
+import shlex
+import hashlib
+import logging
+import threading
+import subprocess
+import timeit
+from typing import *
+
+from sbsp_general.general import get_value
+
+logger = logging.getLogger(__name__)
+
+# A file is broadcast as fixed-size chunks, each identified by its SHA-1 (as printed by sha1sum). Nodes
+# form a tree rooted at the source: every node receives chunks from its parent, in order, and its children
+# can copy a chunk as soon as it's verified, so chunks move down all levels of the tree at the same time.
+_MB = 1024 ** 2
+DEFAULT_CHUNK_SIZE = 64 * _MB
+
+
+class Node:
+    """A copy of the broadcast file, on some machine"""
+
+    def __init__(self, name, path):
+        # type: (str, str) -> None
+        self.name = name
+        self.path = path
+        self.host = None        # type: Union[str, None]
+
+    def __str__(self):
+        return self.name
+
+    def chunk_checksums(self, num_chunks, chunk_size):
+        # type: (int, int) -> List[str]
+        """Checksums of the first num_chunks chunks of the file on this node (chunks past its end are empty)"""
+        raise NotImplementedError()
+
+    def prepare(self, size):
+        # type: (int) -> None
+        """Create the file (and its directory) if needed, and set its size"""
+        raise NotImplementedError()
+
+    def read_chunk_command(self, index, chunk_size):
+        # type: (Union[int, str], int) -> str
+        """Shell command (run on this node) that writes a chunk to standard output"""
+        return "dd if={} bs={} skip={} count=1 2>/dev/null".format(shlex.quote(self.path), chunk_size, index)
+
+    def copy_chunk_from(self, sender, index, chunk_size):
+        # type: (Node, int, int) -> str
+        """
+        Copy a chunk from another node into this node's file
+        :return: checksum of the chunk, as read back from this node's file
+        """
+        raise NotImplementedError()
+
+
+class LocalNode(Node):
+    """A file on this machine, e.g. the source of a broadcast, or a directory standing in for a node"""
+
+    def __init__(self, path, name=None):
+        # type: (str, str) -> None
+        super(LocalNode, self).__init__(name if name is not None else path, path)
+
+    def _read_chunk(self, index, chunk_size):
+        # type: (int, int) -> bytes
+        with open(self.path, "rb") as f:
+            f.seek(index * chunk_size)
+            return f.read(chunk_size)
+
+    def chunk_checksums(self, num_chunks, chunk_size):
+        # type: (int, int) -> List[str]
+        if not os.path.isfile(self.path):
+            return list()
+
+        checksums = list()
+        with open(self.path, "rb") as f:
+            for _ in range(num_chunks):
+                checksums.append(hashlib.sha1(f.read(chunk_size)).hexdigest())
+        return checksums
+
+    def prepare(self, size):
+        # type: (int) -> None
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "ab"):
+            pass
+        os.truncate(self.path, size)
+
+    def copy_chunk_from(self, sender, index, chunk_size):
+        # type: (Node, int, int) -> str
+
+        if isinstance(sender, LocalNode):
+            data = sender._read_chunk(index, chunk_size)
+        else:
+            data = subprocess.check_output("ssh -o BatchMode=yes {} {}".format(
+                sender.host, shlex.quote(sender.read_chunk_command(index, chunk_size))
+            ), shell=True)
+
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            os.pwrite(fd, data, index * chunk_size)
+        finally:
+            os.close(fd)
+
+        return hashlib.sha1(self._read_chunk(index, chunk_size)).hexdigest()
+
+
+class SSHNode(Node):
+    """A file on another machine, reached with ssh (nodes must also be able to ssh to each other)"""
+
+    def __init__(self, host, path):
+        # type: (str, str) -> None
+        super(SSHNode, self).__init__(host, path)
+        self.host = host
+
+    def _run(self, cmd):
+        # type: (str) -> str
+        return subprocess.check_output(
+            "ssh -o BatchMode=yes {} {}".format(self.host, shlex.quote(cmd)), shell=True
+        ).decode("utf-8")
+
+    def chunk_checksums(self, num_chunks, chunk_size):
+        # type: (int, int) -> List[str]
+        output = self._run("for i in $(seq 0 {}); do {} | sha1sum; done".format(
+            num_chunks - 1, self.read_chunk_command("$i", chunk_size)
+        ))
+        return [line.split()[0] for line in output.strip().split("\n") if len(line.strip()) > 0]
+
+    def prepare(self, size):
+        # type: (int) -> None
+        path = shlex.quote(self.path)
+        self._run("mkdir -p {} && touch {} && truncate -s {} {}".format(
+            shlex.quote(os.path.dirname(self.path)), path, size, path
+        ))
+
+    def copy_chunk_from(self, sender, index, chunk_size):
+        # type: (Node, int, int) -> str
+
+        path = shlex.quote(self.path)
+        write_cmd = "dd of={} bs={} seek={} iflag=fullblock conv=notrunc 2>/dev/null && {} | sha1sum".format(
+            path, chunk_size, index, self.read_chunk_command(index, chunk_size)
+        )
+
+        cmd = "{} | ssh -o BatchMode=yes {} {}".format(
+            sender.read_chunk_command(index, chunk_size), self.host, shlex.quote(write_cmd)
+        )
+        if sender.host is not None:
+            # the chunk goes straight from the sender to this node
+            cmd = "ssh -o BatchMode=yes {} {}".format(sender.host, shlex.quote(cmd))
+
+        return subprocess.check_output(cmd, shell=True).decode("utf-8").split()[0]
+
+
+class NodeTransferStats:
+    """What was copied to a node"""
+
+    def __init__(self, node):
+        # type: (Node) -> None
+        self.node = node
+        self.parent = None              # type: Union[Node, None]
+        self.chunks_skipped = 0         # already identical on the node
+        self.chunks_copied = 0
+        self.bytes_copied = 0
+        self.seconds = 0.0
+        self.error = None               # type: Union[str, None]
+
+    def __str__(self):
+        if self.error is not None:
+            return "{}: failed ({})".format(self.node, self.error)
+        if self.chunks_copied == 0:
+            return "{}: identical copy, skipped".format(self.node)
+        return "{}: {} chunks ({:.1f} MB) from {} in {:.1f} s, {} chunks already identical".format(
+            self.node, self.chunks_copied, self.bytes_copied / float(_MB), self.parent, self.seconds,
+            self.chunks_skipped
+        )
+
+
+class BroadcastReport:
+    """Outcome of a broadcast: per node statistics, and aggregate throughput"""
+
+    def __init__(self, size, num_chunks, list_stats, seconds):
+        # type: (int, int, List[NodeTransferStats], float) -> None
+        self.size = size
+        self.num_chunks = num_chunks
+        self.list_stats = list_stats
+        self.seconds = seconds
+
+    def bytes_copied(self):
+        # type: () -> int
+        return sum(s.bytes_copied for s in self.list_stats)
+
+    def failed_nodes(self):
+        # type: () -> List[Node]
+        return [s.node for s in self.list_stats if s.error is not None]
+
+    def __str__(self):
+        num_skipped = sum(1 for s in self.list_stats if s.error is None and s.chunks_copied == 0)
+        return "{:.1f} MB ({} chunks) to {} nodes ({} already identical, {} failed): {:.1f} MB copied in " \
+               "{:.1f} s, {:.1f} MB/s aggregate".format(
+                self.size / float(_MB), self.num_chunks, len(self.list_stats), num_skipped,
+                len(self.failed_nodes()), self.bytes_copied() / float(_MB), self.seconds,
+                self.bytes_copied() / float(_MB) / max(self.seconds, 1e-9)
+                )
+
+    def to_string(self):
+        # type: () -> str
+        return "\n".join([str(s) for s in self.list_stats] + [str(self)])
+
+
+class _BroadcastState:
+    """Chunks held by each node (shared by the threads copying to nodes)"""
+
+    def __init__(self, source, num_chunks):
+        # type: (Node, int) -> None
+        self.condition = threading.Condition()
+        self.available = {source: set(range(num_chunks))}      # type: Dict[Node, Set[int]]
+        self.failed = set()                                     # type: Set[Node]
+
+    def add(self, node, chunks):
+        # type: (Node, Iterable[int]) -> None
+        with self.condition:
+            self.available.setdefault(node, set()).update(chunks)
+            self.condition.notify_all()
+
+    def fail(self, node):
+        # type: (Node) -> None
+        with self.condition:
+            self.failed.add(node)
+            self.condition.notify_all()
+
+
+def build_broadcast_tree(source, receivers, fanout):
+    # type: (Node, List[Node], int) -> Dict[Node, Node]
+    """Parent of each receiver in a tree rooted at the source, where every node has up to fanout children"""
+    all_nodes = [source] + list(receivers)
+    return {node: all_nodes[k // fanout] for k, node in enumerate(receivers)}
+
+
+def _copy_to_node(node, parents, state, checksums, size, chunk_size, num_retries, stats):
+    # type: (Node, Dict[Node, Node], _BroadcastState, List[str], int, int, int, NodeTransferStats) -> None
+
+    num_chunks = len(checksums)
+    start_time = timeit.default_timer()
+
+    try:
+        # chunks the node already has don't need to be copied (e.g. identical copy, or an interrupted broadcast)
+        existing = node.chunk_checksums(num_chunks, chunk_size)
+        node.prepare(size)
+        identical = {i for i, c in enumerate(existing[:num_chunks]) if c == checksums[i]}
+        stats.chunks_skipped = len(identical)
+        state.add(node, identical)
+
+        for index in range(num_chunks):
+            if index in identical:
+                continue
+
+            for attempt in range(num_retries + 1):
+                # wait for the chunk on the closest ancestor that hasn't failed
+                with state.condition:
+                    while True:
+                        parent = parents[node]
+                        while parent in state.failed:
+                            parent = parents[parent]
+                        if index in state.available.get(parent, set()):
+                            break
+                        state.condition.wait()
+
+                stats.parent = parent
+                try:
+                    if node.copy_chunk_from(parent, index, chunk_size) == checksums[index]:
+                        break
+                    logger.warning("Chunk {} on {} doesn't match its checksum (attempt {})".format(
+                        index, node, attempt + 1
+                    ))
+                except subprocess.CalledProcessError as e:
+                    logger.warning("Could not copy chunk {} to {} (attempt {}): {}".format(
+                        index, node, attempt + 1, e
+                    ))
+            else:
+                raise ValueError("chunk {} could not be copied".format(index))
+
+            stats.chunks_copied += 1
+            stats.bytes_copied += min(chunk_size, size - index * chunk_size)
+            state.add(node, [index])
+
+    except Exception as e:      # children wait on this node: any error must mark it as failed
+        stats.error = str(e)
+        state.fail(node)
+        logger.warning("Broadcast to {} failed: {}".format(node, e))
+
+    stats.seconds = timeit.default_timer() - start_time
+
+
+def broadcast_file(source, receivers, **kwargs):
+    # type: (Node, List[Node], Dict[str, Any]) -> BroadcastReport
+    """
+    Copy a file to all receivers, along a tree rooted at the source. The file is split into chunks, each
+    verified by its checksum once written; children copy chunks from their parent as soon as the parent
+    has them. Chunks already identical on a receiver are not copied, and receivers whose parent fails
+    copy from the closest ancestor that hasn't.
+    :param kwargs:
+        - chunk_size: size of chunks in bytes (default 64 MB)
+        - fanout: maximum number of children of a node (default 2)
+        - num_retries: number of times a chunk that doesn't match its checksum is copied again (default 3)
+    """
+
+    chunk_size = get_value(kwargs, "chunk_size", DEFAULT_CHUNK_SIZE, default_if_none=True)
+    fanout = get_value(kwargs, "fanout", 2, default_if_none=True)
+    num_retries = get_value(kwargs, "num_retries", 3, default_if_none=True)
+
+    start_time = timeit.default_timer()
+
+    size = os.path.getsize(source.path)
+    num_chunks = (size + chunk_size - 1) // chunk_size
+    checksums = source.chunk_checksums(num_chunks, chunk_size)
+
+    parents = build_broadcast_tree(source, receivers, fanout)
+    state = _BroadcastState(source, num_chunks)
+    list_stats = [NodeTransferStats(node) for node in receivers]
+
+    threads = [
+        threading.Thread(target=_copy_to_node, args=(
+            node, parents, state, checksums, size, chunk_size, num_retries, stats
+        ))
+        for node, stats in zip(receivers, list_stats)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    report = BroadcastReport(size, num_chunks, list_stats, timeit.default_timer() - start_time)
+    logger.info("Broadcast: {}".format(report))
+    return report
@@ -0,0 +1,354 @@
+import os
+import sys
+import time
+import logging
+import subprocess
+from multiprocessing.pool import ThreadPool
+from typing import *
+
+from sbsp_general import Environment
+from sbsp_general.blast_planner import get_available_cpus
+from sbsp_general.general import run_shell_cmd, except_if_not_in_set
+from sbsp_io.general import mkdir_p, write_string_to_file
+from sbsp_options.parallelization import ParallelizationOptions
+from sbsp_parallelization.job_planner import get_max_concurrent_jobs
+
+logger = logging.getLogger(__name__)
+
+# placeholder for the job number in file templates; each executor replaces it by its own array variable
+ARRAY_ID = "${PBS_ARRAYID}"
+
+
+def create_concrete_from_template(pf_template, file_number):
+    # type: (str, int) -> str
+    """Replace the job number placeholder in a file template, e.g. filename_${PBS_ARRAYID}.txt -> filename_5.txt"""
+    return pf_template.replace(ARRAY_ID, str(file_number))
+
+
+class Executor:
+    """
+    Runs an array of jobs, numbered from 1, each calling run-pbs-job.py on one input package and writing
+    one output package. run yields the number of each job once it has ended, whether or not it succeeded:
+    jobs that failed have no output package.
+    """
+
+    def __init__(self, env, prl_options):
+        # type: (Environment, ParallelizationOptions) -> None
+        self._env = env
+        self._prl_options = prl_options
+
+    def run(self, job_name, num_jobs, pf_input_package_template, pf_output_package_template, dry_run=False):
+        # type: (str, int, str, str, bool) -> Iterator[int]
+        raise NotImplementedError()
+
+    def _get_pd_job_template(self, array_id):
+        # type: (str) -> str
+        pd_compute = os.path.abspath(os.path.join(self._prl_options["pbs-pd-root-compute"],
+                                                  self._prl_options["pbs-dn-compute"]))
+        return os.path.join(pd_compute, "job_{}".format(array_id))
+
+    def _get_pd_logs(self):
+        # type: () -> str
+        pd_pbs_logs = os.path.join(self._prl_options["pbs-pd-head"], "pbs_logs")
+        mkdir_p(pd_pbs_logs)
+        return pd_pbs_logs
+
+    def _generate_call_command(self, pf_job_input, pf_job_output, pd_job, python="python"):
+        # type: (str, str, str, str) -> str
+        return "{} --pf-job-input {} --pf-job-output {} --pd-work {} -l {}".format(
+            "{} {}".format(python, os.path.join(self._env["pd-code"], "python/driver", "run-pbs-job.py")),
+            pf_job_input,
+            pf_job_output,
+            pd_job,
+            logging.getLevelName(logger.getEffectiveLevel())
+        )
+
+
+class PBSExecutor(Executor):
+    """Submits jobs as a PBS array (qsub), and waits for the array to leave the queue"""
+
+    def run(self, job_name, num_jobs, pf_input_package_template, pf_output_package_template, dry_run=False):
+        # type: (str, int, str, str, bool) -> Iterator[int]
+
+        pf_pbs = os.path.join(self._prl_options["pbs-pd-head"], "run.pbs")
+        self._create_pbs_file(job_name, num_jobs, pf_pbs, pf_input_package_template, pf_output_package_template)
+
+        if dry_run:
+            return
+
+        array_job_id = PBSExecutor._qsub(pf_pbs)
+        for job_number in self._wait_for_job_array(array_job_id, num_jobs, pf_output_package_template):
+            yield job_number
+
+    @staticmethod
+    def _qsub(pf_pbs):
+        # type: (str) -> str
+        return run_shell_cmd("qsub  -V " + pf_pbs, do_not_log=True).strip()
+
+    def _create_pbs_file(self, job_name, num_jobs, pf_pbs, pf_input_package_template, pf_output_package_template):
+        # type: (str, int, str, str, str) -> None
+
+        pd_job_template = self._get_pd_job_template(ARRAY_ID)
+
+        pbs_text = self._generate_pbs_header_array(num_jobs, job_name, pd_job_template)
+        pbs_text += "\n{}\n".format(self._generate_call_command(
+            pf_input_package_template, pf_output_package_template, pd_job_template
+        ))
+
+        write_string_to_file(pbs_text, pf_pbs)
+
+    def _generate_pbs_header_array(self, num_jobs, job_name, pd_job_template):
+        # type: (int, str, str) -> str
+
+        prl_options = self._prl_options
+
+        num_nodes = prl_options["pbs-nodes"]
+        ppn = prl_options["pbs-ppn"]
+        walltime = prl_options["pbs-walltime"]
+
+        pd_pbs_logs = self._get_pd_logs()
+
+        node_property = prl_options.safe_get("pbs-node-property")
+        if node_property is not None:
+            node_property = ":" + node_property
+        else:
+            node_property = ""
+
+        pbs_text = ""
+
+        pbs_text += "#PBS -N " + str(job_name) + "\n"
+        pbs_text += "#PBS -o " + "{}/{}".format(pd_pbs_logs, "error_${PBS_ARRAYID}") + "\n"
+        pbs_text += "#PBS -j oe" + "\n"
+        pbs_text += "#PBS -l nodes=" + str(num_nodes) + ":ppn=" + str(ppn) + "{}\n".format(node_property)
+        pbs_text += "#PBS -l walltime=" + str(walltime) + "\n"
+
+        array_param = "1-{}".format(num_jobs)
+        total_concurrent_jobs = get_max_concurrent_jobs(prl_options)
+        if total_concurrent_jobs is not None:
+            array_param = "{}%{}".format(array_param, total_concurrent_jobs)
+
+        pbs_text += "#PBS -t {}".format(array_param) + "\n"
+
+        pbs_text += "#PBS -W umask=002" + "\n"
+
+        pbs_text += "export PATH=\"/home/karl/anaconda/envs/biogem_sbsp/bin:$PATH\"\n"
+
+        pbs_text += "mkdir -p {}".format(pd_job_template) + "\n"
+
+        pbs_text += "PBS_O_WORKDIR=" + pd_job_template + "\n"
+        pbs_text += "cd $PBS_O_WORKDIR \n"
+
+        pbs_text += "echo The working directory is `echo $PBS_O_WORKDIR`" + "\n"
+        pbs_text += "echo This job runs on the following nodes:" + "\n"
+        pbs_text += "echo `cat $PBS_NODEFILE`" + "\n"
+
+        return pbs_text
+
+    @staticmethod
+    def _count_active_jobs(array_job_id):
+        # type: (str) -> Union[int, None]
+        """
+        Number of jobs of the array that are queued or running (i.e. not completed), or None if the
+        scheduler could not be queried (e.g. a transient qstat error)
+        """
+
+        # array job IDs look like 1234[].server, and their jobs like 1234[5].server
+        prefix = array_job_id.split("[")[0] + "["
+
+        process = subprocess.run("qstat -t {}".format(array_job_id), shell=True,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            stderr = process.stderr.decode("utf-8", errors="replace")
+            if "Unknown Job Id" in stderr:
+                return 0        # no longer known to the scheduler
+
+            logger.warning("Could not query jobs of {} (qstat exit code {}): {}".format(
+                array_job_id, process.returncode, stderr.strip()
+            ))
+            return None
+
+        num_active = 0
+        for line in process.stdout.decode("utf-8").splitlines():
+            fields = line.split()
+            if len(fields) >= 5 and fields[0].startswith(prefix) and fields[4] != "C":
+                num_active += 1
+
+        return num_active
+
+    def _wait_for_job_array(self, array_job_id, num_jobs, pf_output_package_template):
+        # type: (str, int, str) -> Iterator[int]
+        """
+        Wait until all jobs of the array have left the queue, or written their output packages, yielding
+        each job as its output package appears. The scheduler is first queried after a few seconds, then
+        less and less often (and retried that way if qstat fails).
+        """
+
+        pending = set(range(1, num_jobs + 1))
+
+        delay = 2
+        while len(pending) > 0:
+            time.sleep(delay)
+
+            for x in sorted(pending):
+                if os.path.isfile(create_concrete_from_template(pf_output_package_template + ".pkl", x)):
+                    pending.remove(x)
+                    yield x
+
+            if len(pending) > 0 and PBSExecutor._count_active_jobs(array_job_id) == 0:
+                break
+
+            delay = min(60, delay * 2)
+
+        # jobs that ended without output
+        if len(pending) > 0:
+            logger.warning("Jobs of {} that ended without output: {}".format(
+                array_job_id, " ".join(str(x) for x in sorted(pending))
+            ))
+        for x in sorted(pending):
+            yield x
+
+
+class SlurmExecutor(Executor):
+    """Submits jobs as a Slurm array (sbatch), and blocks until Slurm reports that all of them ended"""
+
+    ARRAY_VARIABLE = "${SLURM_ARRAY_TASK_ID}"
+
+    def run(self, job_name, num_jobs, pf_input_package_template, pf_output_package_template, dry_run=False):
+        # type: (str, int, str, str, bool) -> Iterator[int]
+
+        pd_job_template = self._get_pd_job_template(SlurmExecutor.ARRAY_VARIABLE)
+
+        pf_sbatch = os.path.join(self._prl_options["pbs-pd-head"], "run.sbatch")
+        sbatch_text = self._generate_sbatch_header_array(num_jobs, job_name, pd_job_template)
+        sbatch_text += "\n{}\n".format(self._generate_call_command(
+            pf_input_package_template.replace(ARRAY_ID, SlurmExecutor.ARRAY_VARIABLE),
+            pf_output_package_template.replace(ARRAY_ID, SlurmExecutor.ARRAY_VARIABLE),
+            pd_job_template
+        ))
+        write_string_to_file(sbatch_text, pf_sbatch)
+
+        if dry_run:
+            return
+
+        # --wait: sbatch returns when all jobs of the array have ended (non-zero exit if any failed)
+        try:
+            run_shell_cmd("sbatch --wait --parsable {}".format(pf_sbatch), do_not_log=True)
+        except subprocess.CalledProcessError as e:
+            logger.warning("Some jobs of array {} failed (exit code {})".format(job_name, e.returncode))
+
+        for x in range(1, num_jobs + 1):
+            yield x
+
+    @staticmethod
+    def _convert_walltime(walltime):
+        # type: (str) -> str
+        """PBS walltimes can include days (dd:hh:mm:ss); Slurm expects days-hh:mm:ss"""
+        fields = str(walltime).split(":")
+        if len(fields) == 4:
+            return "{}-{}".format(fields[0], ":".join(fields[1:]))
+        return str(walltime)
+
+    def _generate_sbatch_header_array(self, num_jobs, job_name, pd_job_template):
+        # type: (int, str, str) -> str
+
+        prl_options = self._prl_options
+        ppn = prl_options["pbs-ppn"]
+
+        array_param = "1-{}".format(num_jobs)
+        total_concurrent_jobs = get_max_concurrent_jobs(prl_options)
+        if total_concurrent_jobs is not None:
+            array_param = "{}%{}".format(array_param, total_concurrent_jobs)
+
+        sbatch_text = "#!/bin/bash\n"
+        sbatch_text += "#SBATCH -J {}\n".format(job_name)
+        sbatch_text += "#SBATCH -o {}/error_%a\n".format(self._get_pd_logs())
+        sbatch_text += "#SBATCH -N {}\n".format(prl_options["pbs-nodes"])
+        sbatch_text += "#SBATCH --cpus-per-task={}\n".format(ppn)
+        sbatch_text += "#SBATCH -t {}\n".format(SlurmExecutor._convert_walltime(prl_options["pbs-walltime"]))
+        sbatch_text += "#SBATCH --array={}\n".format(array_param)
+
+        node_property = prl_options.safe_get("pbs-node-property")
+        if node_property is not None:
+            sbatch_text += "#SBATCH --constraint={}\n".format(node_property)
+
+        sbatch_text += "umask 002\n"
+        sbatch_text += "mkdir -p {}\n".format(pd_job_template)
+        sbatch_text += "cd {}\n".format(pd_job_template)
+
+        return sbatch_text
+
+
+class LocalExecutor(Executor):
+    """
+    Runs jobs as processes on this machine, a few at a time. Completion is known as soon as a process
+    exits, so small runs and tests don't wait on a scheduler.
+    """
+
+    def _get_num_concurrent_jobs(self):
+        # type: () -> int
+        num_jobs = self._prl_options.safe_get("pbs-local-concurrent-jobs")
+        if num_jobs is None:
+            num_jobs = max(1, get_available_cpus() // self._prl_options["pbs-ppn"])
+        return num_jobs
+
+    def _run_job(self, job_number, pf_input_package_template, pf_output_package_template):
+        # type: (int, str, str) -> Tuple[int, int]
+
+        pd_job = self._get_pd_job_template(job_number)
+        mkdir_p(pd_job)
+
+        cmd = self._generate_call_command(
+            create_concrete_from_template(pf_input_package_template, job_number),
+            create_concrete_from_template(pf_output_package_template, job_number),
+            pd_job,
+            python=sys.executable
+        )
+
+        pf_log = os.path.join(self._get_pd_logs(), "error_{}".format(job_number))
+        with open(pf_log, "w") as f_log:
+            return_code = subprocess.call(cmd, shell=True, cwd=pd_job, stdout=f_log, stderr=subprocess.STDOUT)
+
+        return job_number, return_code
+
+    def run(self, job_name, num_jobs, pf_input_package_template, pf_output_package_template, dry_run=False):
+        # type: (str, int, str, str, bool) -> Iterator[int]
+
+        if dry_run:
+            return
+
+        num_concurrent = min(num_jobs, self._get_num_concurrent_jobs())
+        logger.info("Running {} jobs of {} locally, {} at a time".format(num_jobs, job_name, num_concurrent))
+
+        pool = ThreadPool(num_concurrent)
+        try:
+            for job_number, return_code in pool.imap_unordered(
+                    lambda x: self._run_job(x, pf_input_package_template, pf_output_package_template),
+                    range(1, num_jobs + 1)
+            ):
+                if return_code != 0:
+                    logger.warning("Job {} of {} failed (exit code {})".format(job_number, job_name, return_code))
+                else:
+                    logger.debug("Job {} of {} done".format(job_number, job_name))
+
+                yield job_number
+        finally:
+            pool.close()
+            pool.join()
+
+
+def get_executor(env, prl_options):
+    # type: (Environment, ParallelizationOptions) -> Executor
+    """Returns the executor set in the options (pbs-executor)"""
+
+    name_to_executor = {
+        "pbs": PBSExecutor,
+        "slurm": SlurmExecutor,
+        "local": LocalExecutor,
+    }
+
+    name = prl_options.safe_get("pbs-executor")
+    if name is None:
+        name = "pbs"
+
+    except_if_not_in_set(name, name_to_executor.keys())
+    return name_to_executor[name](env, prl_options)
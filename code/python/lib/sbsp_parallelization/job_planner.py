@@ -0,0 +1,242 @@
+import os
+import json
+import math
+import logging
+import threading
+from typing import *
+
+from sbsp_general import Environment
+from sbsp_io.general import mkdir_p, write_string_to_file
+from sbsp_options.parallelization import ParallelizationOptions
+
+logger = logging.getLogger(__name__)
+
+# Jobs are sized from the estimated cost of their data (e.g. estimate_query_cost) and the rate at which a
+# job gets through that cost. The rate is set with pbs-cost-per-second, or measured from earlier jobs
+# running the same function with the same number of processors (see JobHistory).
+_DEFAULT_TARGET_WALLTIME_FRACTION = 0.5     # longest run time planned for a job, as a fraction of pbs-walltime
+
+
+def walltime_to_seconds(walltime):
+    # type: (Union[str, int, float]) -> float
+    """Convert a walltime written as [[dd:]hh:]mm:ss (or a number of seconds) to seconds"""
+    if isinstance(walltime, (int, float)):
+        return float(walltime)
+
+    seconds = 0.0
+    for field, multiplier in zip(reversed(str(walltime).split(":")), [1, 60, 3600, 86400]):
+        seconds += float(field) * multiplier
+    return seconds
+
+
+def seconds_to_walltime(seconds):
+    # type: (float) -> str
+    seconds = int(math.ceil(seconds))
+    return "{:02d}:{:02d}:{:02d}:{:02d}".format(
+        seconds // 86400, (seconds % 86400) // 3600, (seconds % 3600) // 60, seconds % 60
+    )
+
+
+def get_max_concurrent_jobs(prl_options):
+    # type: (ParallelizationOptions) -> Union[int, None]
+    """Number of jobs that can run at the same time under pbs-concurrent-nodes (None if not capped)"""
+    if not prl_options.safe_get("pbs-concurrent-nodes"):
+        return None
+    return prl_options["pbs-concurrent-nodes"] * max(1, int(8 / prl_options["pbs-ppn"]))
+
+
+def get_function_name(func):
+    # type: (Callable) -> str
+    return "{}.{}".format(getattr(func, "__module__", ""), getattr(func, "__qualname__", str(func)))
+
+
+class JobHistory:
+    """Estimated cost and measured run time of earlier jobs, per function, kept in a file"""
+
+    MAX_JOBS = 100
+    _lock = threading.Lock()        # runs in threads of one process (e.g. genomes) record jobs one at a time
+
+    def __init__(self, pf_history):
+        # type: (str) -> None
+
+        self._pf_history = pf_history
+        self.jobs = self._read()
+
+    def _read(self):
+        # type: () -> Dict[str, List[Dict[str, Any]]]
+        try:
+            with open(self._pf_history, "r") as f:
+                return json.load(f)["jobs"]
+        except (OSError, ValueError, KeyError):
+            return dict()
+
+    @staticmethod
+    def default_path(env, prl_options):
+        # type: (Environment, ParallelizationOptions) -> str
+        pf_history = prl_options.safe_get("pbs-pf-job-history")
+        if pf_history is None:
+            pf_history = os.path.join(env["pd-runs"], "pbs_job_history.json")
+        return pf_history
+
+    def get_cost_per_second(self, func_name, ppn):
+        # type: (str, int) -> Union[float, None]
+        """Total cost over total run time of recorded jobs, or None if there are none"""
+        jobs = [j for j in self.jobs.get(func_name, list()) if j["ppn"] == ppn and j["seconds"] > 0]
+        total_seconds = sum(j["seconds"] for j in jobs)
+        if total_seconds == 0:
+            return None
+        return sum(j["cost"] for j in jobs) / total_seconds
+
+    def add_jobs(self, func_name, ppn, list_cost_seconds):
+        # type: (str, int, List[Tuple[float, float]]) -> None
+
+        if len(list_cost_seconds) == 0:
+            return
+
+        with JobHistory._lock:
+            # other runs may have recorded jobs since this history was read
+            self.jobs = self._read()
+
+            jobs = self.jobs.get(func_name, list())
+            jobs += [{"ppn": ppn, "cost": c, "seconds": round(s, 3)} for c, s in list_cost_seconds]
+            self.jobs[func_name] = jobs[-JobHistory.MAX_JOBS:]
+
+            # write then rename, so that runs reading the history never see it partially written
+            pf_tmp = "{}.{}.{}.tmp".format(self._pf_history, os.getpid(), threading.get_ident())
+            try:
+                mkdir_p(os.path.dirname(os.path.abspath(self._pf_history)))
+                with open(pf_tmp, "w") as f:
+                    json.dump({"jobs": self.jobs}, f, indent=1)
+                os.replace(pf_tmp, self._pf_history)
+            except OSError:
+                logger.debug("Could not record job run times in {}".format(self._pf_history))
+
+
+class JobPlan:
+    """How data is split into jobs: the estimated cost of each job, and (if known) how long it should take"""
+
+    def __init__(self, job_costs, job_sizes, cost_per_second, walltime, max_concurrent_jobs):
+        # type: (List[float], List[int], Union[float, None], float, Union[int, None]) -> None
+        self.job_costs = job_costs
+        self.job_sizes = job_sizes                      # number of entries per job
+        self.cost_per_second = cost_per_second
+        self.walltime = walltime                        # seconds
+        self.max_concurrent_jobs = max_concurrent_jobs
+
+    def estimated_seconds(self, cost):
+        # type: (float) -> Union[float, None]
+        return cost / self.cost_per_second if self.cost_per_second else None
+
+    def estimated_total_seconds(self):
+        # type: () -> Union[float, None]
+        """Estimated time until all jobs end, if jobs start as slots free up (longest first)"""
+        if not self.cost_per_second or len(self.job_costs) == 0:
+            return None
+        num_slots = self.max_concurrent_jobs or len(self.job_costs)
+        slots = [0.0] * min(num_slots, len(self.job_costs))
+        for cost in sorted(self.job_costs, reverse=True):
+            slots[slots.index(min(slots))] += self.estimated_seconds(cost)
+        return max(slots)
+
+    def __str__(self):
+        text = "{} jobs, {} entries, estimated cost {:.4g} (largest job {:.4g})".format(
+            len(self.job_costs), sum(self.job_sizes), sum(self.job_costs), max(self.job_costs, default=0)
+        )
+        if self.cost_per_second:
+            text += ", largest job {} and all jobs {} (walltime {})".format(
+                seconds_to_walltime(self.estimated_seconds(max(self.job_costs, default=0))),
+                seconds_to_walltime(self.estimated_total_seconds()), seconds_to_walltime(self.walltime)
+            )
+        if self.max_concurrent_jobs is not None:
+            text += ", {} at a time".format(self.max_concurrent_jobs)
+        return text
+
+    def to_string(self):
+        # type: () -> str
+        """Report with one line per job"""
+        text = "# {}\n".format(self)
+        text += "job\tentries\testimated-cost\testimated-time\n"
+        for i, (cost, size) in enumerate(zip(self.job_costs, self.job_sizes)):
+            seconds = self.estimated_seconds(cost)
+            text += "{}\t{}\t{:.4g}\t{}\n".format(
+                i + 1, size, cost, seconds_to_walltime(seconds) if seconds is not None else "NA"
+            )
+        return text
+
+    def to_file(self, pf_plan):
+        # type: (str) -> None
+        write_string_to_file(self.to_string(), pf_plan)
+
+
+def get_cost_per_second(env, prl_options, func):
+    # type: (Environment, ParallelizationOptions, Callable) -> Union[float, None]
+    """Cost a job gets through per second: from pbs-cost-per-second, or else measured by earlier jobs"""
+    cost_per_second = prl_options.safe_get("pbs-cost-per-second")
+    if cost_per_second is None:
+        cost_per_second = JobHistory(JobHistory.default_path(env, prl_options)).get_cost_per_second(
+            get_function_name(func), prl_options["pbs-ppn"]
+        )
+    return cost_per_second
+
+
+def get_target_walltime(prl_options):
+    # type: (ParallelizationOptions) -> float
+    """Longest run time planned for a job, in seconds"""
+    target = prl_options.safe_get("pbs-target-walltime")
+    if target is not None:
+        return walltime_to_seconds(target)
+    return _DEFAULT_TARGET_WALLTIME_FRACTION * walltime_to_seconds(prl_options["pbs-walltime"])
+
+
+def plan_num_jobs(costs, cost_per_second, prl_options):
+    # type: (Union[Dict[Any, float], None], Union[float, None], ParallelizationOptions) -> int
+    """
+    Choose the number of jobs (for pbs-jobs: auto): one per slot that can run at the same time (see
+    pbs-concurrent-nodes), and more if needed for data with estimated costs and a known rate, so that each
+    job ends within the target walltime (jobs beyond pbs-concurrent-nodes run in waves). Never more jobs
+    than entries.
+    """
+
+    max_concurrent_jobs = get_max_concurrent_jobs(prl_options)
+
+    if costs is None:
+        costs = dict()
+        cost_per_second = None
+
+    if cost_per_second:
+        # fill free slots first: the target walltime is an upper bound per job, not a size to pack jobs up to
+        cost_per_job = cost_per_second * get_target_walltime(prl_options)
+        num_slots = max_concurrent_jobs or 1
+        if len(costs) > 0:
+            num_slots = min(num_slots, len(costs))
+        num_jobs = max(int(math.ceil(sum(costs.values()) / cost_per_job)), num_slots)
+    elif max_concurrent_jobs is not None:
+        logger.warning("Job run times are unknown (see pbs-cost-per-second): using one job per slot")
+        num_jobs = max_concurrent_jobs
+    else:
+        raise ValueError("pbs-jobs: auto needs pbs-cost-per-second, earlier runs, or pbs-concurrent-nodes")
+
+    if len(costs) > 0:
+        num_jobs = min(num_jobs, len(costs))
+    return max(1, num_jobs)
+
+
+def create_job_plan(list_split_data, costs, cost_per_second, prl_options):
+    # type: (List[Dict[str, Any]], Dict[Any, float], Union[float, None], ParallelizationOptions) -> JobPlan
+    """Plan of split data, whose entries (under "data") have estimated costs"""
+
+    job_costs = list()
+    job_sizes = list()
+    for split in list_split_data:
+        entries = split.get("data", dict())
+        job_costs.append(float(sum(costs.get(k, 0) for k in entries)))
+        job_sizes.append(len(entries))
+
+    plan = JobPlan(job_costs, job_sizes, cost_per_second, walltime_to_seconds(prl_options["pbs-walltime"]),
+                   get_max_concurrent_jobs(prl_options))
+
+    logger.info("Job plan: {}".format(plan))
+    if cost_per_second and plan.estimated_seconds(max(job_costs, default=0)) > plan.walltime:
+        logger.warning("The largest job is expected to run longer than pbs-walltime")
+
+    return plan
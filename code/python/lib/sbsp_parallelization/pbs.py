@@ -7,32 +7,22 @@ from typing import *
 import logging
 
 from sbsp_general import Environment
-from sbsp_io.general import mkdir_p, write_string_to_file
+from sbsp_io.general import mkdir_p, write_string_to_file, remove_p
 from sbsp_options.parallelization import ParallelizationOptions
 
-from sbsp_general.general import get_value, run_shell_cmd
+from sbsp_general.general import get_value
 import sbsp_io.general
+from sbsp_parallelization.executors import get_executor, create_concrete_from_template, ARRAY_ID
 from sbsp_parallelization.pbs_job_package import PBSJobPackage
+from sbsp_parallelization.job_planner import JobHistory, get_cost_per_second, plan_num_jobs, create_job_plan, \
+    get_function_name
 
 logger = logging.getLogger(__name__)
 
 
-class FunctionArguments:
-
-    def __init__(self, **kwargs):
-
-        self._kwargs = kwargs
-
-    def get_arguments(self, data):
-        # type: (Dict[str, Any]) -> Dict[str, Any]
-        new_kwargs = copy.deepcopy(self._kwargs)
-        new_kwargs.update(data)
-
-        return new_kwargs
-
-
 class PBS:
-    """Runs any function on input data using PBS scheduler"""
+    """Runs any function on input data as an array of jobs, submitted to PBS or to another executor
+    (see pbs-executor in the parallelization options)"""
 
     def __init__(self, env, prl_options, splitter, merger, **kwargs):
         # type: (Environment, ParallelizationOptions, Callable, Callable, Dict[str, Any]) -> None
@@ -55,6 +45,11 @@ class PBS:
         self._prl_options = copy.deepcopy(prl_options)
         self._splitter = splitter
         self._merger = merger
+        self._executor = get_executor(env, self._prl_options)
+
+        # set when packages are created: function name and estimated cost of each job (if known)
+        self._func_name = None          # type: Union[str, None]
+        self._job_costs = None          # type: Union[List[float], None]
 
     def _setup_pbs_run(self):
         mkdir_p(self._prl_options["pbs-pd-head"])
@@ -80,6 +75,13 @@ class PBS:
         # 1) Parse all PBS arguments
         self._setup_pbs_run()
 
+        if num_jobs == "auto":
+            costs = get_value(data, "costs", None)
+            cost_per_second = None
+            if costs is not None:
+                cost_per_second = get_cost_per_second(self._env, self._prl_options, func)
+            num_jobs = plan_num_jobs(costs, cost_per_second, self._prl_options)
+
         # 2) Create input packages files, one for every PBS run
         list_pf_input_job = self.create_input_package_files(
             data, func, func_kwargs, num_jobs,
@@ -89,16 +91,19 @@ class PBS:
 
         num_jobs = len(list_pf_input_job)
 
-        # 3) Run all
-        list_pf_output_job_packages = self.execute_function_on_input_packages(
+        # 3) Run all, and 4) merge end-results as jobs end
+        output_data = self.execute_function_on_input_packages(
             pf_input_package_template_formatted,
             job_name=job_name, num_jobs=num_jobs
         )
 
-        # 4) Merge end-results
         data_output = None
         if not self._dry_run:
-            data_output = self.merge_output_package_files(list_pf_output_job_packages)
+            data_output = self._merger(output_data)
+
+        # let remaining jobs end (e.g. if the merger stopped early), and write the summary
+        for _ in output_data:
+            pass
 
         return data_output
 
@@ -129,6 +134,16 @@ class PBS:
         # Split data
         list_split_data = self._splitter(data, num_splits, pd_work_pbs)
 
+        # Report the estimated cost (and time) of each job before submitting
+        self._func_name = get_function_name(func)
+        self._job_costs = None
+        costs = get_value(data, "costs", None)
+        if costs is not None:
+            plan = create_job_plan(list_split_data, costs,
+                                   get_cost_per_second(self._env, self._prl_options, func), self._prl_options)
+            plan.to_file(os.path.join(pd_work_pbs, self._prl_options["pbs-fn-plan"]))
+            self._job_costs = plan.job_costs
+
         # Write package to disk
         list_pf_data = self._package_and_save_list_data(list_split_data, func, func_kwargs,
                                                         pf_package_template_formatted)
@@ -138,202 +153,84 @@ class PBS:
 
     def execute_function_on_input_packages(self, pf_input_package_template_formatted, job_name, num_jobs):
         """
-        Create PBS file for run and execute it, returning the paths to all the job output packages
+        Run a job for each input package, yielding the output data of jobs as they end (in job order, so
+        a job's output is yielded once all jobs before it have ended). Once all jobs have ended, the
+        paths to their output packages are written to the summary file.
         :param pf_input_package_template_formatted:
         :param job_name:
         :param num_jobs:
-        :returns: list of paths to output file packages
-        :rtype: str
+        :returns: iterator over the output data of successful jobs
         """
 
-        pd_head = self._prl_options["pbs-pd-head"]
-
-        pf_pbs = os.path.join(self._prl_options["pbs-pd-head"], "run.pbs")
-        pf_input_package_template = pf_input_package_template_formatted.format("${PBS_ARRAYID}")
-
-        # create pbs file
+        pf_input_package_template = pf_input_package_template_formatted.format(ARRAY_ID)
         pf_output_package_template = "{}_output".format(pf_input_package_template)
-        self._create_pbs_file(job_name, num_jobs, pf_pbs, pf_input_package_template, pf_output_package_template)
 
-        # run
+        # remove outputs of a previous run, so that failed jobs don't leave stale results behind
         if not self._dry_run:
-            array_job_name = PBS._qsub(pf_pbs)
-
-            # wait for jobs to end
-            self._wait_for_job_array(array_job_name, pd_head)
+            for x in range(1, num_jobs + 1):
+                remove_p(PBS.create_concrete_from_template(pf_output_package_template + ".pkl", x))
+
+        # run, and read outputs as jobs end
+        list_pf_outputs = list()
+        list_cost_seconds = list()          # estimated cost and run time of jobs, to size later runs
+        ended = set()
+        next_job = 1
+        for job_number in self._executor.run(job_name, num_jobs, pf_input_package_template,
+                                             pf_output_package_template, dry_run=self._dry_run):
+            ended.add(job_number)
+
+            while next_job in ended:
+                pf_output = PBS.create_concrete_from_template(pf_output_package_template, next_job)
+                if os.path.isfile(pf_output + ".pkl"):
+                    list_pf_outputs.append(pf_output)
+                    output_package = PBSJobPackage.load(pf_output)
+                    if self._job_costs is not None and output_package.get("elapsed") is not None:
+                        list_cost_seconds.append((self._job_costs[next_job - 1], output_package["elapsed"]))
+                    yield output_package["data"]
+                next_job += 1
 
         # write summary file
-        list_pf_outputs = [PBS.create_concrete_from_template(pf_output_package_template, x) for x in range(1,num_jobs+1)
-                           if os.path.isfile(PBS.create_concrete_from_template(pf_output_package_template + ".pkl", x))]
         pf_pbs_summary = os.path.join(self._prl_options["pbs-pd-head"], self._prl_options["pbs-fn-summary"])
         sbsp_io.general.write_string_to_file("\n".join(list_pf_outputs), pf_pbs_summary)
 
-        return list_pf_outputs
+        JobHistory(JobHistory.default_path(self._env, self._prl_options)).add_jobs(
+            self._func_name, self._prl_options["pbs-ppn"], list_cost_seconds
+        )
 
     @staticmethod
-    def _qsub(pf_pbs):
-        # type: (str) -> str
-        return run_shell_cmd("qsub  -V " + pf_pbs, do_not_log=True).strip()
-
-    def _read_data_from_output_packages(self, list_pf_output_packages):
-
-        list_data = list()
-
+    def _iterate_data_from_output_packages(list_pf_output_packages):
+        # type: (List[str]) -> Iterator[Any]
         for pf_output_package in list_pf_output_packages:
-            list_data.append(PBSJobPackage.load(pf_output_package)["data"])
-
-        return list_data
+            yield PBSJobPackage.load(pf_output_package)["data"]
 
     def merge_output_package_files(self, list_pf_output_packages):
 
-        list_output_data = self._read_data_from_output_packages(list_pf_output_packages)
-
         # 4-a) Merge data while loading packages one by one
-        data_output = self._merger(list_output_data)
+        data_output = self._merger(PBS._iterate_data_from_output_packages(list_pf_output_packages))
 
         return data_output
 
-    def _package_and_save_data(self, data, func, func_kwargs, pf_package):
-        # type: (Dict[str, Any], Callable, Dict[str, Any], str) -> None
-
-        complete_func_kwargs = FunctionArguments(**func_kwargs).get_arguments(data)
-
-        PBSJobPackage.save(
-            {
-                "func": func,
-                "func_kwargs":  complete_func_kwargs
-            },
-            pf_package
-        )
-
     def _package_and_save_list_data(self, list_data, func, func_kwargs, pf_package_template_formatted):
         # type: (List[Dict[str, Any]], Callable, Dict[str, Any], str) -> List[str]
 
+        # arguments common to all jobs are written once, and referenced by every package
+        shared_input = PBSJobPackage.save_shared_input(
+            func, func_kwargs, pf_package_template_formatted.format("shared")
+        )
+
         list_pf = list()
         file_number = 1
 
         for data in list_data:
             pf_save = pf_package_template_formatted.format(file_number)
 
-            self._package_and_save_data(data, func, func_kwargs, pf_save)
+            PBSJobPackage.save_input(shared_input, data, pf_save)
             list_pf.append(pf_save)
 
             file_number += 1
 
         return list_pf
 
-    def _create_pbs_file(self, jobname, num_jobs, pf_pbs, pf_input_package_template, pf_output_package_template):
-        """
-        Create PBS file for runnning all input jobs
-        :param jobname: Name of job
-        :param num_jobs:
-        :param pf_pbs:
-        :param pf_input_package_template:
-        :return:
-        """
-
-        # create unique compute directory
-        pd_compute = None #run_shell_cmd("mktemp --tmpdir={}".format(self._prl_options["pbs-pd-root-compute"]))
-
-        pbs_text = PBS._generate_pbs_header_array(num_jobs, jobname, self._prl_options, pd_compute=pd_compute)
-
-        pbs_text += "\n{}\n".format(
-            PBS._generate_call_command(self._env,
-                                       pf_input_package_template,
-                                       pf_output_package_template,
-                                       self._prl_options,
-                                       pd_compute=pd_compute
-            )
-        )
-
-        # write to file
-        from sbsp_io.general import write_string_to_file
-        write_string_to_file(pbs_text, pf_pbs)
-
-    @staticmethod
-    def _generate_pbs_header_array(num_jobs, job_name, prl_options, pd_compute):
-        """
-
-        :param num_jobs:
-        :param job_name:
-        :param prl_options:
-        :type prl_options: ParallelizationOptions
-        :return:
-        """
-
-        num_nodes = prl_options["pbs-nodes"]
-        ppn = prl_options["pbs-ppn"]
-        walltime = prl_options["pbs-walltime"]
-
-        pd_compute = os.path.abspath(os.path.join(prl_options["pbs-pd-root-compute"], prl_options["pbs-dn-compute"]))
-
-        pd_job_template = os.path.join(pd_compute, "job_${PBS_ARRAYID}")
-
-        pd_pbs_logs = os.path.join(prl_options["pbs-pd-head"], "pbs_logs")
-        mkdir_p(pd_pbs_logs)
-
-        node_property = prl_options.safe_get("pbs-node-property")
-        if node_property is not None:
-            node_property = ":" + node_property
-        else:
-            node_property = ""
-
-        pbs_text = ""
-
-        pbs_text += "#PBS -N " + str(job_name) + "\n"
-        pbs_text += "#PBS -o " + "{}/{}".format(pd_pbs_logs, "error_${PBS_ARRAYID}") + "\n"
-        pbs_text += "#PBS -j oe" + "\n"
-        pbs_text += "#PBS -l nodes=" + str(num_nodes) + ":ppn=" + str(ppn) + "{}\n".format(node_property)
-        pbs_text += "#PBS -l walltime=" + str(walltime) + "\n"
-
-        if prl_options:
-            array_param = "1-{}".format(num_jobs)
-            if prl_options["pbs-concurrent-nodes"]:
-                total_concurrent_jobs = prl_options["pbs-concurrent-nodes"] * int(8 / ppn)
-                array_param = "{}%{}".format(array_param, total_concurrent_jobs)
-
-            pbs_text += "#PBS -t {}".format(array_param) + "\n"
-
-        pbs_text += "#PBS -W umask=002" + "\n"
-
-        pbs_text += "export PATH=\"/home/karl/anaconda/envs/biogem_sbsp/bin:$PATH\"\n"
-
-        pbs_text += "mkdir -p {}".format(pd_job_template) + "\n"
-
-        pbs_text += "PBS_O_WORKDIR=" + pd_job_template + "\n"
-        pbs_text += "cd $PBS_O_WORKDIR \n"
-        pbs_text += "sleep 60\n"
-
-        pbs_text += "echo The working directory is `echo $PBS_O_WORKDIR`" + "\n"
-        pbs_text += "echo This job runs on the following nodes:" + "\n"
-        pbs_text += "echo `cat $PBS_NODEFILE`" + "\n"
-
-        return pbs_text
-
-    @staticmethod
-    def _generate_call_command(env, pf_job_input, pf_job_output, prl_options, pd_compute):
-
-
-        pd_compute = os.path.abspath(os.path.join(prl_options["pbs-pd-root-compute"], prl_options["pbs-dn-compute"]))
-        pd_job_template = os.path.join(pd_compute, "job_${PBS_ARRAYID}")
-
-        cmd = "{} --pf-job-input {} --pf-job-output {} --pd-work {}".format(
-            "{}/{}".format(env["pd-bin"], "run-pbs-job_py.sh"),
-            pf_job_input,
-            pf_job_output,
-            pd_job_template
-        )
-        cmd = "{} --pf-job-input {} --pf-job-output {} --pd-work {} -l {}".format(
-            "python {}".format(os.path.join(env["pd-code"], "python/driver", "run-pbs-job.py")),
-            pf_job_input,
-            pf_job_output,
-            pd_job_template,
-            logging.getLevelName(logger.getEffectiveLevel())
-        )
-
-        print(cmd)
-        return cmd
-
     @staticmethod
     def create_concrete_from_template(pf_template, file_number):
         """Create a concrete file name based on template and file number
@@ -346,42 +243,7 @@ class PBS:
         :returns: a concrete filename
         """
 
-        return pf_template.replace("${PBS_ARRAYID}", str(file_number))
-
-    def _wait_for_job_array(self, array_jobname, pd_work):
-        # type: (str, str) -> None
-
-        import random, string
-        import sbsp_general.general
-
-        def _create_dummy_pbs_file(pf_dummy, jobname_dummy, pd_work):
-            # type: (str, str, str) -> None
-            pbstext = PBS.generate_pbs_header(jobname_dummy, pd_work, 1, 1, "00:00:01")
-            write_string_to_file(pbstext, pf_dummy)
-
-        def _cmd_run_dummy_and_wait(pf_dummy, jobname_dummy, jobname_array):
-            cmd = "qsub -W depend=afteranyarray:{} {} \n".format(
-                jobname_array,
-                pf_dummy
-            )
-
-            cmd += r'while [ $(qstat -a | grep " R\|Q\|H " | grep ' + jobname_dummy + \
-                   r'  | wc -l) != 0 ]; do sleep 60 ; done'
-
-            return cmd
-
-        # generate a random filename for the dummy job
-        fn_dummy = ''.join(self._rng.choice(list(string.ascii_lowercase)) for _ in range(10))
-        pf_dummy = os.path.join(pd_work, fn_dummy)
-
-        # create an dummy pbs job that waits for the array to finish
-        _create_dummy_pbs_file(pf_dummy, fn_dummy, pd_work)
-
-        # generate pbs command to wait for job-array to finish and then run this dummy job
-        cmd = _cmd_run_dummy_and_wait(pf_dummy, fn_dummy, array_jobname)
-
-        # run command that waits
-        sbsp_general.general.run_shell_cmd(cmd, do_not_log=True)
+        return create_concrete_from_template(pf_template, file_number)
 
     @staticmethod
     def generate_pbs_header(job_name, working_dir=".", num_nodes=1, ppn=1, walltime="00:30:00"):
@@ -1,11 +1,27 @@
+import os
+import json
+import importlib
 from typing import *
+
+import yaml
+import numpy as np
 import cloudpickle as dill
+from Bio import SeqIO
+from Bio.Seq import Seq
+
+from sbsp_general import Environment
+from sbsp_options.options import Options
+
+# Version of the input package format (see PBSJobPackage.save_input): bump when it changes
+JOB_PACKAGE_VERSION = 1
 
 
 def save_obj(obj, name):
     # type: (object, str) -> None
-    with open(name + '.pkl', 'wb') as f:
+    # write then rename, so that a package is never seen partially written
+    with open(name + '.pkl.tmp', 'wb') as f:
         dill.dump(obj, f)
+    os.replace(name + '.pkl.tmp', name + '.pkl')
 
 
 def load_obj(name):
@@ -14,7 +30,119 @@ def load_obj(name):
         return loaded_data
 
 
+def _get_import_path(func):
+    # type: (Callable) -> Union[str, None]
+    """Returns module:name for functions that can be imported by name, None otherwise"""
+    module = getattr(func, "__module__", None)
+    qualname = getattr(func, "__qualname__", "")
+    if module is None or module == "__main__" or "<" in qualname:
+        return None
+    return "{}:{}".format(module, qualname)
+
+
+def _import_from_path(import_path):
+    # type: (str) -> Any
+    module_name, qualname = import_path.split(":")
+    obj = importlib.import_module(module_name)
+    for name in qualname.split("."):
+        obj = getattr(obj, name)
+    return obj
+
+
+def _is_json_value(value):
+    # type: (Any) -> bool
+    """Values that come back unchanged from JSON"""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return True
+    if isinstance(value, list):
+        return all(_is_json_value(v) for v in value)
+    if isinstance(value, dict):
+        return all(isinstance(k, str) and _is_json_value(v) for k, v in value.items())
+    return False
+
+
+def _is_fasta_dict(value):
+    # type: (Any) -> bool
+    """Dictionaries of sequences whose keys can be written (and read back) as FASTA definition lines"""
+    return isinstance(value, dict) and len(value) > 0 and all(
+        isinstance(v, Seq) and isinstance(k, str) and len(k) > 0 and k == k.strip() and "\n" not in k
+        for k, v in value.items()
+    )
+
+
+def _encode_value(value, pf_prefix):
+    # type: (Any, str) -> Dict[str, Any]
+    """
+    Describe a function argument in a job manifest. Small values are stored inline; others are written
+    to a file next to the manifest (named from pf_prefix), in a readable format where possible.
+    """
+
+    if _is_json_value(value):
+        return {"type": "json", "value": value}
+
+    if isinstance(value, Environment):
+        env_dict = value.to_dict()
+        if _is_json_value(env_dict):
+            return {"type": "environment", "value": env_dict}
+
+    if isinstance(value, Options):
+        try:
+            text = yaml.safe_dump({k: value[k] for k in value.option_names()})
+        except yaml.YAMLError:
+            text = None     # options holding objects (e.g. other options) are pickled instead
+
+        if text is not None:
+            pf_value = pf_prefix + ".conf"
+            with open(pf_value, "w") as f:
+                f.write(text)
+            return {"type": "options", "class": _get_import_path(type(value)), "path": pf_value}
+
+    if _is_fasta_dict(value):
+        pf_value = pf_prefix + ".fasta"
+        with open(pf_value, "w") as f:
+            for k, v in value.items():
+                f.write(">{}\n{}\n".format(k, v))
+        return {"type": "fasta", "path": pf_value}
+
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        pf_value = pf_prefix + ".npy"
+        np.save(pf_value, value)
+        return {"type": "npy", "path": pf_value}
+
+    pf_value = pf_prefix + ".pkl"
+    with open(pf_value, "wb") as f:
+        dill.dump(value, f)
+    return {"type": "pickle", "path": pf_value}
+
+
+def _decode_value(encoded, env=None):
+    # type: (Dict[str, Any], Union[Environment, None]) -> Any
+
+    value_type = encoded["type"]
+    if value_type == "json":
+        return encoded["value"]
+    if value_type == "environment":
+        return Environment.init_from_dict(encoded["value"])
+    if value_type == "options":
+        return _import_from_path(encoded["class"]).init_from_complete_file(env, encoded["path"])
+    if value_type == "fasta":
+        return {r.description: r.seq for r in SeqIO.parse(encoded["path"], "fasta")}
+    if value_type == "npy":
+        return np.load(encoded["path"], mmap_mode="r")
+    if value_type == "pickle":
+        with open(encoded["path"], "rb") as f:
+            return dill.load(f)
+
+    raise ValueError("Unknown value type in job package: {}".format(value_type))
+
+
 class PBSJobPackage:
+    """
+    Input and output packages of jobs. An input package is a JSON manifest (<package>.json) naming the
+    function to run (by import path) and its arguments. Arguments shared by all jobs are written once
+    (see save_shared_input), and each job's data is written to files of its own, so the cost of creating
+    packages grows with the size of the data, not with the number of jobs. Output packages are pickled.
+    """
 
     @staticmethod
     def save(pbs_job_package, pf_save_to):
@@ -26,6 +154,84 @@ class PBSJobPackage:
         # type: (str) -> PBSJobPackage
         return load_obj(pf_load_from)
 
+    @staticmethod
+    def save_shared_input(func, func_kwargs, pf_prefix):
+        # type: (Callable, Dict[str, Any], str) -> Dict[str, Any]
+        """
+        Write the function and arguments shared by all jobs of a run
+        :param pf_prefix: prefix of files written for arguments that are not stored inline
+        :return: description of the function and arguments, to pass to save_input
+        """
+
+        import_path = _get_import_path(func)
+        if import_path is not None:
+            encoded_func = {"type": "import", "path": import_path}
+        else:
+            encoded_func = _encode_value(func, "{}_func".format(pf_prefix))
+
+        return {
+            "func": encoded_func,
+            "kwargs": {k: _encode_value(v, "{}_arg_{}".format(pf_prefix, k)) for k, v in func_kwargs.items()}
+        }
+
+    @staticmethod
+    def save_input(shared_input, data, pf_package):
+        # type: (Dict[str, Any], Dict[str, Any], str) -> None
+        """
+        Write the input package of one job
+        :param shared_input: output of save_shared_input
+        :param data: the job's own arguments (these override shared ones)
+        :param pf_package: path to package (without extension)
+        """
+
+        kwargs = dict(shared_input["kwargs"])
+        for k, v in data.items():
+            kwargs[k] = _encode_value(v, "{}_arg_{}".format(pf_package, k))
+
+        manifest = {
+            "version": JOB_PACKAGE_VERSION,
+            "func": shared_input["func"],
+            "kwargs": kwargs
+        }
+
+        with open(pf_package + ".json.tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(pf_package + ".json.tmp", pf_package + ".json")
+
+    @staticmethod
+    def load_input(pf_package):
+        # type: (str) -> Tuple[Callable, Dict[str, Any]]
+        """Returns the function and arguments of a job's input package"""
+
+        if not os.path.isfile(pf_package + ".json"):
+            # packages created before manifests: pickled function and arguments
+            package = load_obj(pf_package)
+            return package["func"], package["func_kwargs"]
+
+        with open(pf_package + ".json", "r") as f:
+            manifest = json.load(f)
+
+        if manifest.get("version", 0) > JOB_PACKAGE_VERSION:
+            raise ValueError("Job package version {} is newer than supported ({}): {}".format(
+                manifest.get("version"), JOB_PACKAGE_VERSION, pf_package
+            ))
+
+        encoded_func = manifest["func"]
+        if encoded_func["type"] == "import":
+            func = _import_from_path(encoded_func["path"])
+        else:
+            func = _decode_value(encoded_func)
+
+        # options are loaded with the job's environment
+        encoded_kwargs = manifest["kwargs"]
+        env = Environment.init_from_dict(dict())
+        if "env" in encoded_kwargs:
+            env = _decode_value(encoded_kwargs["env"])
+
+        func_kwargs = {k: _decode_value(encoded, env) for k, encoded in encoded_kwargs.items()}
+
+        return func, func_kwargs
+
 
 class PBSJobInputPackage:
     """A class that represents an input to a PBS Job"""
@@ -41,4 +247,4 @@ class PBSJobOutputPackage:
     """A class that represents an output from a PBS Job"""
 
     def __init__(self):
-        pass
\ No newline at end of file
+        pass
@@ -1,5 +1,7 @@
 import math
 import os
+import csv
+import shutil
 import logging
 from typing import *
 
@@ -8,7 +10,60 @@ log = logging.getLogger(__name__)
 
 T = TypeVar('T')
 
+# Mergers receive the outputs of jobs as an iterable, one output at a time (in job order), so that they
+# can consume outputs as jobs end, without holding all of them in memory.
+
 
 def merge_identity(list_output_data):
-    # type: (List[T]) -> List[T]
-    return list_output_data
+    # type: (Iterable[T]) -> List[T]
+    return list(list_output_data)
+
+
+def merge_csv_files(list_output_data, pf_output):
+    # type: (Iterable[Union[str, List[str]]], str) -> List[str]
+    """
+    Concatenate the CSV files produced by jobs (each output is a path, or a list of paths) into a single
+    file, row by row. The header of the first file is written once; files with the same columns in a
+    different order are reordered to match it. Missing files (e.g. jobs without results) are skipped.
+    :return: a list containing pf_output
+    """
+
+    header = None       # type: Union[List[str], None]
+    num_files = 0
+
+    with open(pf_output, "w", newline="") as f_out:
+        writer = csv.writer(f_out, lineterminator="\n")
+
+        for output in list_output_data:
+            list_pf = [output] if isinstance(output, str) else output
+
+            for pf in list_pf:
+                if pf is None or not os.path.isfile(pf):
+                    continue
+
+                with open(pf, "r", newline="") as f_in:
+                    line = f_in.readline()
+                    if len(line.strip()) == 0:
+                        continue
+                    curr_header = next(csv.reader([line]))
+
+                    if header is None:
+                        header = curr_header
+                        f_out.write(line)
+
+                    if curr_header == header:
+                        shutil.copyfileobj(f_in, f_out)
+                    else:
+                        extra = set(curr_header).difference(header)
+                        if len(extra) > 0:
+                            log.warning("Dropping columns not in first file from {}: {}".format(pf, sorted(extra)))
+
+                        column_to_index = {c: i for i, c in enumerate(curr_header)}
+                        indices = [column_to_index.get(c) for c in header]
+                        for row in csv.reader(f_in):
+                            writer.writerow([row[i] if i is not None else "" for i in indices])
+
+                num_files += 1
+
+    log.debug("Merged {} files into {}".format(num_files, pf_output))
+    return [pf_output]
@@ -1,5 +1,6 @@
 import math
 import os
+import heapq
 import logging
 import pandas as pd
 from typing import *
@@ -46,11 +47,36 @@ def split_list(data, num_splits, pd_work, **kwargs):
 
     return list_splits
 
+
+def assign_by_longest_job_first(keys_to_costs, num_splits):
+    # type: (Dict[T, float], int) -> List[List[T]]
+    """
+    Greedy longest-processing-time assignment: keys are taken from most to least expensive, and each
+    goes to the split with the smallest total cost so far.
+    :return: list of keys per split, each ordered from most to least expensive
+    """
+
+    splits = [list() for _ in range(num_splits)]        # type: List[List[T]]
+    heap = [(0.0, i) for i in range(num_splits)]         # (total cost, split index)
+
+    for k in sorted(keys_to_costs.keys(), key=lambda x: keys_to_costs[x], reverse=True):
+        total, i = heapq.heappop(heap)
+        splits[i].append(k)
+        heapq.heappush(heap, (total + keys_to_costs[k], i))
+
+    return splits
+
+
 def split_dict(data, num_splits, pd_work, **kwargs):
     # type: (Dict[str, Any], int, str, Dict[str, Any]) -> List[Dict[str, Any]]
+    """
+    Split dictionary entries across jobs. If data contains "costs" (estimated run time per key), splits
+    are balanced by cost (longest job first); otherwise entries are dealt out round-robin.
+    """
 
     a_dict = data["dict"]       # type: Dict[str, Any]
     pf_output_template = data["pf_output_template"]
+    costs = get_value(data, "costs", None)      # type: Union[Dict[str, float], None]
 
     list_splits = list()
     num_splits = min(num_splits, len(a_dict))
@@ -58,11 +84,25 @@ def split_dict(data, num_splits, pd_work, **kwargs):
         list_splits.append(dict())
         list_splits[-1]["data"] = dict()
 
-    index = 0
+    if costs is not None:
+        keys_per_split = assign_by_longest_job_first(
+            {k: costs.get(k, 0) for k in a_dict.keys()}, num_splits
+        )
+
+        for i, keys in enumerate(keys_per_split):
+            for k in keys:
+                list_splits[i]["data"][k] = a_dict[k]
+
+        for i, keys in enumerate(keys_per_split):
+            log.debug("Split {}: {} entries, estimated cost {}".format(
+                i + 1, len(keys), sum(costs.get(k, 0) for k in keys)
+            ))
+    else:
+        index = 0
 
-    for k, v in a_dict.items():
-        list_splits[index % num_splits]["data"][k] = v
-        index += 1
+        for k, v in a_dict.items():
+            list_splits[index % num_splits]["data"][k] = v
+            index += 1
 
     for split_number in range(1, len(list_splits)+1):
         list_splits[split_number-1]["pf_output"] = pf_output_template.format(split_number)